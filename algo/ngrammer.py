@@ -11,10 +11,15 @@ Usage from a folder where "nifty" package is visible:
     cat ngrams_pl_10.txt | env LC_ALL=C sort | uniq -c | sort -n
     cat ngrams_it_10.txt | env LC_ALL=C sort | uniq -c | sort -nr | head -n300000 > freq_ngrams_it_10.txt
 
-2)  python -m nifty.algo.ngrammer score document.txt ...
+    or, from a local corpus of *.txt files, counted in parallel and written directly to ngrams/freq_ngrams_it_10.txt:
+    
+    python -m nifty.algo.ngrammer corpus it 10 corpus_dir/ [--jobs N] [--top 300000] [--sketch WIDTH]
+
+2)  python -m nifty.algo.ngrammer score [--jobs N] document.txt ...
 
 
-This code is compatible with Python 2 & 3.
+This code is compatible with Python 2 & 3, except for --sketch (NgramCounter with a CountMinSketch),
+which requires Python 3 and numpy >= 1.17, like nifty.math.
 
 @author:  Marcin Wojnarski
 @contact: mwojnars@ns.onet.pl
@@ -22,9 +27,10 @@ This code is compatible with Python 2 & 3.
 
 
 from __future__ import print_function
-import os, sys, re, random, unicodedata, chardet, click
+import os, sys, io, re, random, unicodedata, fnmatch, chardet, click, numpy as np
 from itertools import islice
 from collections import namedtuple
+from multiprocessing import Pool, cpu_count
 from six.moves import urllib
 from glob import glob
 
@@ -143,44 +149,377 @@ class Wikipedia(object):
                 count += 1
                 if count % 1000 == 0: print(count, file = sys.stderr)
                 if None != limit <= count: return
-                      
+
+
+#####################################################################################################################################################
+#####
+#####  LOCAL CORPUS COUNTING
+#####
+
+def _CountMinSketch(*args, **kwargs):
+    "Create nifty.math.CountMinSketch, imported only when needed, because nifty.math is Python 3 only."
+    if not PY3: raise Exception("NgramCounter, counting with a sketch requires Python 3")
+    if __name__ != "__main__": from ..math import CountMinSketch
+    else: from nifty.math import CountMinSketch
+    return CountMinSketch(*args, **kwargs)
+
+class NgramCounter(object):
+    """
+    Counts of character n-grams of a given length in a stream of texts. Like in Wikipedia.stream_ngrams(),
+    texts are lowercased and n-grams don't cross line boundaries; additionally, spaces inside lines are merged.
+    By default, counts are exact and kept in a dict. With `sketch` = width of a CountMinSketch, memory is bounded:
+    all n-grams are counted approximately in the sketch, and only up to `capacity` candidates for the most frequent ones
+    are kept, together with the minimum estimated count a new n-gram must reach to become a candidate;
+    when the candidates overflow, they're pruned to the most frequent half and the minimum is raised.
+    Counters of the same length and sketch shape can be merged, so a corpus can be counted in parallel (count_corpus()).
+    The sketch requires Python 3 and numpy >= 1.17 (nifty.math), exact counting works in Python 2, too.
+
+    >>> counter = NgramCounter(3)
+    >>> counter.add_text(u"Ala ma  kota,\\nala ma psa")
+    >>> counter.most_common(3)
+    [(' ma', 2), ('a m', 2), ('ala', 2)]
+    >>> sketched = NgramCounter(3, sketch = 1024)
+    >>> sketched.add_text(u"Ala ma  kota,\\nala ma psa")
+    >>> sketched.most_common(3) == counter.most_common(3)
+    True
+    """
+    def __init__(self, length, sketch = None, capacity = 1000000, seed = 0):
+        self.length = int(length)
+        self.counts = {}                        # n-gram -> exact count; or -> hash key of a candidate if sketch is used
+        self.sketch = _CountMinSketch(sketch, seed = seed) if sketch else None
+        self.capacity = capacity
+        self.threshold = 0                      # min. estimated count of a new candidate, with sketch
+
+    def add_text(self, text):
+        L = self.length
+        lines = (merge_spaces(line) for line in text.lower().split('\n'))
+        codes = _encode(u'\n'.join(line for line in lines if len(line) >= L))
+        n = len(codes)
+        if n < L: return
+
+        windows = np.lib.stride_tricks.as_strided(codes, shape = (n - L + 1, L), strides = (codes.strides[0],) * 2)
+        newlines = np.concatenate([[0], np.cumsum(codes == ord('\n'))])
+        windows = windows[newlines[L:] == newlines[:n-L+1]]                 # drop windows that span 2 lines
+        grams, keys, counts = self._unique(windows)
+        strings = _decode(grams.ravel())
+        strings = [strings[i:i+L] for i in range(0, len(strings), L)]
+
+        if self.sketch is None:
+            get = self.counts.get
+            for ngram, count in zip(strings, counts.tolist()):
+                self.counts[ngram] = get(ngram, 0) + count
+            return
+
+        self.sketch.add_many(keys, counts)
+        frequent = np.flatnonzero(self.sketch.estimate(keys) >= self.threshold)
+        for i in frequent.tolist():
+            self.counts[strings[i]] = keys[i]
+        if len(self.counts) > self.capacity: self._prune()
+
+    @staticmethod
+    def _unique(windows):
+        """
+        Unique rows of a 2D array of codes, their hashes and counts. Rows are grouped by sorting their 64-bit hashes,
+        which is much faster than sorting the rows themselves; rows in every group are verified to be equal,
+        and in the (unlikely) case of a hash collision, the rows are sorted after all.
+        """
+        hashes = _hash(windows, NgramSet.BASE)
+        order = np.argsort(hashes, kind = 'stable')
+        hashes = hashes[order]
+        same = np.flatnonzero(hashes[1:] == hashes[:-1])
+        if (windows[order[same]] != windows[order[same + 1]]).any():
+            grams, counts = np.unique(windows, axis = 0, return_counts = True)
+            return grams, _hash(grams, NgramSet.BASE), counts
+
+        firsts = np.flatnonzero(np.concatenate([[True], hashes[1:] != hashes[:-1]]))
+        counts = np.diff(np.append(firsts, len(hashes)))
+        return windows[order[firsts]], hashes[firsts], counts
+
+    def add_file(self, fname, chunk = 10000000):
+        "Count n-grams in a UTF-8 text file, read in chunks of about `chunk` characters that end at line boundaries."
+        with io.open(fname, 'rt', encoding = 'utf-8', errors = 'replace') as f:
+            while True:
+                lines = f.readlines(chunk)
+                if not lines: break
+                self.add_text(u''.join(lines))
+
+    def _prune(self):
+        "Keep the most frequent half of the candidates; those dropped can come back only when they become more frequent."
+        ngrams, estimates = self._estimates()
+        keep = np.argsort(-estimates, kind = 'stable')[:self.capacity // 2]
+        self.threshold = max(self.threshold, int(estimates[keep[-1]])) if len(keep) else self.threshold
+        self.counts = {ngrams[i]: self.counts[ngrams[i]] for i in keep.tolist()}
+
+    def _estimates(self):
+        ngrams = list(self.counts)
+        keys = np.array([self.counts[ngram] for ngram in ngrams], dtype = np.uint64)
+        return ngrams, self.sketch.estimate(keys)
+
+    def merge(self, other):
+        "Combine with another counter of the same length, exact or with a sketch of the same shape. Returns self."
+        if other.length != self.length or (other.sketch is None) != (self.sketch is None):
+            raise Exception("NgramCounter.merge(): can't merge counters of different lengths or types")
+        if self.sketch is None:
+            get = self.counts.get
+            for ngram, count in other.counts.items():
+                self.counts[ngram] = get(ngram, 0) + count
+            return self
+
+        self.sketch.merge(other.sketch)
+        self.counts.update(other.counts)
+        self.threshold = max(self.threshold, other.threshold)
+        if len(self.counts) > self.capacity: self._prune()
+        return self
+
+    def most_common(self, top = None):
+        "List of (ngram, count) pairs of the `top` most frequent n-grams, sorted by decreasing count, ties alphabetically."
+        if self.sketch is None:
+            items = self.counts.items()
+        else:
+            ngrams, estimates = self._estimates()
+            items = zip(ngrams, estimates.tolist())
+        items = sorted(items, key = lambda item: (-item[1], item[0]))
+        return items[:top] if top else items
+
+    def save_table(self, fname, top = 300000, minfreq = 1):
+        "Write the `top` most frequent n-grams to a freq_ngrams_*.txt file, in the format of `sort | uniq -c | sort -nr`."
+        with io.open(fname, 'wt', encoding = 'utf-8') as f:
+            for ngram, count in self.most_common(top):
+                if count < minfreq: break
+                f.write(u'%7d %s\n' % (count, ngram))
+
+
+def list_files(paths, pattern = '*.txt'):
+    "Files in `paths` (a path or a list): files are taken as they are, directories are searched recursively for `pattern`."
+    if isinstance(paths, str if PY3 else basestring): paths = [paths]
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, _, names in os.walk(path):
+            files += sorted(os.path.join(root, name) for name in fnmatch.filter(names, pattern))
+    return files
+
+def _split_files(files, parts):
+    "Partition files into `parts` lists of similar total size: largest files first, each to the currently smallest part."
+    sizes = [0] * parts
+    groups = [[] for _ in range(parts)]
+    for fname in sorted(files, key = os.path.getsize, reverse = True):
+        i = sizes.index(min(sizes))
+        groups[i].append(fname)
+        sizes[i] += os.path.getsize(fname)
+    return [group for group in groups if group]
+
+def _count_files(args):
+    files, length, sketch, capacity = args
+    counter = NgramCounter(length, sketch, capacity)
+    for fname in files: counter.add_file(fname)
+    return counter
+
+def count_corpus(paths, length, jobs = None, sketch = None, capacity = 1000000, pattern = '*.txt'):
+    """
+    Count n-grams of a given length in a corpus of UTF-8 text files: `paths` is a file, a directory (searched recursively
+    for `pattern`) or a list of them. The files are split into `jobs` groups of similar size (jobs=None: one per CPU),
+    each group is counted by a separate worker process with its own NgramCounter(length, sketch, capacity),
+    and the counters are merged. Returns the merged NgramCounter; see NgramCounter.save_table() to write a frequency table.
+    """
+    files = list_files(paths, pattern)
+    groups = _split_files(files, jobs or cpu_count())
+    tasks = [(group, length, sketch, capacity) for group in groups]
+
+    if len(tasks) <= 1:
+        counters = list(map(_count_files, tasks))
+    else:
+        pool = Pool(len(tasks))
+        try: counters = pool.map(_count_files, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+    total = NgramCounter(length, sketch, capacity)
+    for counter in counters: total.merge(counter)
+    return total
+
 
 #####################################################################################################################################################
 #####
 #####  TEXT SCORING
 #####
 
+class NgramSet(object):
+    """
+    A set of n-grams (strings, possibly of different lengths) that finds all overlapping occurrences of its n-grams
+    in a text in linear time. N-grams of every length L are stored as rows of a (count x L) array of character codes,
+    sorted by a polynomial hash. A text is split into all windows of length L at once (a strided view of its codes),
+    the rolling hash of every window is calculated with numpy, looked up with binary search,
+    and candidate matches are verified by comparing the codes, so hash collisions never produce false matches.
+    Can be saved to an .npz file and loaded back much faster than built from a list of strings.
+    
+    >>> ngrams = NgramSet(['ala', 'kot', 'ot ', 'ma ', 'ma'])
+    >>> starts, ids = ngrams.find('ala ma kot i psa')
+    >>> starts.tolist(), [ngrams[i] for i in ids], ngrams.length(ids).tolist()
+    ([0, 4, 7, 8], ['ala', 'ma ', 'kot', 'ot '], [3, 3, 3, 3])
+    """
+    BASE = 1000003                              # initial base of the polynomial hash
+    
+    def __init__(self, ngrams = ()):
+        self.groups = {}                        # L -> (hashes, codes, base) of n-grams of length L, sorted by hashes
+        self.update(ngrams)
+    
+    def __len__(self):
+        return sum(len(codes) for _, codes, _ in self.groups.values())
+    
+    def __getitem__(self, id):
+        "The n-gram of a given id, as returned by find()."
+        for L in sorted(self.groups):
+            codes = self.groups[L][1]
+            if id < len(codes): return _decode(codes[id])
+            id -= len(codes)
+        raise IndexError(id)
+    
+    def update(self, ngrams):
+        "Add n-grams: strings or another NgramSet."
+        added = {}
+        if isinstance(ngrams, NgramSet):
+            for L, (_, codes, _) in ngrams.groups.items(): added[L] = [codes]
+        else:
+            bylen = {}
+            for ngram in ngrams: bylen.setdefault(len(ngram), []).append(ngram)
+            for L, strings in bylen.items():
+                if L: added[L] = [_encode(u''.join(strings)).reshape(-1, L)]
+        
+        for L, codes in added.items():
+            if L in self.groups: codes.append(self.groups[L][1])
+            self._set(L, np.unique(np.concatenate(codes), axis = 0))
+    
+    def _set(self, L, codes, base = None):
+        "Hash and sort n-grams of length L; the hash base is changed until hashes of different n-grams are unique."
+        base = base or self.BASE
+        while True:
+            hashes = _hash(codes, base)
+            order = np.argsort(hashes, kind = 'stable')
+            hashes = hashes[order]
+            if not len(hashes) or (hashes[1:] != hashes[:-1]).all(): break
+            base += 2
+        self.groups[L] = (hashes, codes[order], base)
+    
+    def find(self, text):
+        """
+        Find occurrences of n-grams in 'text': at every position where at least one n-gram starts, the longest one is taken.
+        Returns a pair of arrays: start positions (sorted) and ids of the n-grams found; the n-gram of a given id
+        is self[id], its length is len(self[id]) or self.length(ids).
+        """
+        codes = _encode(text)
+        n = len(codes)
+        best = np.full(n, -1, dtype = np.int64)                             # id of the longest n-gram starting at a given position
+        offset = len(self)
+        for L in sorted(self.groups, reverse = True):
+            hashes, grams, base = self.groups[L]
+            offset -= len(grams)
+            if n < L or not len(grams): continue
+            windows = np.lib.stride_tricks.as_strided(codes, shape = (n - L + 1, L), strides = (codes.strides[0],) * 2)
+            h = _hash(windows, base)
+            idx = np.minimum(np.searchsorted(hashes, h), len(hashes) - 1)
+            pos = np.flatnonzero(hashes[idx] == h)
+            pos = pos[(windows[pos] == grams[idx[pos]]).all(axis = 1)]      # verify: exclude hash collisions
+            pos = pos[best[pos] < 0]                                         # longer n-grams take precedence
+            best[pos] = offset + idx[pos]
+        starts = np.flatnonzero(best >= 0)
+        return starts, best[starts]
+    
+    def length(self, ids):
+        "Lengths of n-grams of given ids (array)."
+        lengths = sorted(self.groups)
+        bounds = np.cumsum([len(self.groups[L][1]) for L in lengths])
+        return np.array(lengths)[np.searchsorted(bounds, ids, side = 'right')]
+    
+    def save(self, path):
+        "Save to an .npz file."
+        arrays = {}
+        for L, (hashes, codes, base) in self.groups.items():
+            arrays['codes_%d' % L] = codes
+            arrays['base_%d' % L] = np.array(base)
+        np.savez(path, **arrays)
+    
+    @staticmethod
+    def load(path):
+        ngrams = NgramSet()
+        with np.load(path) as data:
+            for key in data.files:
+                if not key.startswith('codes_'): continue
+                L = int(key.split('_')[1])
+                codes, base = data[key], int(data['base_%d' % L])
+                ngrams.groups[L] = (_hash(codes, base), codes, base)
+        return ngrams
+    
+
+def _encode(text):
+    "Array of unicode code points of characters of 'text'. A byte string (Python 2 str) is decoded from UTF-8 first, like in Scorer.score()."
+    if isinstance(text, bytes): text = text.decode('utf-8', 'replace')
+    return np.frombuffer(text.encode('utf-32-le'), dtype = np.uint32)
+
+def _decode(codes):
+    return codes.astype(np.uint32).tobytes().decode('utf-32-le')
+
+def _hash(codes, base):
+    "Polynomial hash, modulo 2^64, of every row of a 2D array of character codes."
+    h = np.zeros(len(codes), dtype = np.uint64)
+    base = np.uint64(base)
+    for k in range(codes.shape[1]):
+        h = h * base + codes[:, k]
+    return h
+
+
 class Scorer(object):
     """
     In method score(), Scorer takes a text and finds in it all overlapping matches of frequent n-grams (loaded in __init__),
     to calculate: (1) the fraction of text matched (after lowercase + spaces merged); (2) no. of different unique n-grams matched.
+    N-grams are matched with NgramSet; the set built from every file is cached on disk next to the file
+    (freq_ngrams_*.txt.min<minfreq>.npz), and reused as long as it's newer than the file.
     """
     
     verbose = True
     
-    def __init__(self, minfreq = 50, lang = '*', length = '*', path = PATH + "ngrams/"):
-        
-        # filtering out strings like:
-        #   athbf {x}      \mathbf {x
-        #   \color {gr     r {gray}{0    &\color {g    {gray}{0}&
-        #   {\displays     playstyle     aystyle {\     style \mat
-        #   \operatorn     0 0 0 0 0     x • xi • x
-        re_invalid = RE(r"\\mat|\\col|\\disp|\\oper|\{|\}|\&\\|displayst|aystyle|0 0 0|" u"x • x|codec can't decode")
-        
-        def invalid(s):
-            return re_invalid.search(s)
+    def __init__(self, minfreq = 50, lang = '*', length = '*', path = PATH + "ngrams/", cache = True):
         
         if self.verbose: print("Loading frequent n-grams (phrases)...")
         
         filenames = glob(path + "freq_ngrams_%s_%s.txt" % (lang, length))
         if not filenames: raise Exception("No file with ngrams found")
         
-        phrases = []
+        self.ngrams = NgramSet()
         for fn in filenames:
             
-            target_len = int(fn.rsplit('.',1)[0].rsplit('_',1)[1])
-            f = open(fn, 'rt')
+            cached = fn + ".min%d.npz" % minfreq
+            if cache and os.path.exists(cached) and os.path.getmtime(cached) >= os.path.getmtime(fn):
+                self.ngrams.update(NgramSet.load(cached))
+                continue
             
+            ngrams = NgramSet(self.read_ngrams(fn, minfreq))
+            if cache:
+                try: ngrams.save(cached)
+                except (IOError, OSError) as ex:
+                    if self.verbose: print("Can't save n-grams cache:", ex)
+            self.ngrams.update(ngrams)
+        
+        if self.verbose: print("Phrases (no duplicates):   ", len(self.ngrams))
+
+    @classmethod
+    def read_ngrams(cls, fn, minfreq,
+                    # filtering out strings like:
+                    #   athbf {x}      \mathbf {x
+                    #   \color {gr     r {gray}{0    &\color {g    {gray}{0}&
+                    #   {\displays     playstyle     aystyle {\     style \mat
+                    #   \operatorn     0 0 0 0 0     x • xi • x
+                    re_invalid = RE(r"\\mat|\\col|\\disp|\\oper|\{|\}|\&\\|displayst|aystyle|0 0 0|" u"x • x|codec can't decode")
+                    ):
+        "Generate lowercase n-grams of frequency >= minfreq from a freq_ngrams_*.txt file."
+        
+        target_len = int(fn.rsplit('.',1)[0].rsplit('_',1)[1])
+        count = 0
+        
+        with open(fn, 'rt') as f:
             for line in f:
                 if not PY3: line = line.decode('utf-8')
                 line = line.lstrip()
@@ -198,51 +537,74 @@ class Scorer(object):
                     assert len(ngram) == target_len
                 
                 if freq < minfreq: continue
-                if invalid(ngram): continue
+                if re_invalid.search(ngram): continue
                 
-                phrases.append(ngram)
-                #print(freq, '[%s]' % ngram)
-                
-        if self.verbose: print("Phrases (with duplicates): ", len(phrases))
-        phrases = set(phrases)
-        if self.verbose: print("Phrases (no duplicates):   ", len(phrases))
-
-        if self.verbose: print("Building regex pattern...")
-        phrases = map(re.escape, phrases)
-        self.re_phrases = RE("(?iu)(?=(%s))" % "|".join(phrases))           # standard re.compile() works 2-3x faster than regex.compile() that allows overlapped=True in finditer()
-        #print(self.re_phrases.pattern)
+                count += 1
+                yield ngram.lower()             # matching is case-insensitive
+        
+        if cls.verbose: print("Phrases in %s: %s" % (os.path.basename(fn), count))
 
     def score(self, text):
         
+        if isinstance(text, bytes): text = text.decode('utf-8', 'replace')      # positions of matches are in characters, not bytes
         text = text.lower()
         text = merge_spaces(text)
-        total_matched = 0
-        unique = set()
+        total_len = len(text)
         
-        last = 0
-        for match in self.re_phrases.finditer(text):
-            phrase = match.group(1)
-            start  = match.start()              # we look for OVERLAPPING matches! for this reason, we use lookahead matches in the regex and the actual match returned is always 0-length
-            stop   = start + len(phrase)        # we need to take group(1) - from inside the lookahead match - to retrieve the length of the matched substring
-            unique.add(phrase)
-            if start < last: start = last
-            assert start < stop
-            
-            if self.verbose:
+        # we look for OVERLAPPING matches: the text is covered by a union of all matched n-grams
+        starts, ids = self.ngrams.find(text)
+        stops = starts + self.ngrams.length(ids)
+        cover = np.zeros(total_len + 1, dtype = np.int64)
+        np.add.at(cover, starts, 1)
+        np.add.at(cover, stops, -1)
+        covered = np.cumsum(cover[:-1]) > 0
+        total_matched = int(covered.sum())
+        
+        if self.verbose:
+            edges = np.flatnonzero(np.diff(np.concatenate([[False], covered, [False]]).astype(np.int8)))
+            last = 0
+            for start, stop in zip(edges[::2], edges[1::2]):
                 click.secho(text[last:start], nl = False)
                 click.secho(text[start:stop], nl = False, bg = 'blue')
-            
-            total_matched += stop - start
-            last = stop
-        
-        if self.verbose: click.secho(text[last:])
+                last = stop
+            click.secho(text[last:])
+            print("Matched characters: %s of %s" % (total_matched, total_len))
         
-        #matches = self.re_phrases.findall(text)
-        #total_matched = sum(map(len, matches))
-        total_len = len(text)
+        return float(total_matched) / total_len, len(np.unique(ids))
+
+    def score_files(self, fnames, jobs = 1):
+        """
+        Generate (fname, score, unique) for every file on the list, in the same order. With jobs > 1, files are scored
+        in a pool of worker processes that share this scorer (read-only; inherited without copying where fork is available);
+        verbose printing is disabled in workers.
+        """
+        if jobs <= 1 or len(fnames) <= 1:
+            for fname in fnames:
+                yield (fname,) + self.score(_read_text(fname))
+            return
         
-        if self.verbose: print("Matched characters: %s of %s" % (total_matched, total_len))
-        return float(total_matched) / total_len, len(unique)
+        pool = Pool(jobs, _score_init, (self,))
+        try:
+            for fname, result in zip(fnames, pool.imap(_score_file, fnames)):
+                yield (fname,) + result
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _read_text(fname):
+    with io.open(fname, 'rt', encoding = 'utf-8', errors = 'replace') as f:
+        return f.read()
+
+_scorer = None                                  # Scorer shared by worker processes of Scorer.score_files()
+
+def _score_init(scorer):
+    global _scorer
+    _scorer = scorer
+    _scorer.verbose = False
+
+def _score_file(fname):
+    return _scorer.score(_read_text(fname))
 
 
 #####################################################################################################################################################
@@ -250,26 +612,45 @@ class Scorer(object):
 #####  MAIN
 #####
 
+def _pop_option(args, name, default = None):
+    "Remove '--name value' from the list of command-line `args` and return the value converted to int, or `default` if absent."
+    if name not in args: return default
+    i = args.index(name)
+    value = args[i+1]
+    del args[i:i+2]
+    return int(value)
+
+
 if __name__ == '__main__':
 
-    cmd = sys.argv[1]
+    cmd, args = sys.argv[1], sys.argv[2:]
     
     if cmd == 'wikipedia':
         
-        for ngram in Wikipedia.stream_ngrams(*sys.argv[2:]):
+        for ngram in Wikipedia.stream_ngrams(*args):
             print(ngram if PY3 else ngram.encode('utf-8'))
         
+    elif cmd == 'corpus':
+        
+        jobs   = _pop_option(args, '--jobs')
+        top    = _pop_option(args, '--top', 300000)
+        sketch = _pop_option(args, '--sketch')
+        lang, length, paths = args[0], int(args[1]), args[2:]
+        
+        counter = count_corpus(paths, length, jobs, sketch)
+        fname = PATH + "ngrams/freq_ngrams_%s_%d.txt" % (lang, length)
+        if not os.path.isdir(os.path.dirname(fname)): os.makedirs(os.path.dirname(fname))
+        counter.save_table(fname, top)
+        print("N-grams written to", fname)
+        
     elif cmd == 'score':
         
+        jobs = _pop_option(args, '--jobs', 1)
         scorer = Scorer()
-        for fname in sys.argv[2:]:
-            text = open(fname).read()
-            if not PY3: text = text.decode('utf-8')
-            print("Matching...")
-            score, unique = scorer.score(text)
+        if jobs <= 1: print("Matching...")
+        for fname, score, unique in scorer.score_files(args, jobs):
             print("%.2f%% matched (%d unique frequent n-grams)" % (score * 100, unique), '-', fname)
     
     else:
         print("Unknown command:", cmd)
         
-    
@@ -62,11 +62,13 @@ if __name__ != "__main__":
     from ..util import isint, islist, istuple, isstring, issubclass, isfunction, isgenerator, iscontainer, istype, \
                        classname, getattrs, setattrs, Tee, openfile, Object, __Object__
     from ..files import GenericFile, File as files_File, SafeRewriteFile, ObjectFile, JsonFile, DastFile
+    from ..math import Stack, namedarray, Moments, MinMax, QuantileSketch, Histogram as _Histogram
 else:
     from nifty import util
     from nifty.util import isint, islist, istuple, isstring, issubclass, isfunction, isgenerator, iscontainer, istype, \
                        classname, getattrs, setattrs, Tee, openfile, Object, __Object__
     from nifty.files import GenericFile, File as files_File, SafeRewriteFile, ObjectFile, JsonFile, DastFile
+    from nifty.math import Stack, namedarray, Moments, MinMax, QuantileSketch, Histogram as _Histogram
 
 
 #####################################################################################################################################################
@@ -1537,14 +1539,21 @@ class Metric(Monitor):
     Aggregation can be implemented in either aggregate() (recommended for general-purpose classes, more versatile), 
     or metric(), together with calculating individual values (easier when writing a short class for one-time use).
     Subclasses can use self.size attribute, which holds the no. of individual not-None metrics computed so far.
+    
+    Subclasses may keep their aggregated state in a mergeable accumulator from nifty.math (Moments, MinMax, ...)
+    assigned to self.acc in open(). Then, the default aggregate() feeds it with metric values - a single value per item,
+    or a whole batch (array) of values per item if `batch` is True - and the default merge() can combine the results
+    of several copies of the pipe run in parallel workers on different parts of the data.
     """
 
     class __knobs__:
         fun = None
+        batch = False           # if True, metric() returns a batch of values (an array) per item, not a single value
     
     #metricname = None           # if not-None, metric of each item will be saved in the item under this name
     last = None                 # most recent individual metric value calculated
     size = None                 # no. of individual metrics calculated & aggregated so far excluding Nones
+    acc  = None                 # optional mergeable accumulator, created in open() of a subclass
 
     def _prolog(self):
         self.size = 0
@@ -1564,6 +1573,17 @@ class Metric(Monitor):
     def aggregate(self, metric):
         """Override in subclasses to update internal structures for calculation of an aggregated metric, 
         after new individual sample was measured with the result 'metric'."""
+        if self.acc is None: return
+        if self.batch: self.acc.add_many(metric)
+        else: self.acc.add(metric)
+        
+    def merge(self, other):
+        """Combine aggregated results of `other` pipe of the same class, typically a copy that was run in a parallel worker
+        on another part of the data, into self; report() is not called. Override in subclasses that don't use self.acc."""
+        if self.acc is None: raise Exception("%s doesn't support merging of results" % classname(self))
+        self.acc.merge(other.acc)
+        self.size += other.size
+        return self
         
     def report(self):
         """Override in subclasses to print out calculated metrics at the end of data iteration. 
@@ -1573,39 +1593,100 @@ class Metric(Monitor):
 class Mean(Metric):
     """Calculates sample mean & std.deviation of values measured for individual items by a given metric.
     The metric is either implemented in overridden metric() method, or given as a function - argument of initialization
-    (typically a lambda expression).
+    (typically a lambda expression). Calculated with a numerically stable Welford's algorithm (math.Moments).
+    >>> PIPE >> [1e9 + 1, 1e9 + 2, 1e9 + 3] >> Mean(fun = lambda x: x, title = 'x') >> RUN
+    x mean +stddev /size:    1000000002.0000 +1.00 /3
     """
     class __knobs__:
         title = None                # leading message when printing the report line
         
     def open(self):
-        self.sum = self.sum2 = 0.0
+        self.acc = Moments()
     
-    def aggregate(self, metric):
-        self.sum += metric
-        self.sum2 += metric ** 2
-
     def mean(self): 
         "Sample mean"
-        if self.size <= 0: return None
-        return self.sum / float(self.size)
+        return self.acc.mean()
 
     def deviation(self): 
         "Sample standard deviation"
-        if self.size <= 1: return None
-        N = float(self.size)
-        return np.sqrt((self.sum2 - self.sum/N * self.sum) / (N-1))
+        return self.acc.std()
 
     def report(self):
         def _s(x, f): return None if x is None else f % x
         header = "mean +stddev /size:    "
         if self.title: header = self.title + ' ' + header
-        if self.size:
+        if self.acc.count:
             mean = _s(self.mean(), "%.4f")
             dev = _s(self.deviation(), "%.2f")
-            print(header + "%s +%s /%d" % (mean, dev, self.size), file = self.out)
+            print(header + "%s +%s /%d" % (mean, dev, self.acc.count), file = self.out)
         else:
-            print(header + "None +None /%s" % self.size, file = self.out)
+            print(header + "None +None /%s" % self.acc.count, file = self.out)
+    
+
+class Extremes(Metric):
+    """Calculates minimum and maximum of values measured for individual items by a given metric (math.MinMax),
+    together with their 0-based indices in the stream of values.
+    >>> PIPE >> [[3, 1], [7, 0], [5, 5]] >> Extremes(fun = np.array, batch = True) >> RUN
+    min @idx / max @idx:    0 @3 / 7 @2
+    """
+    class __knobs__:
+        title = None
+        
+    def open(self):
+        self.acc = MinMax()
+    
+    def report(self):
+        header = "min @idx / max @idx:    "
+        if self.title: header = self.title + ' ' + header
+        acc = self.acc
+        print(header + "%s @%s / %s @%s" % (acc.min(), acc.idxmin(), acc.max(), acc.idxmax()), file = self.out)
+
+
+class Quantiles(Metric):
+    """Calculates approximate quantiles of values measured for individual items by a given metric,
+    using a mergeable sketch of bounded size (math.QuantileSketch).
+    >>> PIPE >> range(101) >> Quantiles(fun = float, q = [0.5, 0.9]) >> RUN
+    quantiles 0.5, 0.9:    50, 90
+    """
+    class __knobs__:
+        title = None
+        q = (0.25, 0.5, 0.75)       # quantiles to report
+        k = 200                     # size parameter of the sketch; rank error is about 1/k
+        
+    def open(self):
+        self.acc = QuantileSketch(self.k)
+    
+    def quantiles(self):
+        return self.acc.quantile(self.q)
+    
+    def report(self):
+        header = "quantiles %s:    " % ', '.join(str(q) for q in self.q)
+        if self.title: header = self.title + ' ' + header
+        values = self.quantiles()
+        print(header + (', '.join("%.4g" % v for v in values) if values is not None else "None"), file = self.out)
+
+
+class Histogram(Metric):
+    """Calculates histogram of values measured for individual items by a given metric, in fixed bins (math.Histogram):
+    given by their `edges`, or by the no. of `bins` over a `range`.
+    >>> PIPE >> [0.1, 0.3, 0.35, 2] >> Histogram(fun = float, bins = 2, range = (0, 1)) >> RUN
+    histogram [0, 0.5, 1] (under, over):    3, 0 (0, 1)
+    """
+    class __knobs__:
+        title = None
+        edges = None
+        bins  = None
+        range = None
+        
+    def open(self):
+        self.acc = _Histogram(self.edges, self.bins, self.range)
+    
+    def report(self):
+        acc = self.acc
+        header = "histogram [%s] (under, over):    " % ', '.join("%.4g" % e for e in acc.edges)
+        if self.title: header = self.title + ' ' + header
+        counts = ', '.join("%.4g" % c for c in acc.counts)
+        print(header + "%s (%.4g, %.4g)" % (counts, acc.under, acc.over), file = self.out)
     
 
 # class Experiment(Monitor):
@@ -1720,6 +1801,34 @@ class List(Pipe):
             self.items.append(item)
         yield self.items
 
+class ToNamedArray(Pipe):
+    """
+    Combines all input rows into a 2D namedarray with given column `names`. At the end, this array is output
+    as the only output item; it's also directly available as self.array property.
+    If `batch` is True, input items are batches of rows (2D arrays or lists of rows) rather than individual rows.
+    Rows are written directly to a geometrically growing buffer (math.Stack), which is trimmed once at the end,
+    so no intermediate list of rows nor DataFrame is created.
+    >>> PIPE >> [[1,2],[3,4],[5,6]] >> ToNamedArray(['x','y']) >> Function(lambda A: A.y) >> Print >> RUN
+    [2. 4. 6.]
+    """
+    class __knobs__:
+        names = None        # list of column names
+        dtype = float
+        batch = False       # if True, input items are batches of rows rather than individual rows
+        size  = None        # initial capacity of the buffer, in rows
+    
+    array = None
+    
+    def iter(self):
+        stack = Stack((len(self.names),), dtype = self.dtype, size = self.size)
+        self.count = 0
+        for item in self.source:
+            self.count += 1
+            if self.batch: stack.append_all(item)
+            else: stack.append(item)
+        self.array = namedarray(stack.trim(), names = list(self.names))
+        yield self.array
+
         
 #####################################################################################################################################################
 ###
@@ -12,7 +12,7 @@ You should have received a copy of the GNU General Public License along with Nif
 '''
 
 from __future__ import absolute_import
-import random, bisect, json, copy, numbers, math, numpy as np
+import os, random, bisect, json, copy, numbers, math, threading, numpy as np
 import numpy.linalg as linalg
 from numpy import sum, mean, zeros, sqrt, pi, exp, isnan, isinf, arctan
 from collections import OrderedDict, namedtuple
@@ -108,38 +108,145 @@ class WeightedRandom(object):
         return self.vals[i]
 
 
+class AliasTable(object):
+    """
+    Walker's alias table (Vose's variant) for O(1) sampling of indices 0,1,...,k-1 with given (unscaled) probabilities.
+    Sampling of `n` values is fully vectorized: one uniform integer and one uniform float per value.
+    
+    >>> table = AliasTable([1, 3])
+    >>> round(table.sample(100000, np.random.default_rng(0)).mean(), 2)
+    0.75
+    """
+    def __init__(self, weights):
+        probs = np.asarray(weights, dtype = float)
+        k = len(probs)
+        scaled = probs * (k / probs.sum())
+        alias  = np.zeros(k, dtype = np.int64)
+        small  = [i for i in range(k) if scaled[i] < 1.0]
+        large  = [i for i in range(k) if scaled[i] >= 1.0]
+        
+        while small and large:
+            s, l = small.pop(), large.pop()
+            alias[s] = l
+            scaled[l] += scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        
+        for i in small + large: scaled[i] = 1.0             # leftovers, due to rounding errors
+        self.prob  = scaled
+        self.alias = alias
+    
+    def sample(self, n, rng):
+        "Draw `n` indices with numpy's Generator `rng`."
+        i = rng.integers(0, len(self.prob), n)
+        return np.where(rng.random(n) < self.prob[i], i, self.alias[i])
+
+
+def _asarray(values):
+    "Convert a list of sampled values to a numeric numpy array if all values are numbers, or to an object array otherwise."
+    if all(isinstance(v, numbers.Number) for v in values):
+        return np.array(values)
+    arr = np.empty(len(values), dtype = object)
+    for i, v in enumerate(values): arr[i] = v
+    return arr
+
+def _full(n, value):
+    "Array of `n` copies of `value`; an object array if `value` is not a number."
+    if isinstance(value, numbers.Number): return np.full(n, value)
+    arr = np.empty(n, dtype = object)
+    arr.fill(value)
+    return arr
+
+
 #####################################################################################################################################################
 
+_thread_rand = threading.local()
+
+def default_rand():
+    """
+    Fallback python Random generator, separate for every thread, so that threads never share (and race on) the same generator.
+    Used by Distribution and Randomized when no generator was set explicitly.
+    """
+    rand = getattr(_thread_rand, 'rand', None)
+    if rand is None:
+        rand = _thread_rand.rand = random.Random()
+    return rand
+
+def seed_streams(seed, n):
+    """
+    Derive `n` independent and reproducible random seeds - np.random.SeedSequence objects - from a root `seed`
+    (an int, a SeedSequence, or None for unpredictable entropy), for parallel workers: the streams of generators
+    seeded with different children don't overlap, and the same root seed always produces the same children.
+    """
+    root = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return root.spawn(n)
+
+def _python_random(seedseq):
+    "Create python's Random seeded deterministically from a SeedSequence."
+    return random.Random(int(seedseq.generate_state(1, np.uint64)[0]))
+
+
 class Distribution(object):
     "Base class for probability distributions."
     
     
     rand = None                         # Random generator to use in get_random() if `rand` argument is None
-    rand_default = random.Random()      # fallback Random instance to use in random() if both `rand` argument and self.rand are None
+    rand_default = None                 # fallback Random instance to use in random() if both `rand` argument and self.rand are None;
+                                        # if None, a thread-local default_rand() is used instead
+    rng  = None                         # numpy's Generator to use in sample() if `rng` argument is None
     
     def __init__(self, **common):
         self.set_rand(**common)
 
-    def set_rand(self, rand = None, seed = None, recursive = True, overwrite = False):
-        if seed is not None:
-            rand = random.Random(seed)
+    def set_rand(self, rand = None, seed = None, recursive = True, overwrite = False, rng = None):
+        """
+        Set the source of randomness for get_random() (python Random, `rand`) and sample() (numpy Generator, `rng`).
+        `seed` can be an int, which seeds both generators, or a np.random.SeedSequence, typically one of the streams
+        created with seed_streams() for parallel workers. With recursive=True, nested distributions inherit
+        the generators unless they have their own already (or `overwrite` is True).
+        """
+        if isinstance(seed, np.random.SeedSequence):
+            rand, rng = _python_random(seed), np.random.default_rng(seed)
+        elif seed is not None:
+            rand, rng = random.Random(seed), np.random.default_rng(seed)
+        if rng is not None:
+            self.rng = rng
         if rand is not None:
             self.rand = rand
-        else:
-            self.rand_default = random.Random()
         # print self, rand
 
     def _set_rand_recursive(self, items, overwrite):
         "To be used by subclasses that contain nested Distribution objects."
-        if not (overwrite or self.rand): return
+        if not (overwrite or self.rand or self.rng): return
         for item in items:
-            if isinstance(item, Distribution) and (overwrite or item.rand is None):
-                item.set_rand(self.rand, recursive = True, overwrite = overwrite)
+            if isinstance(item, Distribution) and (overwrite or (item.rand is None and item.rng is None)):
+                item.set_rand(self.rand, recursive = True, overwrite = overwrite, rng = self.rng)
         
     def _fix_rand(self, rand = None):
-        fixed_rand = rand or self.rand or self.rand_default
+        fixed_rand = rand or self.rand or self.rand_default or default_rand()
         assert fixed_rand is not None
         return fixed_rand
+    
+    def spawn(self, n, seed = None):
+        """
+        Create `n` deep copies of this distribution for parallel workers (threads or processes), each one seeded,
+        recursively, with an independent stream derived from the root `seed` through seed_streams().
+        With the same root seed, every worker generates the same values on every run, no matter how many
+        workers are running at the same time, or in what order.
+        
+        >>> dist = Choice([Interval(0, 1), Range(5, 9)])
+        >>> workers = dist.spawn(4, seed = 123)
+        >>> again = dist.spawn(4, seed = 123)
+        >>> [w.get_random() for w in workers] == [w.get_random() for w in again]
+        True
+        >>> np.array_equal(workers[2].sample(10), again[2].sample(10)), np.array_equal(workers[0].sample(10), workers[1].sample(10))
+        (True, False)
+        """
+        copies = []
+        for stream in seed_streams(seed, n):
+            dist = self.copy()
+            dist.set_rand(seed = stream, recursive = True, overwrite = True)
+            copies.append(dist)
+        return copies
 
     def _get_random_value(self, rand):
         """
@@ -165,6 +272,26 @@ class Distribution(object):
         while True:
             yield self._get_random_value(rand)
     
+    def sample(self, n, rng = None):
+        """
+        Draw `n` items from the distribution at once and return as a numpy array: numeric if all items are numbers,
+        or an object array otherwise. Items follow the same distribution as in get_random(),
+        but are generated in a vectorized way, with numpy's Generator `rng` as a source of randomness
+        (a Generator instance, a seed, or None for a fresh unpredictable Generator).
+        In subclasses, override _sample() instead of this method.
+        """
+        return self._sample(n, np.random.default_rng(rng if rng is not None else self.rng))
+        
+    def _sample(self, n, rng):
+        """
+        Vectorized counterpart of _get_random_value(). Override in subclasses. The default implementation
+        falls back on calling _get_random_value() `n` times with a python Random seeded from `rng`.
+        """
+        if type(self)._get_random_value is Distribution._get_random_value:
+            return rng.random(n)
+        rand = random.Random(int(rng.integers(2**63)))
+        return _asarray([self._get_random_value(rand) for _ in range(n)])
+    
     # Distribution instances are callable, which provides a shorthand for get_random():
     #   distribution() is equiv. to distribution.get_random()
     #
@@ -186,6 +313,9 @@ class Fixed(Distribution):
     def _get_random_value(self, rand):
         return self.value
 
+    def _sample(self, n, rng):
+        return _full(n, self.value)
+    
     
 class Interval(Distribution):
     """Uniform distribution over [start,stop) or [start,stop] interval, depending on rounding, like in random.uniform().
@@ -207,6 +337,13 @@ class Interval(Distribution):
             return self.cast(val)
         return val
     
+    def _sample(self, n, rng):
+        if self.stop in (None, self.start): return _full(n, self.start)
+        vals = rng.uniform(self.start, self.stop, n)
+        if self.cast in (None, float): return vals
+        if self.cast is int: return vals.astype(np.int64)              # truncation towards zero, like int()
+        return _asarray([self.cast(v) for v in vals.tolist()])
+    
     
 class Range(Distribution):
     """Uniform distribution over integral numbers in [start,stop] range, including both endpoints, like in random.randint().
@@ -222,11 +359,22 @@ class Range(Distribution):
         if self.stop in (None, self.start): return self.start
         return rand.randint(self.start, self.stop)
     
+    def _sample(self, n, rng):
+        if self.stop in (None, self.start): return _full(n, self.start)
+        return rng.integers(self.start, self.stop, n, endpoint = True)
+    
     
 class Choice(Distribution):
     """Discrete probability distribution over a fixed set of possible outcomes (choices).
        In random(), if a chosen value is an instance of Distribution, a subsequent choice from this distribution is performed,
        which allows nesting of distributions and building composite ones.
+       
+       >>> choice = Choice(OrderedDict([('a', 0.2), ('b', 0.3), (Range(1, 4), 0.5)]))
+       >>> x = choice.sample(100000, rng = 0)
+       >>> x.dtype, round((x == 'a').mean(), 2), round((x == 'b').mean(), 2), sorted(set(x) - {'a', 'b'})
+       (dtype('O'), 0.2, 0.3, [1, 2, 3, 4])
+       >>> Choice([1.5, 2, Interval(5, 6)]).sample(4, rng = 0).dtype
+       dtype('float64')
     """
     
     choices = None      # list of possible outcomes (values) to choose from
@@ -266,15 +414,15 @@ class Choice(Distribution):
         # `choices` collection has no predefined ordering? must sort `outcomes` explicitly,
         # but first ensure all values are reliably (deterministically) sortable...
         for v in outcomes:
-            if not isinstance(v, (basestring, list, tuple, numbers.Number)):
+            if not (isstring(v) or isinstance(v, (list, tuple, numbers.Number))):
                 raise Exception('Unsortable choice value, must be a number/string/list/tuple: %s' % v)
         
         return sorted(outcomes)
     
         
-    def set_rand(self, rand = None, seed = None, recursive = True, overwrite = False):
+    def set_rand(self, rand = None, seed = None, recursive = True, overwrite = False, rng = None):
         
-        super(Choice, self).set_rand(rand, seed, recursive, overwrite)
+        super(Choice, self).set_rand(rand, seed, recursive, overwrite, rng)
         if recursive:
             self._set_rand_recursive(self.choices, overwrite)
         
@@ -292,6 +440,31 @@ class Choice(Distribution):
             val = val.get_random(rand)
         
         return val
+    
+    def _sample(self, n, rng):
+        """
+        Indices of choices are drawn with an alias table (built once, on the first call), then nested distributions
+        are sampled in bulk, one call per distribution, for all positions where this distribution was chosen.
+        """
+        if self.probs is None:
+            index = rng.integers(0, len(self.choices), n)
+        else:
+            if getattr(self, '_alias', None) is None: self._alias = AliasTable(self.probs)
+            index = self._alias.sample(n, rng)
+        
+        if not any(self.is_dist):
+            return _asarray(self.choices)[index]
+        
+        out = np.empty(n, dtype = object)
+        numeric = True
+        for i, val in enumerate(self.choices):
+            pos = np.flatnonzero(index == i)
+            if not len(pos): continue
+            vals = val.sample(len(pos), rng) if self.is_dist[i] else _full(len(pos), val)
+            numeric = numeric and vals.dtype != object
+            out[pos] = vals
+        
+        return np.array(out.tolist()) if numeric and n else out
             
     
 class Switch(Choice):
@@ -349,9 +522,9 @@ class RandomInstance(Distribution):
 
         super(RandomInstance, self).__init__(**common)
         
-    def set_rand(self, rand = None, seed = None, recursive = True, overwrite = False):
+    def set_rand(self, rand = None, seed = None, recursive = True, overwrite = False, rng = None):
         
-        super(RandomInstance, self).set_rand(rand, seed, recursive, overwrite)
+        super(RandomInstance, self).set_rand(rand, seed, recursive, overwrite, rng)
         
         # walk through attributes of `self` and for every instance of Distribution initialize its `rand` if missing, or if `overwrite`=True
         if recursive:
@@ -376,6 +549,31 @@ class RandomInstance(Distribution):
         self.postprocess(obj, self._fix_rand(rand))
         return obj
     
+    def sample_columns(self, n, rng = None):
+        """
+        Draw values of all random attributes for `n` instances at once, without creating the instances.
+        Returns a dict of {attribute: array of `n` values}. Every column is sampled in bulk with the attribute's sample().
+        """
+        rng = np.random.default_rng(rng if rng is not None else self.rng)
+        return OrderedDict((attr, distr.sample(n, rng)) for attr, distr in
+                           ((attr, getattr(self, attr, None)) for attr in self.attributes) if isinstance(distr, Distribution))
+    
+    def _sample(self, n, rng):
+        "Create `n` instances from attribute columns sampled in bulk. Returns an object array."
+        assert self.class_type is not None
+        columns = self.sample_columns(n, rng)
+        rand = random.Random(int(rng.integers(2**63)))          # postprocess() expects a python Random
+        
+        out = np.empty(n, dtype = object)
+        values = [col.tolist() for col in columns.values()]
+        for i, row in enumerate(zip(*values) if values else [()] * n):
+            obj = self.class_type()
+            for attr, val in zip(columns, row):
+                setattr(obj, attr, val)
+            self.postprocess(obj, rand)
+            out[i] = obj
+        return out
+    
     def postprocess(self, obj, rand):
         """Override in sublasses to perform additional post-processing of an object generated by random().
            `rand` is a Random generator that is guaranteed to be not-None and should be used instead of self.rand.
@@ -396,7 +594,8 @@ class Randomized(object):
     """
 
     _rand = None                        # Random generator to use in get_random() if `rand` argument is None
-    _rand_default = random.Random()     # fallback Random instance to use in random() if both `rand` argument and self.rand are None
+    _rand_default = None                # fallback Random instance to use in random() if both `rand` argument and self.rand are None;
+                                        # if None, a thread-local default_rand() is used instead
     
 
     @classmethod
@@ -454,7 +653,7 @@ class Randomized(object):
 
     @classmethod
     def _fix_rand(cls, rand = None):
-        fixed_rand = rand or cls._rand or cls._rand_default
+        fixed_rand = rand or cls._rand or cls._rand_default or default_rand()
         assert fixed_rand is not None
         return fixed_rand
 
@@ -710,6 +909,43 @@ class MinMax(object):
         "0-based index in the stream of the 1st maximum value seen so far."
         return self.curr_max[0]
     
+    def add_many(self, values, args = None):
+        """
+        Add a batch of numeric values (a 1D array or a list), with optional `args` of the same length, in one vectorized step.
+        >>> mm = MinMax([3, 1, 2])
+        >>> mm.add_many(np.array([5, 0, 5, 0]), args = ['a', 'b', 'c', 'd'])
+        >>> mm.min(), mm.argmin(), mm.max(), mm.argmax(), mm.idxmax()
+        (0, 'b', 5, 'a', 3)
+        """
+        values = np.asarray(values)
+        if not len(values): return
+        imin, imax = values.argmin(), values.argmax()
+        arg = lambda i: args[i] if args is not None else None
+        
+        cmin = self.curr_min[2]
+        if cmin is None or values[imin] < cmin:
+            self.curr_min = (self.count + imin, arg(imin), values[imin])
+        
+        cmax = self.curr_max[2]
+        if cmax is None or values[imax] > cmax:
+            self.curr_max = (self.count + imax, arg(imax), values[imax])
+        
+        self.count += len(values)
+    
+    def merge(self, other):
+        """
+        Combine with another MinMax, typically one that monitored a different part of the data in a parallel worker.
+        The `other` stream is treated as a continuation of `self`: its indices are shifted by self.count,
+        and on ties, the items of `self` win. Returns self.
+        """
+        omin, omax = other.curr_min, other.curr_max
+        if omin[2] is not None and (self.curr_min[2] is None or omin[2] < self.curr_min[2]):
+            self.curr_min = (self.count + omin[0], omin[1], omin[2])
+        if omax[2] is not None and (self.curr_max[2] is None or omax[2] > self.curr_max[2]):
+            self.curr_max = (self.count + omax[0], omax[1], omax[2])
+        self.count += other.count
+        return self
+    
 
 class Accumulator(object):
     """Weighted sequence of values (scalars or numpy arrays) where new items are added incrementally
@@ -736,6 +972,257 @@ class Accumulator(object):
         "Weighted mean of all the items added so far."
         return self.total / self.dtype(self.weight)
     
+    def merge(self, other):
+        "Add all the items accumulated in `other` Accumulator. Returns self."
+        self.total += other.total
+        self.weight += other.weight
+        return self
+    
+
+class Moments(object):
+    """
+    Count, mean and variance of a stream of numbers, or element-wise of a stream of numpy arrays,
+    computed incrementally without storing the items. Single values are added with Welford's update
+    and batches with Chan's pairwise formula, which is also used in merge() to combine partial results
+    computed in parallel. Both are numerically stable, unlike the naive sum(x^2) - sum(x)^2/N.
+    
+    >>> a, b = Moments(), Moments()
+    >>> for x in [1e9 + 1, 1e9 + 2, 1e9 + 3]: a.add(x)
+    >>> b.add_many(np.array([1e9 + 4, 1e9 + 5]))
+    >>> m = a.merge(b)
+    >>> m.count, m.mean() - 1e9, m.var()
+    (5, 3.0, 2.5)
+    >>> m = Moments(); m.add_many(np.arange(12.).reshape(4,3)); m.mean()
+    array([4.5, 5.5, 6.5])
+    """
+    count = 0               # no. of items added so far
+    _mean = 0.0             # current mean of the items
+    _m2   = 0.0             # current sum of squared differences from the mean
+    
+    def __init__(self, values = None):
+        if values is not None: self.add_many(values)
+    
+    def add(self, value):
+        self.count += 1
+        delta = value - self._mean
+        self._mean = self._mean + delta / self.count
+        self._m2 = self._m2 + delta * (value - self._mean)
+    
+    def add_many(self, values):
+        "Add a batch of items: an array or a list of numbers, or of equally-shaped arrays stacked along axis 0."
+        values = np.asarray(values, dtype = float)
+        if not len(values): return
+        mean = values.mean(axis = 0)
+        self._combine(len(values), mean, ((values - mean) ** 2).sum(axis = 0))
+    
+    def merge(self, other):
+        "Combine with another Moments, typically one computed in a parallel worker on a different part of the data. Returns self."
+        self._combine(other.count, other._mean, other._m2)
+        return self
+    
+    def _combine(self, count, mean, m2):
+        if not count: return
+        total = self.count + count
+        delta = mean - self._mean
+        self._mean = self._mean + delta * (count / float(total))
+        self._m2 = self._m2 + m2 + delta ** 2 * (self.count * count / float(total))
+        self.count = total
+    
+    def mean(self):
+        if self.count <= 0: return None
+        return self._mean
+    
+    def var(self, ddof = 1):
+        "Sample variance (ddof=1) or population variance (ddof=0); None if there are too few items."
+        if self.count <= ddof: return None
+        return self._m2 / float(self.count - ddof)
+    
+    def std(self, ddof = 1):
+        var = self.var(ddof)
+        return None if var is None else np.sqrt(var)
+    
+
+class QuantileSketch(object):
+    """
+    Approximate quantiles of a stream of numbers in O(k log(n/k)) memory, with a KLL sketch (Karnin, Lang & Liberty, 2016):
+    a hierarchy of compactors, where level h keeps sample items of weight 2^h and its capacity shrinks
+    geometrically (by 2/3) with the distance from the top level. When a level overflows, it's sorted and every other item,
+    starting at a random offset, is promoted to the next level. Rank error is about O(1/k) of the stream size.
+    Sketches with the same `k` can be merged, so quantiles of a large dataset can be computed in parallel workers.
+    
+    >>> a, b = QuantileSketch(seed = 1), QuantileSketch(seed = 2)
+    >>> a.add_many(np.arange(50000)); b.add_many(np.arange(50000, 100000))
+    >>> q = a.merge(b).quantile([0.1, 0.5, 0.9])
+    >>> a.count, np.abs(q - [10000, 50000, 90000]).max() < 2000
+    (100000, True)
+    """
+    def __init__(self, k = 200, seed = None):
+        self.k = k
+        self.count = 0
+        self.levels = [np.empty(0)]         # levels[h] holds items of weight 2^h
+        self._buffer = []                   # single items added with add(), not yet moved to levels[0]
+        self._rng = np.random.default_rng(seed)
+    
+    def add(self, value):
+        self._buffer.append(value)
+        self.count += 1
+        if len(self._buffer) >= self.k: self._flush()
+    
+    def add_many(self, values):
+        values = np.asarray(values, dtype = float).ravel()
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+    
+    def merge(self, other):
+        "Combine with another sketch of the same `k`. Returns self."
+        if other.k != self.k: raise Exception("QuantileSketch.merge(): can't merge sketches with different k (%s, %s)" % (self.k, other.k))
+        self._flush()
+        while len(self.levels) < len(other.levels): self.levels.append(np.empty(0))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.levels[0] = np.concatenate([self.levels[0], np.asarray(other._buffer, dtype = float)])
+        self.count += other.count
+        self._compress()
+        return self
+    
+    def _flush(self):
+        if not self._buffer: return
+        self.levels[0] = np.concatenate([self.levels[0], np.asarray(self._buffer, dtype = float)])
+        self._buffer = []
+        self._compress()
+    
+    def _capacity(self, h):
+        return max(2, int(self.k * (2/3.) ** (len(self.levels) - 1 - h)))
+    
+    def _compress(self):
+        h = 0
+        while h < len(self.levels):
+            items = self.levels[h]
+            if len(items) > self._capacity(h):
+                items = np.sort(items)
+                keep = items[-1:] if len(items) % 2 else items[:0]          # odd item stays at this level
+                items = items[:len(items) - len(keep)]
+                if h + 1 == len(self.levels): self.levels.append(np.empty(0))
+                self.levels[h] = keep
+                self.levels[h+1] = np.concatenate([self.levels[h+1], items[self._rng.integers(2)::2]])
+            h += 1
+    
+    def quantile(self, q):
+        "Approximate q-th quantile(s), for q in [0,1] (scalar or array), of all the items added so far; None if there are no items."
+        self._flush()
+        if not self.count: return None
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2 ** h) for h, items in enumerate(self.levels)])
+        order = np.argsort(items, kind = 'stable')
+        items, cumw = items[order], np.cumsum(weights[order])
+        idx = np.searchsorted(cumw, np.asarray(q) * cumw[-1], side = 'left')
+        return items[np.minimum(idx, len(items) - 1)]
+    
+
+class Histogram(object):
+    """
+    Counts of a stream of numbers in fixed bins, defined by their `edges` (increasing), or by the no. of `bins`
+    of equal width over a `range` (lo, hi). Like in np.histogram, bins are half-open [a, b) except for the last one,
+    which includes the right edge. Values outside the edges are counted in `under` and `over`; NaNs are ignored.
+    Histograms with the same edges can be merged.
+    
+    >>> h = Histogram(bins = 4, range = (0, 4))
+    >>> h.add(0.5); h.add_many([1, 3.5, 4, 7, -1, np.nan], weights = [1, 1, 1, 1, 1, 1])
+    >>> g = Histogram([0, 1, 2, 3, 4]); g.add(1.5)
+    >>> h.merge(g).counts.tolist(), h.under, h.over
+    ([1.0, 2.0, 0.0, 2.0], 1.0, 1.0)
+    """
+    def __init__(self, edges = None, bins = None, range = None):
+        if edges is None:
+            if bins is None or range is None: raise Exception("Histogram: either `edges` or both `bins` and `range` must be given")
+            edges = np.linspace(range[0], range[1], bins + 1)
+        self.edges = np.asarray(edges, dtype = float)
+        self.counts = np.zeros(len(self.edges) - 1)
+        self.under = self.over = 0.0
+    
+    def add(self, value, weight = 1):
+        edges = self.edges
+        if value < edges[0]: self.under += weight
+        elif value > edges[-1]: self.over += weight
+        elif value == value:                                            # not NaN
+            self.counts[min(bisect.bisect_right(edges, value), len(edges) - 1) - 1] += weight
+    
+    def add_many(self, values, weights = None):
+        "Add a batch of values with optional weights."
+        values = np.asarray(values, dtype = float).ravel()
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype = float).ravel()
+        edges = self.edges
+        bins = np.minimum(np.searchsorted(edges, values, side = 'right'), len(edges) - 1) - 1
+        inside = (values >= edges[0]) & (values <= edges[-1])
+        self.counts += np.bincount(bins[inside], weights[inside], minlength = len(self.counts))
+        self.under += weights[values < edges[0]].sum()
+        self.over  += weights[values > edges[-1]].sum()
+    
+    def merge(self, other):
+        "Combine with another Histogram of the same edges. Returns self."
+        if not np.array_equal(self.edges, other.edges): raise Exception("Histogram.merge(): can't merge histograms with different bin edges")
+        self.counts += other.counts
+        self.under += other.under
+        self.over += other.over
+        return self
+    
+    def total(self):
+        "Total weight of all the values added so far, including outliers."
+        return self.counts.sum() + self.under + self.over
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of a stream of keys in fixed memory (Cormode & Muthukrishnan, 2005): a (depth x width) table
+    of counters, each key is counted in one counter per row, chosen by a row-specific hash of the key;
+    the estimated count of a key is the minimum of its counters. Estimates never undercount, and overcount
+    by at most 2*total/width with probability 1 - 2^-depth. Keys are non-negative integers (typically 64-bit hashes
+    of the actual keys); `width` is rounded up to a power of 2. Sketches with the same shape and seed can be merged.
+
+    >>> a, b = CountMinSketch(1024, seed = 5), CountMinSketch(1024, seed = 5)
+    >>> a.add_many([1, 2, 2, 3, 3, 3]); b.add(3, 7); b.add_many([10**15], [4])
+    >>> a.merge(b).estimate([1, 2, 3, 10**15, 4]).tolist(), a.total
+    ([1, 2, 10, 4, 0], 17)
+    """
+    def __init__(self, width = 2**20, depth = 4, seed = 0):
+        self.bits = max(1, int(np.ceil(np.log2(width))))
+        self.width, self.depth, self.seed = 2 ** self.bits, depth, seed
+        self.table = np.zeros((depth, self.width), dtype = np.int64)
+        self.total = 0
+        salts = np.random.default_rng(seed).integers(1, 2**63, size = (2, depth), dtype = np.int64).astype(np.uint64)
+        self._mul, self._add = salts[0] | np.uint64(1), salts[1]           # odd multipliers for multiply-shift hashing
+
+    def _index(self, keys, row):
+        return ((keys * self._mul[row] + self._add[row]) >> np.uint64(64 - self.bits)).astype(np.intp)
+
+    def add(self, key, count = 1):
+        self.add_many([key], [count])
+
+    def add_many(self, keys, counts = None):
+        "Add a batch of keys (array of non-negative integers) with optional counts, 1 by default."
+        keys = np.asarray(keys).astype(np.uint64).ravel()
+        counts = np.ones(len(keys), dtype = np.int64) if counts is None else np.asarray(counts, dtype = np.int64).ravel()
+        for row in range(self.depth):
+            np.add.at(self.table[row], self._index(keys, row), counts)
+        self.total += int(counts.sum())
+
+    def estimate(self, keys):
+        "Estimated counts (array) of given keys."
+        keys = np.asarray(keys).astype(np.uint64).ravel()
+        est = self.table[0][self._index(keys, 0)]
+        for row in range(1, self.depth):
+            est = np.minimum(est, self.table[row][self._index(keys, row)])
+        return est
+
+    def merge(self, other):
+        "Combine with another sketch of the same width, depth and seed. Returns self."
+        if (self.width, self.depth, self.seed) != (other.width, other.depth, other.seed):
+            raise Exception("CountMinSketch.merge(): can't merge sketches of different shape or seed")
+        self.table += other.table
+        self.total += other.total
+        return self
+
 
 class Accumulator2D(object):
     """A 2D+ numpy array, typically a large one, built incrementally
@@ -745,6 +1232,8 @@ class Accumulator2D(object):
     The resulting array is computed as a weighted average of all accumulated patches.
     """
     
+    LARGE_PATCH = 512           # min. no. of elements of a patch for add_many() to add patches one by one instead of scattering
+    
     def __init__(self, X, weight = 0.001, dtype = None):
         """
         'weight' of the initial fullsize patch X should be strictly positive
@@ -762,6 +1251,100 @@ class Accumulator2D(object):
         self.total[y : y + h, x : x + w, ...] += patch * weight
         self.count[y : y + h, x : x + w, ...] += weight
     
+    def add_many(self, xs, ys, patches, weights = 1.0, chunk = 1 << 22):
+        """
+        Add many equally-sized patches at once: patches[i], of shape (h, w, ...), is placed at position (xs[i], ys[i])
+        with weight weights[i]. `patches` is an array of shape (n, h, w, ...), `weights` is a scalar,
+        an array of shape (n,), or an array broadcastable to the shape of `patches`.
+        Unlike add(), patches may stick out of the array, in any direction: parts outside the borders are clipped.
+        Small patches are scatter-added all together with np.bincount, in chunks of at most `chunk` elements;
+        large ones (LARGE_PATCH elements or more), where slicing is as fast as scattering, are added one by one.
+        With one weight per patch, self.count is updated for all patches at once through a 2D difference array.
+        
+        >>> acc = Accumulator2D(np.zeros((3, 4)), weight = 0)
+        >>> acc.add_many([0, 2, -1], [0, 1, 2], np.ones((3, 2, 2)), weights = [1, 2, 1])
+        >>> acc.total
+        array([[1., 1., 0., 0.],
+               [1., 1., 2., 2.],
+               [1., 0., 2., 2.]])
+        """
+        patches = np.asarray(patches)
+        xs, ys = np.asarray(xs, dtype = np.int64), np.asarray(ys, dtype = np.int64)
+        n, h, w = patches.shape[:3]
+        H, W = self.total.shape[:2]
+        inner = self.total.shape[2:]
+        if patches.shape[3:] != inner:
+            raise Exception("Accumulator2D.add_many(): patches of shape %s don't match the array of shape %s" % (patches.shape[1:], self.total.shape))
+        if not n: return
+        
+        weights = np.asarray(weights, dtype = float)
+        scalar = weights.ndim == 0 or (weights.ndim == 1 and patches.ndim > 1 and len(weights) == n)      # one weight per patch?
+        if scalar:
+            weights = np.broadcast_to(weights, (n,))
+            self._add_boxes(xs, ys, h, w, weights)
+            weights = weights.reshape((n,) + (1,) * (patches.ndim - 1))
+        
+        C = int(np.prod(inner))
+        if h * w * C >= self.LARGE_PATCH:
+            return self._add_slices(xs, ys, patches, weights, scalar)
+        
+        offsets = (np.arange(h)[:, None] * W + np.arange(w)).reshape(-1)                 # flat offsets of patch cells relative to its corner
+        if C > 1: offsets = (offsets[:, None] * C + np.arange(C)).reshape(-1)
+        total, count = self.total.reshape(-1), self.count.reshape(-1)
+        step = max(1, chunk // max(1, h * w * C))
+        
+        for start in range(0, n, step):
+            x, y = xs[start:start+step], ys[start:start+step]
+            wgt = np.broadcast_to(weights[start:start+step], (len(x),) + patches.shape[1:])
+            val = patches[start:start+step] * wgt
+            
+            if x.min() >= 0 and y.min() >= 0 and x.max() + w <= W and y.max() + h <= H:
+                idx = ((y * W + x) * C)[:, None] + offsets                              # all patches inside: no clipping needed
+                val, wgt = val.reshape(-1), wgt.reshape(-1)
+            else:
+                R = y[:, None] + np.arange(h)
+                K = x[:, None] + np.arange(w)
+                valid = ((R >= 0) & (R < H))[:, :, None] & ((K >= 0) & (K < W))[:, None, :]
+                if not valid.any(): continue
+                idx = ((R[:, :, None] * W + K[:, None, :]) * C)[valid]
+                if C > 1: idx = idx[:, None] + np.arange(C)
+                val, wgt = val[valid].reshape(-1), wgt[valid].reshape(-1)
+            
+            idx = idx.reshape(-1)
+            lo = idx.min()
+            idx -= lo
+            size = idx.max() + 1
+            total[lo : lo + size] += np.bincount(idx, val, minlength = size)
+            if not scalar:
+                count[lo : lo + size] += np.bincount(idx, wgt, minlength = size)
+    
+    def _add_slices(self, xs, ys, patches, weights, scalar):
+        "Add large patches one by one through slicing, with clipping coordinates calculated for all patches in bulk."
+        n, h, w = patches.shape[:3]
+        H, W = self.total.shape[:2]
+        x0, y0 = np.clip(xs, 0, W), np.clip(ys, 0, H)
+        x1, y1 = np.clip(xs + w, 0, W), np.clip(ys + h, 0, H)
+        px0, py0 = x0 - xs, y0 - ys
+        px1, py1 = px0 + x1 - x0, py0 + y1 - y0
+        total, count = self.total, self.count
+        if not scalar: weights = np.broadcast_to(weights, patches.shape)
+        for i in np.flatnonzero((x1 > x0) & (y1 > y0)).tolist():
+            patch = patches[i, py0[i]:py1[i], px0[i]:px1[i]]
+            weight = weights[i] if scalar else weights[i, py0[i]:py1[i], px0[i]:px1[i]]
+            total[y0[i]:y1[i], x0[i]:x1[i]] += patch * weight
+            if not scalar: count[y0[i]:y1[i], x0[i]:x1[i]] += weight
+    
+    def _add_boxes(self, xs, ys, h, w, weights):
+        "Add weights[i] to self.count in boxes of size (h, w) at (xs[i], ys[i]), clipped, through a 2D difference array."
+        H, W = self.count.shape[:2]
+        x0, y0 = np.clip(xs, 0, W), np.clip(ys, 0, H)
+        x1, y1 = np.clip(xs + w, 0, W), np.clip(ys + h, 0, H)
+        diff = np.zeros((H + 1) * (W + 1))
+        for yy, xx, sign in [(y0, x0, 1), (y0, x1, -1), (y1, x0, -1), (y1, x1, 1)]:
+            diff += np.bincount(yy * (W + 1) + xx, sign * weights, minlength = len(diff))
+        boxes = diff.reshape(H + 1, W + 1).cumsum(0).cumsum(1)[:H, :W]
+        self.count += boxes.reshape((H, W) + (1,) * (self.count.ndim - 2))
+    
     def mean(self):
         return self.total / self.count
     
@@ -795,6 +1378,10 @@ class Stack(object):
     >>> for _ in range(100): stack.append([10,10,10])
     >>> stack.get().sum()
     3024.0
+    >>> X = stack.trim()
+    >>> stack.append([0,0,0])                   # goes to a new buffer, `X` stays valid
+    >>> X.shape, float(X.sum()), len(stack)
+    ((102, 3), 3024.0, 103)
     """
     
     GROWTH_RATE = 1.5       # `data` array can be at most 50% larger than the actual data stored in it
@@ -802,6 +1389,7 @@ class Stack(object):
     data = None             # the preallocated greater array; new items are added along the 1st dimension
     size = None             # the current no. of items in `data`
     maxsize = None          # maximum `size` allowed in this Stack object
+    trimmed = False         # True if `data` was returned by trim(), so it must not be resized nor overwritten anymore
 
     def __init__(self, shape = (), dtype = float, like = None, init = None, size = None, maxsize = None):
         if init is not None:
@@ -855,6 +1443,11 @@ class Stack(object):
         assert new_size >= requested >= data.shape[0]
         
         extended = (new_size,) + data.shape[1:]
+        if self.trimmed:                                            # the caller owns `data` now, copy to a new buffer
+            self.data = np.zeros(extended, data.dtype)
+            self.data[:size,...] = data[:size,...]
+            self.trimmed = False
+            return
         newdata  = self.data.resize(extended, refcheck = False)     # resize() may work in place (with a standard np.array) or return a new array (with a derived array type)
         if newdata is not None:
             self.data = newdata
@@ -887,13 +1480,261 @@ class Stack(object):
     def clear(self):
         """Remove all items but keep the shape and dtype unchanged."""
         self.size = 0
+        if self.trimmed:
+            self.data = np.zeros_like(self.data)
+            self.trimmed = False
+    
+    def trim(self):
+        """
+        Shrink the underlying array to the actual no. of items (drop the preallocated empty space) and return it.
+        Typically called once, after the last item was added, to obtain the final array without making a copy.
+        Items can still be appended afterwards: they go to a new buffer, so the returned array is never modified nor reallocated.
+        """
+        if self.size < self.data.shape[0]:
+            trimmed = (self.size,) + self.data.shape[1:]
+            newdata = self.data.resize(trimmed, refcheck = False)
+            if newdata is not None:
+                self.data = newdata
+        self.trimmed = True
+        return self.data
+    
+
+class MappedStack(Stack):
+    """
+    A Stack backed by a memory-mapped file on disk instead of RAM, for accumulation of data that don't fit in memory.
+    The file grows by extending its length and remapping, so the existing data are never copied, unlike in Stack.
+    get() returns a memmap view of the file. The file contains raw items, without a header; the dtype, shape and no. of items
+    are saved in a small JSON file next to it (<path>.json) upon flush(), so that the stack can be reopened later
+    in 'r+' (continue appending) or 'r' (read-only) mode.
+    
+    >>> import tempfile, os
+    >>> path = os.path.join(tempfile.mkdtemp(), 'stack.bin')
+    >>> stack = MappedStack(path, (3,), size = 2)
+    >>> for i in range(5): stack.append([i, i, i])
+    >>> stack.get().sum(), len(stack), stack.data.shape[0] >= 5
+    (30.0, 5, True)
+    >>> stack.flush()
+    >>> stack = MappedStack(path, mode = 'r+')
+    >>> stack.append_all([[9, 9, 9]] * 2)
+    >>> stack.get()[-3:,0], [len(chunk) for chunk in stack.chunks(3)]
+    (memmap([4., 9., 9.]), [3, 3, 1])
+    """
+    
+    path = None             # path to the data file
+    mode = None             # mode of opening the file: 'w+' (create or overwrite), 'r+' (open existing for appending), 'r' (read-only)
+    
+    def __init__(self, path, shape = (), dtype = float, size = None, maxsize = None, mode = 'w+'):
+        self.path = path
+        self.mode = mode
+        self.maxsize = maxsize
+        
+        if mode == 'w+':
+            if isnumber(shape): shape = (shape,)
+            self.shape, self.dtype, self.size = tuple(shape), np.dtype(dtype), 0
+            initsize = size or 10
+            if maxsize: initsize = min(initsize, maxsize)
+            with open(path, 'wb'): pass
+        else:
+            with open(path + '.json', 'rt') as f:
+                meta = json.load(f)
+            self.shape = tuple(meta['shape'])
+            self.dtype = np.lib.format.descr_to_dtype(meta['dtype'])
+            self.size  = meta['size']
+            initsize   = max(self.size, 1)
+        
+        self._map(initsize)
+    
+    def _map(self, rows):
+        "Set the length of the file to `rows` items, if needed, and (re)map it to self.data."
+        itemsize = self.dtype.itemsize * int(np.prod(self.shape))
+        if self.mode != 'r':
+            with open(self.path, 'r+b') as f:
+                f.truncate(rows * itemsize)
+        self.data = np.memmap(self.path, dtype = self.dtype, mode = self.mode if self.mode != 'w+' else 'r+', shape = (rows,) + self.shape)
+    
+    def _resize(self, extend = 1):
+        
+        size, requested = self.size, self.size + extend
+        new_size = max(requested, int(math.ceil(self.data.shape[0] * self.GROWTH_RATE)))
+        
+        if self.maxsize:
+            new_size = min(new_size, self.maxsize)
+            if new_size < requested: raise Exception("Can't resize the Stack beyond its maximum size (%s)" % self.maxsize)
+        
+        self._map(new_size)
+    
+    def trim(self):
+        "Truncate the file to the actual no. of items and return the (remapped) data array."
+        if self.size < self.data.shape[0]:
+            self.data.flush()
+            self._map(max(self.size, 1))
+        return self.data[:self.size]
+        
+    def chunks(self, size = 65536):
+        "Iterate over the items in consecutive chunks (memmap views) of `size` items each, for out-of-core processing."
+        for start in range(0, self.size, size):
+            yield self.data[start : min(start + size, self.size)]
     
+    def flush(self):
+        "Write pending changes to disk and save metadata (dtype, shape, no. of items), so the stack can be reopened later."
+        if self.mode == 'r': return
+        self.data.flush()
+        meta = {'dtype': np.lib.format.dtype_to_descr(self.dtype), 'shape': list(self.shape), 'size': self.size}
+        with open(self.path + '.json', 'wt') as f:
+            json.dump(meta, f)
+
+
+class ConcurrentStack(object):
+    """
+    A Stack that can be appended to from multiple threads at the same time, without locking on append().
+    Every thread appends to its own private sub-stack, which is resized independently of the others
+    (always to a new buffer, so arrays being read by other threads are never reallocated under their feet).
+    get() merges all sub-stacks into one array; the merged result is cached until new items are appended.
+    Items appended by the same thread keep their relative order in the merged array; items of different threads
+    are placed in blocks, in the order of threads' first appends.
+    
+    >>> import threading
+    >>> stack = ConcurrentStack((2,), dtype = int)
+    >>> def produce(tid):
+    ...     for i in range(10000): stack.append([tid, i])
+    >>> threads = [threading.Thread(target = produce, args = (tid,)) for tid in range(8)]
+    >>> for t in threads: t.start()
+    >>> for t in threads: t.join()
+    >>> X = stack.get()
+    >>> len(X), len(stack), all((X[X[:,0] == tid, 1] == np.arange(10000)).all() for tid in range(8))
+    (80000, 80000, True)
+    """
+    
+    class _Substack(Stack):
+        "A Stack that allocates a new buffer on resize instead of reallocating in place, so that existing views stay valid."
+        def _resize(self, extend = 1):
+            data = self.data
+            new_size = max(self.size + extend, int(math.ceil(self.size * self.GROWTH_RATE)))
+            newdata = np.empty((new_size,) + data.shape[1:], dtype = data.dtype)
+            newdata[:self.size] = data[:self.size]
+            self.data = newdata
+    
+    def __init__(self, shape = (), dtype = float, size = None):
+        if isnumber(shape): shape = (shape,)
+        self.shape = shape
+        self.dtype = dtype
+        self.initsize = size
+        self._stacks = []                   # sub-stacks of all threads, in the order of creation
+        self._local  = threading.local()    # sub-stack of the current thread
+        self._lock   = threading.Lock()     # guards registration of new sub-stacks and merging in get()
+        self._merged = None                 # cached result of get(), together with the sizes of sub-stacks used to build it
+    
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = ConcurrentStack._Substack(self.shape, self.dtype, size = self.initsize)
+            with self._lock:
+                self._stacks.append(stack)
+        return stack
+        
+    def append(self, item):
+        try: stack = self._local.stack
+        except AttributeError: stack = self._stack()
+        stack.append(item)
+    
+    def append_all(self, items):
+        try: stack = self._local.stack
+        except AttributeError: stack = self._stack()
+        stack.append_all(items)
+    
+    def get(self):
+        "Merge items of all threads into one array. The returned array is a copy, it doesn't change with subsequent appends."
+        with self._lock:
+            parts = [stack.get() for stack in self._stacks]         # stack.get() is a consistent snapshot: size is incremented after the item is written
+            sizes = [len(part) for part in parts]
+            if self._merged is not None and self._merged[1] == sizes:
+                return self._merged[0]
+            
+            merged = np.concatenate(parts) if parts else np.zeros((0,) + self.shape, dtype = self.dtype)
+            self._merged = (merged, sizes)
+            return merged
+    
+    def __len__(self):
+        return sum([len(stack) for stack in list(self._stacks)])         # a list, not a generator: 'sum' is numpy's
+    
+    def clear(self):
+        with self._lock:
+            for stack in self._stacks: stack.clear()
+            self._merged = None
+
 
 #####################################################################################################################################################
 #####
 #####  NAMEDARRAY
 #####
 
+class colschema(object):
+    """
+    Immutable description of the columns of a namedarray: column `names` (a read-only numpy array of strings)
+    and `columns` ({name: index} dict). A schema is shared by reference between a namedarray and all its views
+    and derived arrays that keep the same columns, so slicing and ufuncs don't allocate any new names/dicts.
+    The schema also caches translations of index keys (column names) and schemas of column subsets,
+    which speeds up repeated column access in loops.
+    
+    >>> s = colschema(['x','y','z'])
+    >>> s.columns['y'], s.names.tolist()
+    (1, ['x', 'y', 'z'])
+    >>> s.subset(slice(1,None)).names.tolist(), s.subset(slice(1,None)) is s.subset(slice(1,None))
+    (['y', 'z'], True)
+    """
+    __slots__ = ('names', 'columns', '_keys', '_subsets')
+    
+    MAX_CACHE = 1000            # max. no. of entries in each of the caches; the cache is cleared when exceeded
+    
+    def __init__(self, names):
+        names = np.array(names)
+        names.flags.writeable = False
+        columns = {name: column for column, name in enumerate(names.tolist())}
+        if len(names) != len(columns): raise Exception("names of columns are not unique")
+        
+        object.__setattr__(self, 'names', names)
+        object.__setattr__(self, 'columns', columns)
+        object.__setattr__(self, '_keys', {})           # cache of decoded string keys: {(ndim, name): index key}
+        object.__setattr__(self, '_subsets', {})        # cache of sub-schemas: {column selector: colschema}
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("colschema is immutable")
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def decode(self, name, ndim, _full_slice = slice(None)):
+        "Translate a column name to a full index key (tuple) for an array of `ndim` dimensions. Cached."
+        key = self._keys.get((ndim, name))
+        if key is None:
+            key = (_full_slice,) * (ndim - 1) + (self.columns[name],)
+            if len(self._keys) >= self.MAX_CACHE: self._keys.clear()
+            self._keys[(ndim, name)] = key
+        return key
+    
+    def subset(self, column):
+        """
+        Schema of a subset of columns selected with `column` (slice, list of indices, boolean mask...).
+        Schemas for slices and lists of indices are cached, so repeated slicing returns the same object.
+        """
+        if isinstance(column, slice):
+            cachekey = (column.start, column.stop, column.step)
+        elif isinstance(column, list):
+            cachekey = tuple(column)
+        else:
+            return colschema(self.names[column])
+        
+        schema = self._subsets.get(cachekey)
+        if schema is None:
+            schema = colschema(self.names[column])
+            if len(self._subsets) >= self.MAX_CACHE: self._subsets.clear()
+            self._subsets[cachekey] = schema
+        return schema
+    
+    def __reduce__(self):
+        return (colschema, (self.names.tolist(),))
+        
+
 class namedarray(np.ndarray):
     """
     namedarray is a Numpy's ndarray that keeps its column names internally, similar to Pandas,
@@ -909,8 +1750,11 @@ class namedarray(np.ndarray):
     
     Being based on Numpy's ndarray, namedarray is restricted to a single data type (dtype)
     for all columns of the array, unlike Pandas' DataFrames where this restriction is not present.
-    If your application requires the use of different dtypes for columns, or some other advanced functionality
-    of Pandas (e.g., the groupby() method), Pandas' DataFrame may still be a better choice than namedarray.
+    If your application requires the use of different dtypes for columns, use namedtable instead,
+    which can be converted to/from namedarray without copying the data for homogeneous subsets of columns.
+    Basic relational operations are available through groupby().agg(), sort_by() and join().
+    For some other advanced functionality of Pandas (e.g., indexes, pivot tables),
+    Pandas' DataFrame may still be a better choice than namedarray.
     
     A namedarray has either 1 or 2 dimensions. A 1-dimensional namedarray is interpreted as a row vector.
     namedarray can be used with all Numpy's operators and methods, similar to a standard array (ndarray),
@@ -981,8 +1825,17 @@ class namedarray(np.ndarray):
     """
     pandas_compatible = True
     
-    names   = None         # column names, as a numpy array of strings to allow indexing by lists
-    columns = None         # dict of names and their column indices in the underlying numpy array: {name: column}
+    schema  = None         # colschema of the array, shared by reference with views that have the same columns; None if no names
+    
+    @property
+    def names(self):
+        "Column names, as a (read-only) numpy array of strings to allow indexing by lists."
+        return self.schema.names if self.schema is not None else None
+    
+    @property
+    def columns(self):
+        "Dict of names and their column indices in the underlying numpy array: {name: column}."
+        return self.schema.columns if self.schema is not None else None
     
     def __new__(cls, input_array, names = None, pandas_compatible = True):
         if input_array is NotImplemented: raise Exception("input_array is NotImplemented")
@@ -1002,19 +1855,93 @@ class namedarray(np.ndarray):
     def init_like(self, other, only_params = False):
         self.pandas_compatible = other.pandas_compatible
         if not only_params:
-            self._set_names(other.names, other.columns)
+            self._set_schema(other.schema)
         return self
     
-    def _set_names(self, names, columns = None):
+    def _set_names(self, names):
         if names is None: return
-        self.names = np.array(names)
-        self.columns = {name: column for column, name in enumerate(names)} if columns is None else columns
-        if len(names) != len(self.columns): raise Exception("names of columns are not unique")
-        if len(names) != self.shape[-1]: raise Exception("the no. of names is different than the no. of columns")
+        self._set_schema(colschema(names))
+        
+    def _set_schema(self, schema):
+        if schema is None: return
+        if len(schema) != self.shape[-1]: raise Exception("the no. of names is different than the no. of columns")
+        self.schema = schema
         
     @staticmethod
     def from_pandas(frame):
         return namedarray(frame.values, names = frame.columns.to_list())
+    
+    @staticmethod
+    def read_csv(path, names = None, delimiter = ',', header = True, dtype = float, usecols = None, block = 10000):
+        """
+        Load a namedarray from a CSV file of numeric values. The file is parsed in blocks of `block` lines
+        (with np.loadtxt), which are appended directly to a preallocated, geometrically growing buffer (Stack),
+        so peak memory usage stays close to the size of the final array. Quoted fields are not supported.
+        If `header` is True, the 1st line contains column names, which are used if `names` is None.
+        `usecols` is an optional list of column indices to be loaded.
+        """
+        from itertools import islice
+        
+        with open(path, 'rt') as f:
+            if header:
+                first = next(f, '').rstrip('\r\n').split(delimiter)
+                if names is None:
+                    names = [name.strip() for name in first]
+                    if usecols is not None: names = [names[i] for i in usecols]
+            
+            stack = None
+            while True:
+                lines = list(islice(f, block))
+                if not lines: break
+                rows = np.loadtxt(lines, delimiter = delimiter, dtype = dtype, usecols = usecols, ndmin = 2)
+                if stack is None:
+                    stack = Stack(rows.shape[1:], dtype = rows.dtype, size = len(rows))
+                stack.append_all(rows)
+                
+        if stack is None:
+            data = np.zeros((0, len(names) if names else 0), dtype = dtype)
+        else:
+            data = stack.trim()
+        return namedarray(data, names = names)
+    
+    def save(self, path):
+        """
+        Save the array to a standard .npy file at `path` (the extension is appended if missing, like in np.save()),
+        and its column schema to a small JSON file next to it: <path>.json.
+        The .npy file can be loaded with np.load() as a plain array, or with namedarray.load() including names,
+        possibly as a memory-mapped array that is opened instantly no matter its size.
+        
+        >>> import tempfile, os
+        >>> A = namedarray([[1., 2.], [3., 4.], [5., 6.]], names = ['x', 'y'])
+        >>> path = os.path.join(tempfile.mkdtemp(), 'A.npy')
+        >>> A.save(path)
+        >>> B = namedarray.load(path, mmap_mode = 'r')
+        >>> B.names.tolist(), B[1:].y, B[1:][:,1:].names.tolist()
+        (['x', 'y'], namedarray([4., 6.]), ['y'])
+        """
+        if not path.endswith('.npy'): path += '.npy'
+        np.save(path, self.asarray())
+        
+        schema = {'names': self.names.tolist() if self.schema is not None else None, 'pandas_compatible': self.pandas_compatible}
+        with open(path + '.json', 'wt') as f:
+            json.dump(schema, f)
+    
+    @staticmethod
+    def load(path, mmap_mode = None):
+        """
+        Load a namedarray saved with save(). With `mmap_mode` ('r', 'r+', 'c', see np.load()) the data are not read
+        into memory, but memory-mapped from the file instead; all views and slices keep column names as usual.
+        If the schema file is missing, the array is loaded without names.
+        """
+        if not path.endswith('.npy') and not os.path.exists(path): path += '.npy'
+        arr = np.load(path, mmap_mode = mmap_mode)
+        
+        schema = {}
+        if os.path.exists(path + '.json'):
+            with open(path + '.json', 'rt') as f:
+                schema = json.load(f)
+        
+        return namedarray(arr, names = schema.get('names'), pandas_compatible = schema.get('pandas_compatible', True))
         
     def asarray(self):
         assert not isinstance(self.base, namedarray)
@@ -1024,7 +1951,7 @@ class namedarray(np.ndarray):
         # dup = np.array(self, order = order, dtype = self.dtype)
         assert not isinstance(self.base, namedarray)
         dup = self.base.copy()
-        return namedarray(dup, names = list(self.names), pandas_compatible = self.pandas_compatible)
+        return namedarray(dup).init_like(self)
         
     def resize(self, new_shape, refcheck = True):
         """
@@ -1034,7 +1961,9 @@ class namedarray(np.ndarray):
         "cannot resize this array: it does not own its data".
         """
         new = np.resize(self, new_shape)        # this does NOT preserve the array type (namedarray)
-        return namedarray(new, names = list(self.names), pandas_compatible = self.pandas_compatible)
+        new = namedarray(new, pandas_compatible = self.pandas_compatible)
+        if new.ndim and new.shape[-1] == self.shape[-1]: new._set_schema(self.schema)
+        return new
 
     def __array_finalize__(self, src_array):
         """
@@ -1048,12 +1977,11 @@ class namedarray(np.ndarray):
         # copy config parameters
         self.pandas_compatible = src_array.pandas_compatible
         
-        # only propagate names/columns when the no. of columns hasn't changed
-        # (warning: this does NOT mean that the meaning of columns hasn't changed either)
+        # only propagate the schema (names/columns) when the no. of columns hasn't changed
+        # (warning: this does NOT mean that the meaning of columns hasn't changed either);
+        # the schema is immutable, so it can be shared by reference without copying
         if self.shape[-1] == src_array.shape[-1]:
-            names = getattr(src_array, 'names', None)
-            columns = getattr(src_array, 'columns', None)
-            self._set_names(names, columns)
+            self.schema = src_array.schema
 
     def __array_ufunc__(self, ufunc, method, *inputs, out = None, **kwargs):
         # print(f'in __array_ufunc__{ufunc, method, *inputs, kwargs}')
@@ -1089,10 +2017,16 @@ class namedarray(np.ndarray):
     
 
     def __getattr__(self, attr):
-        if self.columns and attr in self.columns:
-            column = self.columns[attr]
-            return self[column] if self.ndim <= 1 else self[...,column]
-        raise AttributeError(attr)
+        schema = self.schema
+        column = schema.columns.get(attr) if schema is not None else None
+        if column is None: raise AttributeError(attr)
+        
+        # fast path: index the base array directly, the result has no column names (column dimension is reduced)
+        ret = self.base[column] if self.ndim <= 1 else self.base[...,column]
+        if not isinstance(ret, np.ndarray): return ret
+        ret = ret.view(namedarray)
+        ret.pandas_compatible = self.pandas_compatible
+        return ret
     
     def __getitem__(self, key, _full_slice = slice(None)):
         # print('key:', keys, type(keys))
@@ -1112,12 +2046,13 @@ class namedarray(np.ndarray):
             return ret
             # return np.array(ret)
         
-        if self.names is not None:                          # self.names are None for a vertical vector
+        schema = self.schema
+        if schema is not None:                              # schema is None for a vertical vector
             if isinstance(column, slice) and column == _full_slice:
                 # full slice of the column dimension? names stay the same, no need for recalculation
-                ret._set_names(self.names, self.columns)
+                ret._set_schema(schema)
             else:
-                ret._set_names(self.names[column])
+                ret._set_schema(schema.subset(column))
                 
         return ret
 
@@ -1137,7 +2072,8 @@ class namedarray(np.ndarray):
         ndim = self.ndim
         if self.pandas_compatible and isinstance(key, str):
             # if create and key not in self.columns: self._add_column(key)
-            key = (_full_slice,) * (ndim - 1) + (self.columns[key],)
+            key = self.schema.decode(key, ndim)
+            return key, key[-1]
             
         if not isinstance(key, tuple): key = (key,)
         if len(key) < ndim:
@@ -1193,7 +2129,124 @@ class namedarray(np.ndarray):
     
     def astype(self, *a, **kw):
         arr = self.base.astype(*a, **kw)
-        return namedarray(arr, names = list(self.names), pandas_compatible = self.pandas_compatible)
+        return namedarray(arr).init_like(self)
+    
+    ###  Relational operations: grouping, sorting, joining  ###
+    
+    def _keys(self, cols):
+        "Normalize a column name or a list of names to a list; check that all columns exist."
+        if isinstance(cols, str): cols = cols.split()
+        cols = list(cols)
+        for col in cols:
+            if col not in self.columns: raise KeyError(col)
+        return cols
+    
+    def groupby(self, keys):
+        """
+        Group rows of a 2D namedarray by the values of `keys` column(s), like DataFrame.groupby() in Pandas.
+        Returns a GroupBy object, call agg() on it to compute aggregates.
+        """
+        return GroupBy(self, self._keys(keys))
+        
+    def sort_by(self, cols, ascending = True):
+        """
+        Stable sort of rows by `cols` column(s). The 1st column is the primary sort key.
+        `ascending` can be a single bool or a list of bools, one for each column.
+        Returns a NEW namedarray.
+        
+        >>> A = namedarray([[2, 1], [1, 5], [2, 0], [1, 3]], names = ['k', 'v'])
+        >>> A.sort_by('k').v, A.sort_by(['k', 'v'], ascending = [False, True]).v
+        (namedarray([5, 3, 1, 0]), namedarray([0, 1, 3, 5]))
+        """
+        cols = self._keys(cols)
+        if isinstance(ascending, bool): ascending = [ascending] * len(cols)
+        if len(ascending) != len(cols): raise Exception("the no. of `ascending` flags differs from the no. of columns")
+        
+        base = self.asarray()
+        keys = []
+        for col, asc in zip(cols, ascending):
+            values = base[:,self.columns[col]]
+            if not asc:
+                values = -np.unique(values, return_inverse = True)[1].ravel()       # descending order of ranks keeps the sort stable
+            keys.append(values)
+        
+        if len(keys) == 1:
+            order = np.argsort(keys[0], kind = 'stable')
+        else:
+            order = np.lexsort(keys[::-1])                                          # lexsort is stable and takes the primary key last
+        return self[order]
+    
+    def join(self, other, on, how = 'inner', suffixes = ('_x', '_y')):
+        """
+        Join rows of two 2D namedarrays on equal values of `on` column(s), like DataFrame.merge() in Pandas.
+        The result contains all columns of `self` followed by non-key columns of `other`; overlapping names
+        of non-key columns get `suffixes`. Many-to-many matches produce all combinations of rows.
+        how='inner' keeps matching rows only; how='left' keeps all rows of `self` in their original order,
+        and fills the columns of `other` with NaN where no match is found.
+        Implemented as a sorted merge: keys of both arrays are factorized together, `other` is sorted by keys,
+        and matching ranges of sorted rows are found for every row of `self`.
+        
+        >>> A = namedarray([[1, 10], [2, 20], [3, 30]], names = ['id', 'x'])
+        >>> B = namedarray([[3, 0.3], [1, 0.1], [1, 0.2]], names = ['id', 'x'])
+        >>> C = A.join(B, on = 'id')
+        >>> C.names.tolist()
+        ['id', 'x_x', 'x_y']
+        >>> C
+        namedarray([[ 1. , 10. ,  0.1],
+                    [ 1. , 10. ,  0.2],
+                    [ 3. , 30. ,  0.3]])
+        >>> A.join(B, on = 'id', how = 'left').x_y
+        namedarray([0.1, 0.2, nan, 0.3])
+        """
+        if how not in ('inner', 'left'): raise Exception("unsupported type of join: %s" % how)
+        on = self._keys(on)
+        other._keys(on)
+        
+        left, right = self.asarray(), other.asarray()
+        lkeys = left [:,[self.columns[col] for col in on]]
+        rkeys = right[:,[other.columns[col] for col in on]]
+        codes, first = _factorize(np.concatenate([lkeys, rkeys]))
+        lcodes, rcodes = codes[:len(left)], codes[len(left):]
+        
+        # sort `other` by key codes and find the range of matching rows for every row of `self`;
+        # the codes are dense, so the ranges can be found with bincount() instead of a binary search
+        rorder = np.argsort(rcodes, kind = 'stable')
+        rcount = np.bincount(rcodes, minlength = len(first))
+        lo     = (np.cumsum(rcount) - rcount)[lcodes]
+        counts = rcount[lcodes]
+        
+        if how == 'left':
+            missing = (counts == 0)
+            counts  = np.maximum(counts, 1)
+        
+        total = counts.sum()
+        lo = np.minimum(lo, max(len(rorder) - 1, 0))
+        
+        if total == len(left) and (counts == 1).all():      # every row of `self` has exactly one match: no need to repeat rows
+            lidx = slice(None)
+            ridx = rorder[lo] if len(rorder) else None
+        else:
+            lidx   = np.repeat(np.arange(len(left)), counts)
+            starts = np.cumsum(counts) - counts
+            offset = np.arange(total) - np.repeat(starts, counts)
+            ridx   = rorder[np.minimum(np.repeat(lo, counts) + offset, len(rorder) - 1)] if len(rorder) else None
+        
+        # assemble the result: all columns of `self` + non-key columns of `other`
+        rcols  = [col for col in other.names.tolist() if col not in on]
+        lnames = [col + suffixes[0] if col in rcols and col not in on else col for col in self.names.tolist()]
+        rnames = [col + suffixes[1] if col in self.columns else col for col in rcols]
+        
+        dtype = np.result_type(left.dtype, right.dtype)
+        if how == 'left' and missing.any(): dtype = np.result_type(dtype, float)
+        
+        result = np.empty((total, len(lnames) + len(rnames)), dtype = dtype)
+        result[:,:len(lnames)] = left[lidx]
+        if ridx is not None:
+            result[:,len(lnames):] = right[:,[other.columns[col] for col in rcols]][ridx]
+        if how == 'left':
+            result[np.repeat(missing, counts), len(lnames):] = np.nan
+            
+        return namedarray(result, names = lnames + rnames, pandas_compatible = self.pandas_compatible)
         
     ###  Extra properties and methods, for partial compatibility with Pandas  ###
     
@@ -1222,10 +2275,554 @@ class namedarray(np.ndarray):
             for row in self:
                 yield row
 
+
+
+def _factorize_column(values):
+    """
+    Encode a 1D array of `values` as integer codes assigned to unique values in ascending order. Returns (uniq, codes).
+    Integral values from a narrow range are encoded in linear time with np.bincount(), other values with np.unique().
+    """
+    n = len(values)
+    if n and values.dtype.kind in 'iuf':
+        lo, hi = values.min(), values.max()
+        if hi - lo <= 2 * n:                                    # false for NaNs
+            ints = (values - lo).astype(np.int64)
+            if values.dtype.kind != 'f' or np.array_equal(ints + lo, values):
+                present = np.bincount(ints) > 0
+                remap = np.cumsum(present) - 1
+                return np.flatnonzero(present) + lo, remap[ints]
+                
+    uniq, codes = np.unique(values, return_inverse = True)
+    return uniq, codes.ravel()
+
+
+def _factorize(keys):
+    """
+    Encode rows of a 2D array `keys` as integer codes 0,1,2,... assigned to unique rows in lexicographic order.
+    Returns (codes, first) where codes[i] is the code of keys[i] and first[code] is the index of the 1st row with this code.
+    Every column is factorized separately and the codes are combined column by column,
+    which is much faster than np.unique(keys, axis = 0).
+    """
+    n, k = keys.shape
+    codes, ncodes = np.zeros(n, dtype = np.int64), 1
+    for j in range(k):
+        vals, col_codes = _factorize_column(keys[:,j])
+        codes = codes * len(vals) + col_codes
+        ncodes *= len(vals)
+        if ncodes > 2 * n:                                      # compact the codes to keep them small and avoid overflow of int64
+            _, codes = np.unique(codes, return_inverse = True)
+            codes = codes.ravel()
+            ncodes = codes.max() + 1 if n else 0
+    
+    # make the codes dense
+    present = np.bincount(codes, minlength = ncodes) > 0
+    if not present.all():
+        codes = (np.cumsum(present) - 1)[codes]
+    
+    first = np.full(codes.max() + 1 if n else 0, n, dtype = np.int64)     # index of the 1st occurrence of every code
+    np.minimum.at(first, codes, np.arange(n))
+    return codes, first
+
+
+class GroupBy(object):
+    """
+    Rows of a 2D namedarray grouped by the values of key columns; created by namedarray.groupby().
+    Groups are identified with np.unique(return_inverse = True), or np.bincount() for integral keys,
+    and aggregates are computed in a vectorized way, with np.bincount() (sum, mean, count, var, std)
+    or unbuffered ufunc.at() (min, max, first, last). Groups are ordered by their keys.
+    
+    >>> A = namedarray([[1, 0, 2.], [2, 1, 3.], [1, 1, 4.], [1, 0, 6.]], names = ['k', 'j', 'v'])
+    >>> G = A.groupby('k').agg({'v': ['sum', 'mean', 'max'], 'j': 'count'})
+    >>> G.names.tolist()
+    ['k', 'v_sum', 'v_mean', 'v_max', 'j']
+    >>> G
+    namedarray([[ 1., 12.,  4.,  6.,  3.],
+                [ 2.,  3.,  3.,  3.,  1.]])
+    >>> A.groupby(['k', 'j']).agg({'v': 'first'}).v
+    namedarray([2., 4., 3.])
+    """
+    
+    AGGREGATES = ('sum', 'mean', 'count', 'min', 'max', 'var', 'std', 'first', 'last')
+    
+    array = None            # the namedarray being grouped
+    keys  = None            # list of names of key columns
+    codes = None            # group index for every row of `array`
+    first = None            # index of the 1st row of every group
+    uniq  = None            # 2D array of key values of every group
+    
+    def __init__(self, array, keys):
+        self.array = array
+        self.keys  = keys
+        keyvals = array.asarray()[:,[array.columns[key] for key in keys]]
+        self.codes, self.first = _factorize(keyvals)
+        self.uniq = keyvals[self.first]
+        self._size = None
+    
+    def __len__(self):
+        return len(self.first)
+    
+    def size(self):
+        "No. of rows in each group."
+        if self._size is None:
+            self._size = np.bincount(self.codes, minlength = len(self))
+        return self._size
+    
+    def _aggregate(self, values, fun):
+        "Compute a named aggregate `fun` of a 1D array `values` in every group."
+        codes, ngroups = self.codes, len(self)
+        
+        if fun == 'count': return self.size()
+        if fun == 'sum':   return np.bincount(codes, weights = values, minlength = ngroups)
+        if fun == 'mean':  return np.bincount(codes, weights = values, minlength = ngroups) / self.size()
+        if fun in ('var', 'std'):
+            count = self.size()
+            dev = values - (np.bincount(codes, weights = values, minlength = ngroups) / count)[codes]
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):           # single-row groups get NaN, like in Pandas
+                var = np.bincount(codes, weights = dev * dev, minlength = ngroups) / (count - 1)
+            return var if fun == 'var' else np.sqrt(var)
+        
+        if fun == 'first': return values[self.first]
+        if fun == 'last':
+            last = np.zeros(ngroups, dtype = np.int64)
+            np.maximum.at(last, codes, np.arange(len(codes)))
+            return values[last]
+        if fun in ('min', 'max'):
+            result = values[self.first]
+            (np.minimum if fun == 'min' else np.maximum).at(result, codes, values)
+            return result
+        
+        if callable(fun):
+            order = np.argsort(codes, kind = 'stable')
+            ends  = np.cumsum(self.size())
+            return np.array([fun(values[order[end-size:end]]) for end, size in zip(ends, self.size())])
+            
+        raise Exception("unknown aggregate function: %s" % fun)
+    
+    def agg(self, spec):
+        """
+        Compute aggregates of columns in every group. `spec` is a dict of {column: function}
+        or {column: [function1, function2, ...]}, where a function is a name from AGGREGATES or a callable
+        that takes a 1D array of column values in a group and returns a scalar.
+        Returns a namedarray with key columns followed by aggregated columns, one row per group.
+        An aggregated column is named after the source column if only one function is given for this column,
+        or "<column>_<function>" otherwise.
+        """
+        base    = self.array.asarray()
+        names   = list(self.keys)
+        results = [self.uniq[:,i] for i in range(len(self.keys))]
+        
+        for col, funs in spec.items():
+            values = base[:,self.array.columns[col]]
+            single = not isinstance(funs, (list, tuple))
+            if single: funs = [funs]
+            for fun in funs:
+                results.append(self._aggregate(values, fun))
+                names.append(col if single else '%s_%s' % (col, getattr(fun, '__name__', fun)))
+        
+        dtype  = np.result_type(*results) if results else base.dtype
+        result = np.empty((len(self), len(results)), dtype = dtype)
+        for i, res in enumerate(results):
+            result[:,i] = res
+        
+        return namedarray(result, names = names, pandas_compatible = self.array.pandas_compatible)
+    
+    aggregate = agg
+
+
+class namedtable(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    A table of named columns of different dtypes: a heterogeneous sibling of namedarray,
+    backed by a 1-dimensional numpy structured array (self.data) with one field per column.
+    Provides the same syntax for column access as namedarray: T.COL, T['COL'], T[rows,'COL'],
+    as well as assign() and extended_with(). Numpy's ufuncs and operators are applied column by column
+    and return a new namedtable with the same names and (possibly different) dtypes of columns.
+    
+    A namedtable can be created from a namedarray without copying (if the array is C-contiguous),
+    and a subset of columns of the same dtype that lie next to each other in the underlying record
+    can be converted back to a namedarray without copying, too - see from_namedarray() and to_namedarray().
+    
+    >>> T = namedtable({'id': [1, 2, 3], 'x': [0.5, -1.0, 2.0]})
+    >>> T
+    namedtable([(1,  0.5), (2, -1. ), (3,  2. )], names=['id', 'x'])
+    >>> T.id, T['x'], T[1:,'x'], T[0,'id']
+    (array([1, 2, 3]), array([ 0.5, -1. ,  2. ]), array([-1.,  2.]), 1)
+    >>> float(T[0,1]), T[1:,1].tolist(), T[:2,[1,0]].id.tolist()     # columns can be given by position, too
+    (0.5, [-1.0, 2.0], [1, 2])
+    >>> (T * 2).id, abs(T).x
+    (array([2, 4, 6]), array([0.5, 1. , 2. ]))
+    >>> T.assign(y = T.x * 10, id = [7, 8, 9])
+    namedtable([(7,  0.5,   5.), (8, -1. , -10.), (9,  2. ,  20.)], names=['id', 'x', 'y'])
+    >>> T.extended_with('z', flag = [True, False, True])[1:]
+    namedtable([(2, -1., 0., False), (3,  2., 0.,  True)], names=['id', 'x', 'z', 'flag'])
+    
+    >>> A = namedarray([[1., 2.], [3., 4.]], names = ['a', 'b'])
+    >>> S = namedtable.from_namedarray(A)
+    >>> S.b[0] = 20                         # a zero-copy view: modifications are visible in `A`
+    >>> A.b
+    namedarray([20.,  4.])
+    >>> S.to_namedarray().names.tolist(), np.shares_memory(S.to_namedarray(), A)
+    (['a', 'b'], True)
+    """
+    pandas_compatible = True
+    
+    data   = None           # 1D numpy structured array with one field per column
+    schema = None           # colschema of the table
+    
+    def __init__(self, data, names = None, pandas_compatible = True):
+        """
+        `data` can be: a 1D structured array (used without copying); a dict of {name: column};
+        a list of columns (1D sequences), in such case `names` must be given; or a namedarray/2D ndarray
+        (converted without copying through from_namedarray()).
+        """
+        self.pandas_compatible = pandas_compatible
+        
+        if isinstance(data, np.ndarray) and data.dtype.names is not None:
+            if data.ndim != 1: raise Exception("namedtable must be backed by a 1-dimensional structured array")
+            if names is not None: data = data[names]
+        elif isinstance(data, np.ndarray):
+            data = namedtable._as_records(data, names)
+        else:
+            if isdict(data):
+                if names is None: names = list(data.keys())
+                columns = [data[name] for name in names]
+            else:
+                columns = data
+            if names is None or len(names) != len(columns): raise Exception("names of columns must be provided for all columns")
+            data = namedtable._from_columns(names, columns)
+        
+        self.data = data
+        self.schema = colschema(data.dtype.names)
+        
+    @staticmethod
+    def _from_columns(names, columns):
+        "Allocate a structured array and copy `columns` into it."
+        columns = [np.asarray(col) for col in columns]
+        if not all(col.ndim == 1 for col in columns): raise Exception("columns of a namedtable must be 1-dimensional")
+        if len(set(len(col) for col in columns)) > 1: raise Exception("columns of a namedtable must have equal lengths")
+        
+        size = len(columns[0]) if columns else 0
+        data = np.empty(size, dtype = [(name, col.dtype) for name, col in zip(names, columns)])
+        for name, col in zip(names, columns):
+            data[name] = col
+        return data
+    
+    @staticmethod
+    def _as_records(arr, names = None):
+        "View a 2D homogeneous array as a 1D structured array, without copying if `arr` is C-contiguous."
+        if names is None: names = getattr(arr, 'names', None)
+        if names is None: raise Exception("names of columns must be provided")
+        
+        arr = np.asarray(arr)
+        if arr.ndim != 2: raise Exception("only a 2-dimensional array can be converted to a namedtable")
+        if not arr.flags.c_contiguous: arr = np.ascontiguousarray(arr)
+        
+        dtype = np.dtype([(str(name), arr.dtype) for name in names])
+        return arr.view(dtype).reshape(arr.shape[0])
+    
+    @staticmethod
+    def from_namedarray(arr):
+        "Create a namedtable that shares memory with a C-contiguous 2D namedarray `arr` (otherwise, data are copied)."
+        return namedtable(namedtable._as_records(arr), pandas_compatible = arr.pandas_compatible)
+    
+    @staticmethod
+    def from_pandas(frame):
+        return namedtable({str(name): frame[name].values for name in frame.columns})
+    
+    def save(self, path):
+        "Save to a .npy file. Names and dtypes of columns are kept in the structured dtype, so no extra schema file is needed."
+        np.save(path, self.data)
+    
+    @staticmethod
+    def load(path, mmap_mode = None):
+        "Load a namedtable saved with save(), possibly memory-mapped, see namedarray.load()."
+        if not path.endswith('.npy') and not os.path.exists(path): path += '.npy'
+        return namedtable(np.load(path, mmap_mode = mmap_mode))
+    
+    def to_namedarray(self, *names, **kwargs):
+        """
+        Convert a subset of columns (all columns by default) to a namedarray.
+        If the columns have the same dtype and are placed next to each other in the record,
+        the result is a view on self.data (no copying). Otherwise, the columns are copied
+        and converted to a common dtype, or to `dtype` if provided as a keyword argument.
+        """
+        from numpy.lib.stride_tricks import as_strided
+        
+        if len(names) == 1 and not isinstance(names[0], str): names = names[0]
+        names  = list(names or self.schema.names.tolist())
+        dtype  = kwargs.get('dtype')
+        fields = self.data.dtype.fields
+        types  = [fields[name][0] for name in names]
+        offset = [fields[name][1] for name in names]
+        first  = types[0]
+        
+        homogeneous = all(t == first for t in types) and (dtype is None or np.dtype(dtype) == first)
+        adjacent    = all(offset[i+1] - offset[i] == first.itemsize for i in range(len(names) - 1))
+        
+        if homogeneous and adjacent and first.shape == ():
+            col = self.data[names[0]]
+            arr = as_strided(col, shape = (len(col), len(names)), strides = (col.strides[0], first.itemsize))
+        else:
+            dtype = dtype or np.result_type(*types)
+            arr = np.stack([self.data[name].astype(dtype) for name in names], axis = 1)
+            
+        return namedarray(arr, names = names, pandas_compatible = self.pandas_compatible)
+    
+    def to_pandas(self):
+        import pandas as pd
+        return pd.DataFrame(self.data)
+    
+    def copy(self):
+        return namedtable(self.data.copy(), pandas_compatible = self.pandas_compatible)
+    
+    def _derived(self, data):
+        "Wrap a structured array derived from self.data (same fields) into a namedtable that shares the schema."
+        new = namedtable.__new__(namedtable)
+        new.data = data
+        new.schema = self.schema
+        new.pandas_compatible = self.pandas_compatible
+        return new
+    
+    @property
+    def names(self):
+        return self.schema.names
+    
+    @property
+    def columns(self):
+        return self.schema.columns
+    
+    @property
+    def dtypes(self):
+        return [self.data.dtype[i] for i in range(len(self.schema))]
+    
+    @property
+    def shape(self):
+        return (len(self.data), len(self.schema))
+    
+    ndim = 2
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __iter__(self):
+        return iter(self.data)
+    
+    def __repr__(self):
+        body = np.array2string(self.data, separator = ', ', prefix = 'namedtable(')
+        return 'namedtable(%s, names=%s)' % (body, self.schema.names.tolist())
+    
+    def __getattr__(self, attr):
+        schema = self.__dict__.get('schema')
+        if schema is None or attr not in schema.columns: raise AttributeError(attr)
+        return self.data[attr]
+    
+    def __getitem__(self, key):
+        """
+        T['COL'] returns a column as a 1D array (a view), T[['COL1','COL2']] returns a namedtable with a subset of columns;
+        T[rows] returns a namedtable of selected rows, or a single record (np.void) if `rows` is an integer;
+        T[rows,'COL'] and T[rows,['COL1','COL2']] combine both types of selection; in T[rows,cols], columns can be given
+        by position, too: an integer, a slice or a list of integers (and names).
+        """
+        if isinstance(key, str):
+            if not self.pandas_compatible: raise KeyError(key)
+            return self.data[key]
+        
+        if isinstance(key, tuple) and len(key) == 2:
+            rows, column = key
+            names = self.data.dtype.names
+            if isinstance(column, numbers.Integral): column = names[column]
+            elif isinstance(column, slice): column = list(names[column])
+            elif isinstance(column, list): column = [names[c] if isinstance(c, numbers.Integral) else c for c in column]
+            if isinstance(column, str):
+                return self.data[column][rows]
+            if isinstance(column, list): return self[column][rows]
+            raise TypeError("namedtable, column must be a name, a position, a slice or a list of them, not %s" % type(column).__name__)
+            
+        if isinstance(key, list) and key and all(isinstance(name, str) for name in key):
+            return namedtable(self.data[key], pandas_compatible = self.pandas_compatible)
+            
+        ret = self.data[key]
+        if isinstance(ret, np.ndarray): return self._derived(ret)
+        return ret
+    
+    def __setitem__(self, key, value):
+        if isinstance(key, tuple) and len(key) == 2:
+            rows, column = key
+            self._check_column(column)
+            self.data[column][rows] = value
+        elif isinstance(key, str):
+            self._check_column(key)
+            self.data[key] = value
+        else:
+            self.data[key] = value
+    
+    def _check_column(self, name):
+        if name not in self.schema.columns: raise KeyError(name)
+    
+    def assign(self, **columns):
+        """
+        Assign new and/or existing columns, similar to DataFrame.assign() in Pandas.
+        Existing columns keep their dtype; new columns get the dtype of the assigned values.
+        Creates and returns a NEW namedtable. The original table remains unchanged.
+        """
+        create  = [name for name in columns if name not in self.schema.columns]
+        new     = self.extended_with(**{name: columns[name] for name in create})
+        for name, values in columns.items():
+            if name not in create: new[name] = values
+        return new
+    
+    def extended_with(self, *names, **columns):
+        """
+        Add new columns and return as a NEW namedtable. The current table (self) remains unchanged.
+        New columns as given in `names` are filled with zeros of float dtype.
+        For `columns`, the columns are assigned the values of corresponding `columns` arguments, with their original dtype.
+        """
+        if len(names) == 1: names = names[0]
+        if isinstance(names, str): names = names.split()
+        
+        size    = len(self.data)
+        fields  = [(name, self.data[name]) for name in self.schema.names.tolist()]
+        fields += [(name, np.zeros(size)) for name in names]
+        fields += [(name, np.broadcast_to(np.asarray(values), (size,))) for name, values in columns.items()]
+        
+        data = namedtable._from_columns([f[0] for f in fields], [f[1] for f in fields])
+        return namedtable(data, pandas_compatible = self.pandas_compatible)
+    
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        "Apply `ufunc` column by column. Only element-wise calls (method='__call__') are supported."
+        if method != '__call__': return NotImplemented
+        
+        out = kwargs.pop('out', None)
+        if out is not None and not all(isinstance(x, namedtable) for x in out): return NotImplemented
+        
+        for x in inputs:
+            if isinstance(x, namedtable) and len(x.schema) != len(self.schema):
+                raise Exception("namedtables in a ufunc call must have the same no. of columns")
+        
+        names   = self.schema.names.tolist()
+        results = [[] for _ in range(ufunc.nout)]
+        
+        for i, name in enumerate(names):
+            args = [x.data[x.schema.names[i]] if isinstance(x, namedtable) else x for x in inputs]
+            if out is not None:
+                kwargs['out'] = tuple(x.data[x.schema.names[i]] for x in out)
+            res = ufunc(*args, **kwargs)
+            if ufunc.nout == 1: res = (res,)
+            for j, r in enumerate(res): results[j].append(r)
+        
+        if out is not None:
+            return out[0] if ufunc.nout == 1 else out
+        
+        tables = tuple(namedtable(namedtable._from_columns(names, cols), pandas_compatible = self.pandas_compatible) for cols in results)
+        return tables[0] if ufunc.nout == 1 else tables
+    
+    ###  Extra properties and methods, for partial compatibility with Pandas  ###
+    
+    @property
+    def empty(self):
+        return len(self.data) == 0
+        
+    @property
+    def iloc(self):
+        return self
+        
+    def itertuples(self, index = True, name = 'Pandas'):
+        assert index == False
+        t = namedtuple(name, self.schema.names.tolist())
+        for row in self.data:
+            yield t(*row)
+
     
 #####################################################################################################################################################
 
 if __name__ == "__main__":
-    import doctest
+    import sys, doctest
+    from timeit import timeit
+    
+    def bench_namedarray(rows = 1000, cols = 20, number = 100000):
+        "Speed of column access in namedarray vs. plain ndarray and pandas' DataFrame, in microseconds per access."
+        import pandas as pd
+        names = ['c%d' % i for i in range(cols)]
+        X = np.random.rand(rows, cols)
+        A = namedarray(X, names = names)
+        D = pd.DataFrame(X, columns = names)
+        tests = [("ndarray   X[:,5]",     lambda: X[:,5]),
+                 ("namedarray A.c5",      lambda: A.c5),
+                 ("namedarray A['c5']",   lambda: A['c5']),
+                 ("namedarray A[:,'c5']", lambda: A[:,'c5']),
+                 ("namedarray A[10:20]",  lambda: A[10:20]),
+                 ("namedarray A[:,2:8]",  lambda: A[:,2:8]),
+                 ("namedarray A + A",     lambda: A + A),
+                 ("DataFrame D.c5",       lambda: D.c5),
+                 ("DataFrame D['c5']",    lambda: D['c5']),
+                 ("DataFrame D[10:20]",   lambda: D[10:20])]
+        for title, test in tests:
+            print("%-22s %8.2f us" % (title, timeit(test, number = number) * 1e6 / number))
+    
+    def bench_relational(rows = 10**7, groups = 1000):
+        "Speed of groupby/agg, sort_by and join in namedarray vs. pandas' DataFrame, in seconds."
+        import pandas as pd
+        rand = np.random.RandomState(0)
+        X = np.column_stack([rand.randint(0, groups, rows), rand.randint(0, 10, rows), rand.rand(rows)])
+        Y = np.column_stack([np.arange(groups), rand.rand(groups)])
+        A, B = namedarray(X, names = ['k', 'j', 'v']), namedarray(Y, names = ['k', 'w'])
+        D, E = pd.DataFrame(X, columns = ['k', 'j', 'v']), pd.DataFrame(Y, columns = ['k', 'w'])
+        tests = [("namedarray groupby",   lambda: A.groupby(['k', 'j']).agg({'v': ['sum', 'mean', 'max']})),
+                 ("DataFrame  groupby",   lambda: D.groupby(['k', 'j']).agg({'v': ['sum', 'mean', 'max']})),
+                 ("namedarray sort_by",   lambda: A.sort_by(['k', 'v'])),
+                 ("DataFrame  sort",      lambda: D.sort_values(['k', 'v'], kind = 'stable')),
+                 ("namedarray join",      lambda: A.join(B, on = 'k')),
+                 ("DataFrame  merge",     lambda: D.merge(E, on = 'k'))]
+        for title, test in tests:
+            print("%-22s %8.3f s" % (title, timeit(test, number = 1)))
+    
+    def bench_accumulator2d(size = 1024, patch = 32, stride = 4):
+        "Sliding-window heatmap assembly: a loop of Accumulator2D.add() vs. a single add_many()."
+        X = np.zeros((size, size))
+        ys, xs = [a.ravel() for a in np.mgrid[0 : size - patch + 1 : stride, 0 : size - patch + 1 : stride]]
+        patches = np.random.rand(len(xs), patch, patch)
+        weights = np.random.rand(len(xs))
+        
+        def loop():
+            acc = Accumulator2D(X)
+            for x, y, p, w in zip(xs, ys, patches, weights): acc.add(x, y, p, w)
+            return acc
+        def bulk():
+            acc = Accumulator2D(X)
+            acc.add_many(xs, ys, patches, weights)
+            return acc
+        
+        assert np.allclose(loop().mean(), bulk().mean())
+        t1, t2 = timeit(loop, number = 1), timeit(bulk, number = 1)
+        print("Accumulator2D, %d patches %dx%d:  add() %.3fs (%.0f patches/s)   add_many() %.3fs (%.0f patches/s)" %
+              (len(xs), patch, patch, t1, len(xs) / t1, t2, len(xs) / t2))
+    
+    def bench_concurrent_stack(threads = 8, items = 100000, shape = (16,), batch = 10000):
+        "Time of appending rows and batches of rows from multiple threads to a ConcurrentStack vs. a Stack guarded by a single Lock."
+        import threading
+        row, rows = np.ones(shape), np.ones((batch,) + shape)
+        
+        def run(append, item, count):
+            workers = [threading.Thread(target = lambda: [append(item) for _ in range(count)]) for _ in range(threads)]
+            for w in workers: w.start()
+            for w in workers: w.join()
+        
+        def locked(method):
+            lock = threading.Lock()
+            def append(item):
+                with lock: method(item)
+            return append
+        
+        print("rows:    Stack + Lock      %8.3f s" % timeit(lambda: run(locked(Stack(shape).append), row, items), number = 1))
+        print("rows:    ConcurrentStack   %8.3f s" % timeit(lambda: run(ConcurrentStack(shape).append, row, items), number = 1))
+        print("batches: Stack + Lock      %8.3f s" % timeit(lambda: run(locked(Stack(shape).append_all), rows, 100), number = 1))
+        print("batches: ConcurrentStack   %8.3f s" % timeit(lambda: run(ConcurrentStack(shape).append_all, rows, 100), number = 1))
+    
     print(doctest.testmod())
+    
+    if 'bench' in sys.argv[1:]:
+        bench_namedarray()
+        bench_relational()
+        bench_concurrent_stack()
+        bench_accumulator2d(patch = 8, stride = 2)
+        bench_accumulator2d(patch = 32, stride = 4)
 
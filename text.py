@@ -14,10 +14,11 @@ You should have received a copy of the GNU General Public License along with Nif
 '''
 
 from __future__ import absolute_import
-import re, math
+import os, re, math, json, multiprocessing, numpy as np
+from scipy import sparse
 from collections import defaultdict
 from array import array
-from six.moves import reduce
+from six.moves import reduce, xrange
 from six.moves.html_parser import HTMLParser
 
 try:                                                # Python 2
@@ -478,12 +479,19 @@ def keyPattern(keys):
 ###  EDIT DISTANCE
 ###
 
-def levenshtein(a, b, casecost = 1, spacecost = 1, totals = False):
+def levenshtein(a, b, casecost = 1, spacecost = 1, totals = False, max_dist = None):
     """
     Calculates the Levenshtein edit distance between strings a and b.
     'casecost' is the cost of replacement when only the case is changed, not the actual character.
+    'spacecost' is the cost of insertion/deletion of a whitespace character (other characters cost 1).
     If totals=True, returns total character costs of both strings, in addition to the distance value,
     as a triple (dist, cost_a, cost_b).
+    If 'max_dist' is given, calculation stops as soon as it's known that the distance exceeds max_dist,
+    and a lower bound of the true distance is returned instead, which is larger than max_dist.
+
+    After stripping a common prefix and suffix, unit costs (casecost = spacecost = 1) are calculated
+    with Myers' bit-parallel algorithm, as modified by Hyyrö for the edit distance, in O(n*m/w) time;
+    other costs with the Wagner-Fischer dynamic programming, vectorized over rows with numpy for longer strings.
 
     >>> levenshtein("Ala", "OLa")
     2
@@ -493,79 +501,396 @@ def levenshtein(a, b, casecost = 1, spacecost = 1, totals = False):
     0.3
     >>> levenshtein(" a ala Ola ", "aalaola ", 1, 2)
     7
+    >>> levenshtein("kitten", "sitting"), levenshtein("kitten", "sitting", max_dist = 1) > 1
+    (3, True)
+    >>> levenshtein("kitten", "sitting", 1.0, 1.0), levenshtein("kitten", "sitting", 1.0, 2.0)
+    (3.0, 3.0)
     """
-    #_a, _b = a,b
-    reorder = False
+    isint = util.isint(casecost) and util.isint(spacecost)
+    cast = int if isint else float
+
+    if totals:
+        spaces_a, spaces_b = _count_spaces(a), _count_spaces(b)
+        cost_a = cast(len(a) - spaces_a + spaces_a * spacecost)
+        cost_b = cast(len(b) - spaces_b + spaces_b * spacecost)
+        return levenshtein(a, b, casecost, spacecost, max_dist = max_dist), cost_a, cost_b
+
+    # common prefix and suffix never influence the distance
     n, m = len(a), len(b)
-    if n < m:                                   # ensure that n >= m ('a' is longer), to speed up calculations (short outer loop); but mem usage is O(max(n,m))
-        a,b = b,a
-        n,m = m,n
-        reorder = True
+    start = 0
+    while start < n and start < m and a[start] == b[start]: start += 1
+    stop = 0
+    while stop < n - start and stop < m - start and a[n-1-stop] == b[m-1-stop]: stop += 1
+    a, b = a[start:n-stop], b[start:m-stop]
+    if len(a) < len(b): a, b = b, a             # ensure that 'a' is longer: short outer loop in DP
+    if not b:
+        return cast(len(a) - _count_spaces(a) + _count_spaces(a) * spacecost)
+
+    if casecost == 1 and spacecost == 1:
+        return cast(_levenshtein_bits(a, b, max_dist))
+
+    if max_dist is not None:
+        # every edit operation except case change costs at least 'mincost', hence a lower bound of the distance
+        # is the unit-cost distance of lowercase strings, which is fast to calculate
+        mincost = min(1, spacecost)
+        if mincost > 0:
+            lower = mincost * _levenshtein_bits(a.lower(), b.lower(), max_dist / float(mincost))
+            if lower > max_dist: return cast(lower)
+
+    if len(a) * len(b) >= _LEVENSHTEIN_NUMPY:
+        dist = _levenshtein_rows(a, b, casecost, spacecost, max_dist, int if isint else float)
+    else:
+        dist = _levenshtein_dp(a, b, casecost, spacecost, max_dist)
+    return cast(dist)
 
-    charcost = lambda c: spacecost if c.isspace() else 1
-    isint = util.isint(casecost) and util.isint(spacecost)
-    typecode = 'l' if isint else 'd'
-    zero = array(typecode, [0])
-    zeron = zero * n
+_LEVENSHTEIN_NUMPY = 2500           # min. no. of DP cells (len(a)*len(b)) for levenshtein() to use a numpy-vectorized DP
 
-    try:
-        alow = a.lower()
-        blow = b.lower()
-        acost = array(typecode, imap(charcost, a))
-        bcost = array(typecode, imap(charcost, b))
-
-        #current = range(n+1)
-        current = zero + acost                  # initially, current[j] is the total cost of letters in a[:j], for j = 0,1,...,n
-        for j in range(2,n+1):
-            current[j] += current[j-1]          # 'current' must hold cumulative a[:j] costs rather than single-letter costs
-        #print current
-
-        # loop invariant: current[j] is the cost of transforming a[:j] into b[:i]
-        for i in range(1,m+1):                  # loop over characters of 'b'
-            cur_b, cur_bcost = b[i-1], bcost[i-1]
-            previous = current
-            current = array(typecode, [previous[0] + cur_bcost]) + zeron
-            for j in range(1,n+1):              # loop over characters of 'a'
-                add = previous[j] + cur_bcost                           # cost of adding extra character in 'b'
-                delete = current[j-1] + acost[j-1]                      # cost of deleting extra character from 'a'
-                change = previous[j-1]
-                if a[j-1] != cur_b:
-                    if alow[j-1] == blow[i-1]: change += casecost       # only the case is different?
-                    else: change += max(cur_bcost, acost[j-1])
-                current[j] = min(add, delete, change)
-
-    except UnicodeWarning:
-        print("unicode error in levenshtein(%s, %s)" % (repr(a), repr(b)))
-        raise
 
-    if totals:
-        if reorder: return current[n], sum(bcost), sum(acost)
-        else: return current[n], sum(acost), sum(bcost)
-    return current[n]
+def _count_spaces(s, pat = re.compile(r'\s', re.UNICODE)):
+    return len(pat.findall(s)) if s else 0
 
-def levendist(a, b, casecost = 0.5, spacecost = 0.5):
+def _levenshtein_bits(a, b, max_dist = None):
+    """
+    Unit-cost Levenshtein distance with a bit-parallel algorithm (Myers 1999; Hyyrö 2001).
+    Columns of the DP matrix for 'a' are encoded as bit vectors (python ints of len(a) bits) of vertical deltas,
+    so that a whole column is updated in a few integer operations for every character of 'b'.
+    With 'max_dist', returns a lower bound > max_dist as soon as the distance is known to exceed it.
+    """
+    m = len(a)
+    if not m: return len(b)
+    peq = {}                                    # bit masks of positions of every character in 'a'
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    
+    mask = (1 << m) - 1
+    high = 1 << (m - 1)
+    pv, mv = mask, 0                            # positive/negative vertical deltas
+    score = m
+    remaining = len(b)
+    
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & high: score += 1
+        elif mh & high: score -= 1
+        ph = (ph << 1) | 1
+        mh <<= 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+        
+        remaining -= 1
+        if max_dist is not None and score - remaining > max_dist:
+            return score - remaining            # the distance can decrease by at most 1 per remaining character of 'b'
+    return score
+
+def _levenshtein_dp(a, b, casecost, spacecost, max_dist = None):
+    "Weighted Levenshtein distance, Wagner-Fischer DP with python lists; 'a' should be the longer string."
+    alow, blow = a.lower(), b.lower()
+    acost = [spacecost if c.isspace() else 1 for c in a]
+    
+    current = [0]                               # current[j] is the cost of transforming a[:j] into b[:i]
+    for cost in acost: current.append(current[-1] + cost)
+    
+    for i, cb in enumerate(b):
+        bcost = spacecost if cb.isspace() else 1
+        lb = blow[i]
+        previous = current
+        left = previous[0] + bcost
+        current = [left]
+        rowmin = left
+        for j, ca in enumerate(a):
+            change = previous[j]
+            if ca != cb:
+                if alow[j] == lb: change += casecost                # only the case is different?
+                else: change += bcost if bcost > acost[j] else acost[j]
+            add = previous[j+1] + bcost                             # cost of adding extra character in 'b'
+            delete = left + acost[j]                                # cost of deleting extra character from 'a'
+            left = add if add < delete else delete
+            if change < left: left = change
+            current.append(left)
+            if left < rowmin: rowmin = left
+        
+        if max_dist is not None and rowmin > max_dist:
+            return rowmin                       # every path to the final cell crosses this row, and costs are non-negative
+    
+    return current[-1]
+
+def _levenshtein_rows(a, b, casecost, spacecost, max_dist = None, dtype = float):
+    """
+    Weighted Levenshtein distance, Wagner-Fischer DP vectorized over rows of the DP matrix with numpy.
+    The horizontal dependency in a row, current[j] = min(t[j], current[j-1] + acost[j-1]), is resolved
+    with a running minimum: current = C + minimum.accumulate(t - C), where C is the cumulative cost of 'a'.
+    """
+    A = np.array([ord(c) for c in a], dtype = np.uint32)            # no encoding: 'a' may be a py2 byte string with non-ASCII bytes
+    Alow = np.array([ord(c) for c in a.lower()], dtype = np.uint32)
+    acost = np.array([spacecost if c.isspace() else 1 for c in a], dtype = dtype)
+    C = np.concatenate([[0], np.cumsum(acost)]).astype(dtype)
+    
+    blow = b.lower()
+    current = C.copy()
+    t = np.empty_like(C)
+    for i, cb in enumerate(b):
+        bcost = spacecost if cb.isspace() else 1
+        change = np.where(Alow == ord(blow[i]), casecost, np.maximum(acost, bcost)).astype(dtype)
+        change[A == ord(cb)] = 0
+        t[0] = current[0] + bcost
+        np.minimum(current[1:] + bcost, current[:-1] + change, out = t[1:])
+        current = C + np.minimum.accumulate(t - C)
+        if max_dist is not None:
+            rowmin = current.min()
+            if rowmin > max_dist: return rowmin
+    return current[-1]
+
+def levendist(a, b, casecost = 0.5, spacecost = 0.5, max_dist = None):
     """Like levenshtein(), but normalizes the distance value into [0,1] range: 0.0 iff a==b, 1.0 for total dissimilarity.
     Warning: distance value can get out of [0,1] range if casecost or spacecost is outside this range!
+    If 'max_dist' (normalized) is given and the distance exceeds it, 1.0 is returned without calculating the exact distance.
     >>> levendist("Alama", "ALA")
     0.6
     """
     if a == b: return 0.0
     if not a or not b: return 1.0
-    dist, cost_a, cost_b = levenshtein(a, b, casecost, spacecost, totals = True)
     maxcost = max(len(a), len(b)) #max(cost_a, cost_b)
+    if max_dist is not None:
+        max_dist = max_dist * maxcost + 1e-9                # tolerance for rounding errors of normalization
+        if abs(len(a) - len(b)) * min(1, spacecost) > max_dist: return 1.0
+    dist = levenshtein(a, b, casecost, spacecost, max_dist = max_dist)
+    if max_dist is not None and dist > max_dist: return 1.0
     #print dist, maxcost
     assert 0 <= dist <= maxcost or not (0 <= casecost <= 1) or not (0 <= spacecost <= 1)        # from properties of Levenshtein algorithm
     return dist / float(maxcost)
 
-def levenscore(a, b, casecost = 0.5, spacecost = 0.5):
+def levenscore(a, b, casecost = 0.5, spacecost = 0.5, min_score = None):
     """Like levenshtein(), but normalizes the distance value and converts into a score in [0,1]: the more similar the strings, the higher the score, 1.0 iff a==b.
     Warning: score value can get out of [0,1] range if casecost or spacecost is outside this range!
+    If 'min_score' is given and the score is lower, 0.0 is returned without calculating the exact score
+    - useful when only pairs above a threshold are needed, as in deduplication.
     >>> levenscore("Alama", "ALA")
     0.4
     >>> levenscore("Control of Insect Ve", "Osamu Kanamori: Phil")
     0.025000000000000022
+    >>> levenscore("Control of Insect Ve", "Osamu Kanamori: Phil", min_score = 0.8), levenscore("Alama", "ALA", min_score = 0.4)
+    (0.0, 0.4)
     """
-    return 1.0 - levendist(a, b, casecost, spacecost)
+    max_dist = None if min_score is None else 1.0 - min_score
+    return 1.0 - levendist(a, b, casecost, spacecost, max_dist)
+
+
+#########################################################################################################################################################
+###
+###  FUZZY MATCHING of many strings
+###
+
+class FuzzyIndex(object):
+    """
+    Index of strings for fast approximate matching by levenscore(): one-vs-many in query() and all-pairs in self_join().
+    Instead of scoring all pairs, candidates are generated by blocking on character N-grams (see ngrams()) of lowercase strings:
+    if levenscore(a, b) >= threshold, then the unit-cost edit distance k of lowercase strings is limited (see _max_edits()),
+    and the padded N-grams of a, b share at least max(len(a),len(b)) + N-1 - k*N items (the q-gram count filter). Only candidates that share one of the rarest
+    N-grams of the query (prefix filter), and pass the length and count filters, are scored with levenscore(),
+    which also stops early below the threshold.
+    
+    N-grams are numbered and kept in CSR-like numpy arrays: strings -> N-gram ids, and N-gram ids -> strings (postings);
+    repeated N-grams of a string get different ids for subsequent occurrences, so that set intersection
+    counts shared N-grams with multiplicities.
+    
+    >>> index = FuzzyIndex(["Marcin Wojnarski", "Marcin Wojnarsky", "John Smith", "Jon Smith", "jon smith "])
+    >>> index.query("John Smyth", k = 2, threshold = 0.7)
+    [(0, 2, 0.9), (0, 3, 0.8)]
+    >>> index.self_join(threshold = 0.8)
+    [(0, 1, 0.9375), (2, 3, 0.9), (3, 4, 0.85)]
+    """
+    
+    def __init__(self, strings = (), N = 3, casecost = 0.5, spacecost = 0.5):
+        self.N = N
+        self.casecost = casecost
+        self.spacecost = spacecost
+        self.strings = []
+        self._vocab = {}                        # (ngram, occurrence) -> id
+        self._pending = []                      # lists of N-gram ids of strings added since the last _build()
+        self._kptr = np.zeros(1, dtype = np.int64)              # N-gram ids of string i: _kids[_kptr[i]:_kptr[i+1]]
+        self._kids = np.zeros(0, dtype = np.int64)
+        self._pptr = self._pids = None                          # postings: ids of strings containing N-gram g: _pids[_pptr[g]:_pptr[g+1]]
+        self._lengths = np.zeros(0, dtype = np.int64)              # lengths of strings
+        self._spaces = np.zeros(0, dtype = np.int64)               # no. of whitespace characters in strings
+        self.extend(strings)
+    
+    def __len__(self):
+        return len(self.strings)
+    
+    def add(self, s):
+        "Add a string to the index. Returns its id: the position in self.strings."
+        self.strings.append(s)
+        self._pending.append(self._encode(s, add = True))
+        self._pptr = None
+        return len(self.strings) - 1
+    
+    def extend(self, strings):
+        for s in strings: self.add(s)
+    
+    def _ngrams(self, s):
+        "List of (ngram, occurrence) keys of the lowercase string 's'."
+        seen = defaultdict(int)
+        keys = []
+        for gram in ngrams([s.lower()], self.N):
+            keys.append((gram, seen[gram]))
+            seen[gram] += 1
+        return keys
+    
+    def _encode(self, s, add = False):
+        "List of N-gram ids of 's'. If add=False, N-grams not present in the index are omitted."
+        vocab = self._vocab
+        if add: return [vocab.setdefault(key, len(vocab)) for key in self._ngrams(s)]
+        return [vocab[key] for key in self._ngrams(s) if key in vocab]
+    
+    def _build(self):
+        "Append pending strings to CSR arrays and rebuild postings."
+        if self._pending:
+            sizes = [len(keys) for keys in self._pending]
+            ids = np.fromiter((k for keys in self._pending for k in keys), dtype = np.int64, count = sum(sizes))
+            self._kids = np.concatenate([self._kids, ids])
+            self._kptr = np.concatenate([self._kptr, self._kptr[-1] + np.cumsum(sizes, dtype = np.int64)])
+            added = self.strings[len(self._lengths):]
+            self._lengths = np.concatenate([self._lengths, [len(s) for s in added]]).astype(np.int64)
+            self._spaces = np.concatenate([self._spaces, [_count_spaces(s) for s in added]]).astype(np.int64)
+            self._pending = []
+        
+        owners = np.repeat(np.arange(len(self.strings)), np.diff(self._kptr))
+        order = np.argsort(self._kids, kind = 'stable')
+        self._pids = owners[order]
+        self._pptr = np.concatenate([[0], np.cumsum(np.bincount(self._kids, minlength = len(self._vocab)))])
+    
+    @staticmethod
+    def _gather(ptr, values, rows):
+        "Concatenation of values[ptr[r]:ptr[r+1]] for all r in 'rows', and their lengths."
+        starts, sizes = ptr[rows], ptr[rows + 1] - ptr[rows]
+        offsets = np.repeat(starts - np.cumsum(sizes) + sizes, sizes)
+        return values[offsets + np.arange(sizes.sum())], sizes
+    
+    def _max_edits(self, L, S, threshold):
+        """
+        Upper bound of the unit-cost edit distance of lowercase strings a, b, when levenscore(a, b) >= threshold,
+        max(len(a),len(b)) = L and the total no. of whitespace characters in a and b is S. The weighted distance is
+        at most D = (1-threshold) * L, every edit costs at least 1, except for case changes (free in lowercase)
+        and edits of whitespace, which cost 'spacecost' and consume at least one of the S whitespace characters.
+        """
+        D = (1 - threshold) * L + 1e-9
+        sc = self.spacecost
+        if sc >= 1: return D
+        if sc <= 0: return D + S
+        return D + (1 - sc) * np.minimum(S, D / sc)
+    
+    def candidates(self, s, threshold, start = 0):
+        "Ids (>= start) of indexed strings that pass the length and N-gram count filters for levenscore(s, ...) >= threshold."
+        if self._pptr is None: self._build()
+        N = self.N
+        r = 1 - threshold
+        lq, sq = len(s), _count_spaces(s)
+        S = sq + (self._spaces.max() if len(self._spaces) else 0)               # upper bound of whitespace in a pair
+        lo = lq - self._max_edits(lq, S, threshold)
+        hi = (lq + (1 - min(1, self.spacecost)) * S) / (1 - r) + 1e-9 if r < 1 else float('inf')
+        
+        keys = np.array(self._encode(s), dtype = np.int64)
+        total = lq + N - 1 if lq else 0                                         # no. of N-grams of 's', including unknown
+        
+        # min. no. of shared N-grams for all candidates; L - N*max_edits(L) is convex and piecewise linear in L,
+        # so its minimum lies at an end of the range of L, or at the breakpoint of max_edits()
+        lmax = min(hi, self._lengths.max() if len(self._lengths) else lq)
+        points = [lq, max(lq, lmax)]
+        if 0 < self.spacecost < 1 and r > 0: points.append(min(max(lq, S * self.spacecost / r), points[1]))
+        tmin = int(np.ceil(min(L + N - 1 - N * self._max_edits(L, S, threshold) for L in points)))
+        
+        scan = tmin <= 0 or not total                                            # no filtering possible: scan all strings of allowed lengths
+        if scan:
+            cands = np.flatnonzero((self._lengths >= lo) & (self._lengths <= hi))
+        else:
+            probe = (total - tmin + 1) - (total - len(keys))                    # unknown N-grams are the rarest, but yield no candidates
+            if probe <= 0 or not len(keys): return np.zeros(0, dtype = np.int64)
+            df = self._pptr[keys + 1] - self._pptr[keys]
+            rare = keys[np.argsort(df, kind = 'stable')[:probe]]
+            cands, hits = np.unique(self._gather(self._pptr, self._pids, rare)[0], return_counts = True)
+            rest = len(keys) - len(rare)                                        # no. of N-grams of 's' not probed
+        
+        # exact length filter for each candidate, and a count filter with shared N-grams counted among the probed ones only
+        lengths = self._lengths[cands]
+        L = np.maximum(lengths, lq)
+        K = np.floor(self._max_edits(L, sq + self._spaces[cands], threshold))
+        required = L + N - 1 - N * K
+        ok = (cands >= start) & (np.abs(lengths - lq) <= K)
+        if not scan: ok &= hits + rest >= required
+        cands, required = cands[ok], required[ok]
+        if not len(cands) or scan: return cands
+        
+        # count filter: no. of shared N-grams (with multiplicities) of each candidate
+        grams, sizes = self._gather(self._kptr, self._kids, cands)
+        hits = np.isin(grams, keys).astype(np.int64)
+        shared = np.add.reduceat(hits, np.cumsum(sizes) - sizes) if len(hits) else np.zeros(len(cands), np.int64)
+        shared[sizes == 0] = 0
+        return cands[shared >= required]
+    
+    def _scores(self, s, cands, threshold):
+        strings, casecost, spacecost = self.strings, self.casecost, self.spacecost
+        result = []
+        for j in cands.tolist():
+            score = levenscore(s, strings[j], casecost, spacecost, min_score = threshold)
+            if score >= threshold: result.append((j, score))
+        return result
+    
+    def query(self, s, k = 10, threshold = 0.5):
+        """
+        Find up to 'k' indexed strings most similar to 's', with levenscore() >= threshold.
+        's' can be a string or a list of strings. Returns a list of triples (i, j, score), sorted by decreasing score
+        for each i, where i is the position of the query string on the list (0 for a single string),
+        and j is the id of the indexed string.
+        """
+        queries = [s] if isstring(s) else s
+        result = []
+        for i, q in enumerate(queries):
+            matches = self._scores(q, self.candidates(q, threshold), threshold)
+            matches.sort(key = lambda m: (-m[1], m[0]))
+            result += [(i, j, score) for j, score in matches[:k]]
+        return result
+    
+    def self_join(self, threshold = 0.8, jobs = 1):
+        """
+        Find all pairs of indexed strings with levenscore() >= threshold. Returns a list of triples (i, j, score), i < j,
+        sorted by (i, j). With jobs > 1, the work is split between this many worker processes.
+        """
+        if self._pptr is None: self._build()
+        n = len(self.strings)
+        if jobs <= 1 or n < 2 * jobs:
+            return _fuzzy_join(self, 0, n, threshold)
+        
+        bounds = np.linspace(0, n, 4 * jobs + 1).astype(int)
+        tasks = [(int(a), int(b), threshold) for a, b in zip(bounds[:-1], bounds[1:])]
+        pool = multiprocessing.Pool(jobs, initializer = _fuzzy_init, initargs = (self,))
+        try:
+            parts = pool.map(_fuzzy_join_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        return [pair for part in parts for pair in part]
+
+_fuzzy_index = None                                 # FuzzyIndex instance in a worker process of FuzzyIndex.self_join()
+
+def _fuzzy_init(index):
+    global _fuzzy_index
+    _fuzzy_index = index
+
+def _fuzzy_join_task(task):
+    return _fuzzy_join(_fuzzy_index, *task)
+
+def _fuzzy_join(index, start, stop, threshold):
+    "Pairs (i, j, score) of FuzzyIndex.self_join() for i in [start, stop)."
+    result = []
+    for i in xrange(start, stop):
+        s = index.strings[i]
+        matches = index._scores(s, index.candidates(s, threshold, start = i + 1), threshold)
+        result += [(i, j, score) for j, score in sorted(matches)]
+    return result
 
 
 #########################################################################################################################################################
@@ -653,7 +978,7 @@ class WordsModelUnderTraining(WordsModel):
         # transform counts into real-valued weights
         weights = {}
         #delta = self.nDocs / 100.0     # with this delta, weights will range between 1.0 and <100.0
-        for word, count in self.counts.iteritems():
+        for word, count in self.counts.items():
             # for efficiency ignore rare terms (lots of them! ~60% in long texts)
             # - they'll have a default weight assigned anyway
             if count > 1:
@@ -692,14 +1017,14 @@ class WordsModelUnderTraining(WordsModel):
             if self.isTraining:
                 model.addDoc(vec.keys())
                 return vec  # no need for further processing of 'vec' when training
-            for word in vec.iterkeys():
+            for word in list(vec.keys()):
                 vec[word] *= model.get(word)
             return vec
 
         def cosine(v1, v2):
             "Both v1 and v2 are variable-length dictionaries of tf-idf frequencies"
             dot = norm1 = norm2 = 0.0
-            for word in set(v1.keys() + v2.keys()):
+            for word in set(v1) | set(v2):
                 f1 = v1.get(word, 0.0)
                 f2 = v2.get(word, 0.0)
                 dot += f1 * f2
@@ -730,6 +1055,169 @@ class WordsModelUnderTraining(WordsModel):
         return bound(cosine(v1, v2) / scale * longEnough)
 
 
+class TfidfModel(object):
+    """
+    A bag-of-words model of a corpus with TF-IDF weights, like WordsModel, but vectorized: documents are rows
+    of a sparse CSR matrix (scipy.sparse) over a vocabulary built during training, so that cosine similarity of a document
+    to all documents of the corpus is computed with a single sparse matrix-vector product in most_similar().
+    Training is incremental: new documents can be added with add() at any time, also after querying.
+    Term frequency is the raw count of a word in a document, and IDF of a word is log(nDocs / df),
+    where df is the no. of documents containing the word, like in WordsModelUnderTraining; words unknown to the model
+    get the IDF of a word that occurs in a single document.
+    A document is a string of space-separated words or a list of words (tokenize() the texts before if needed).
+    
+    >>> model = TfidfModel(["red apple", "green apple", "red car", "fast red car", "green pear"])
+    >>> [(i, round(score, 3)) for i, score in model.most_similar("red car wash", k = 2)]
+    [(2, 0.546), (3, 0.298)]
+    >>> model.add("red apple pie")
+    5
+    >>> model.nDocs, round(model.similarity("red apple", "apple pie"), 3)
+    (6, 0.311)
+    """
+    
+    def __init__(self, docs = ()):
+        self.vocab = {}                         # word -> column no. in the matrix
+        self.words = []                         # column no. -> word
+        self.nDocs = 0
+        self.counts = sparse.csr_matrix((0, 0), dtype = np.float64)         # raw term counts of documents added so far, (nDocs x len(vocab))
+        self.df = np.zeros(0)                   # no. of documents containing a given word
+        self._pending = []                      # (columns, counts) of documents not yet appended to self.counts
+        self._tfidf = None                      # cached L2-normalized TF-IDF matrix, or None if outdated
+        self.extend(docs)
+    
+    def _terms(self, doc, add = False):
+        "Columns and counts of words in 'doc'; words missing in the vocabulary are added (add=True) or counted separately."
+        words = doc if isinstance(doc, list) else doc.split()
+        freq = defaultdict(int)
+        for w in words: freq[w] += 1
+        cols, counts, unknown = [], [], []
+        for w, c in freq.items():
+            col = self.vocab.get(w)
+            if col is None:
+                if not add:
+                    unknown.append(c)
+                    continue
+                col = self.vocab[w] = len(self.words)
+                self.words.append(w)
+            cols.append(col)
+            counts.append(c)
+        return np.array(cols, dtype = np.int64), np.array(counts, dtype = np.float64), unknown
+    
+    def add(self, doc):
+        "Train the model on a new document. Returns its no. in the corpus."
+        cols, counts, _ = self._terms(doc, add = True)
+        self._pending.append((cols, counts))
+        self._tfidf = None
+        self.nDocs += 1
+        return self.nDocs - 1
+    
+    def extend(self, docs):
+        for doc in docs: self.add(doc)
+    
+    def _build(self):
+        "Append pending documents to the counts matrix and update document frequencies."
+        if not self._pending: return
+        V = len(self.words)
+        sizes = [len(cols) for cols, _ in self._pending]
+        indptr = np.concatenate([[0], np.cumsum(sizes)])
+        indices = np.concatenate([cols for cols, _ in self._pending])
+        data = np.concatenate([counts for _, counts in self._pending])
+        new = sparse.csr_matrix((data, indices, indptr), shape = (len(self._pending), V))
+        
+        old = self.counts
+        old.resize((old.shape[0], V))                                       # new words in the vocabulary
+        self.counts = sparse.vstack([old, new], format = 'csr')
+        self.df = np.concatenate([self.df, np.zeros(V - len(self.df))]) + np.bincount(indices, minlength = V)
+        self._pending = []
+    
+    def idf(self):
+        "IDF weights of all words in the vocabulary."
+        self._build()
+        return np.log(self.nDocs / np.maximum(self.df, 1))
+    
+    def tfidf(self):
+        "Sparse matrix of L2-normalized TF-IDF vectors of all documents, (nDocs x len(vocab)). Cached until new documents are added."
+        if self._tfidf is None:
+            M = sparse.csr_matrix(self.counts_matrix().multiply(self.idf()))
+            norms = np.sqrt(np.asarray(M.multiply(M).sum(axis = 1)).ravel())
+            norms[norms == 0] = 1
+            self._tfidf = sparse.csr_matrix(M.multiply(1 / norms[:, None]))
+        return self._tfidf
+    
+    def counts_matrix(self):
+        self._build()
+        return self.counts
+    
+    def vectorize(self, doc):
+        """
+        L2-normalized TF-IDF vector of 'doc', as a 1 x len(vocab) sparse matrix. Unknown words, though not included
+        in the vector, contribute to its norm, so that the vector's length is the same as if they were present.
+        """
+        cols, counts, unknown = self._terms(doc)
+        idf = self.idf()
+        weights = counts * idf[cols]
+        norm2 = (weights ** 2).sum() + sum((c * math.log(max(self.nDocs, 1))) ** 2 for c in unknown)
+        if norm2 > 0: weights /= np.sqrt(norm2)
+        return sparse.csr_matrix((weights, cols, [0, len(cols)]), shape = (1, len(self.words)))
+    
+    def similarity(self, doc1, doc2):
+        "Cosine similarity of TF-IDF vectors of two documents."
+        return float(self.vectorize(doc1).multiply(self.vectorize(doc2)).sum())
+    
+    def most_similar(self, doc, k = 10):
+        """
+        Find up to 'k' documents of the corpus most similar to 'doc' by cosine similarity of their TF-IDF vectors.
+        Returns a list of pairs (document no., similarity), in decreasing order of similarity; documents with no common
+        words (zero similarity) are never returned.
+        """
+        M = self.tfidf()
+        q = self.vectorize(doc)
+        dense = np.zeros(M.shape[1])
+        dense[q.indices] = q.data
+        scores = M.dot(dense)
+        top = np.flatnonzero(scores > 0)
+        if len(top) > k:
+            top = top[np.argpartition(-scores[top], k - 1)[:k]]
+        top = top[np.lexsort((top, -scores[top]))]
+        return [(int(i), float(scores[i])) for i in top]
+    
+    def save(self, path):
+        """
+        Save the model to a directory 'path': sparse matrices as .npy files of their CSR arrays (data, indices, indptr),
+        and the vocabulary in a JSON file. The model can be loaded with TfidfModel.load(), possibly memory-mapped.
+        """
+        if not os.path.exists(path): os.makedirs(path)
+        for name, M in [('counts', self.counts_matrix()), ('tfidf', self.tfidf())]:
+            for attr in ('data', 'indices', 'indptr'):
+                np.save(os.path.join(path, '%s.%s.npy' % (name, attr)), getattr(M, attr))
+        np.save(os.path.join(path, 'df.npy'), self.df)
+        with open(os.path.join(path, 'model.json'), 'wt') as f:
+            json.dump({'nDocs': self.nDocs, 'words': self.words}, f)
+    
+    @staticmethod
+    def load(path, mmap_mode = None):
+        """
+        Load a model saved with save(). With 'mmap_mode' ('r', 'c', see np.load()) the matrices are not read into memory,
+        but memory-mapped from files instead, so a large model is opened instantly and shared between processes.
+        Training can be continued afterwards: new documents are stored in memory.
+        """
+        with open(os.path.join(path, 'model.json'), 'rt') as f:
+            meta = json.load(f)
+        model = TfidfModel()
+        model.nDocs = meta['nDocs']
+        model.words = meta['words']
+        model.vocab = {w: i for i, w in enumerate(model.words)}
+        model.df = np.load(os.path.join(path, 'df.npy'))
+        
+        shape = (model.nDocs, len(model.words))
+        def load_csr(name):
+            arrays = [np.load(os.path.join(path, '%s.%s.npy' % (name, attr)), mmap_mode = mmap_mode) for attr in ('data', 'indices', 'indptr')]
+            return sparse.csr_matrix(tuple(arrays), shape = shape, copy = False)
+        model.counts = load_csr('counts')
+        model._tfidf = load_csr('tfidf')
+        return model
+
+
 #########################################################################################################################################################
 ###
 ###  TEXT class for language control
@@ -1014,5 +1502,42 @@ def HyML(text, settings = None): return Text(text, "HyML", settings)
 #########################################################################################################################################################
 
 if __name__ == "__main__":
-    import doctest
+    import sys, doctest, random
+    from timeit import timeit
+    
+    def bench_fuzzy_index(n = 10**6, queries = 1000, join = 10**5, threshold = 0.85, jobs = multiprocessing.cpu_count()):
+        "FuzzyIndex on a corpus of 'n' random names, half of them being copies of the others with a typo."
+        rand = random.Random(0)
+        syllables = [c + v for c in 'bcdfghjklmnprstvwz' for v in 'aeiouy'] + ['ski', 'son', 'sen', 'berg', 'stein', 'man']
+        def name(): return ' '.join(''.join(rand.choice(syllables) for _ in range(rand.randint(2, 4))).title() for _ in range(2))
+        def typo(s):
+            pos = rand.randrange(len(s))
+            return s[:pos] + rand.choice('aeiouxz') + s[pos+1:]
+        
+        names = [name() for _ in range(n // 2)]
+        names += [typo(rand.choice(names)) for _ in range(n - len(names))]
+        rand.shuffle(names)
+        probes = [typo(rand.choice(names)) for _ in range(queries)]
+        
+        def build(strings):
+            index = FuzzyIndex(strings)
+            index._build()
+            indexes.append(index)
+        indexes = []
+        
+        print("FuzzyIndex, %d strings:  build %.1fs" % (n, timeit(lambda: build(names), number = 1)))
+        index = indexes.pop()
+        t = timeit(lambda: index.query(probes, k = 5, threshold = threshold), number = 1)
+        t0 = timeit(lambda: [levenscore(probes[0], s, min_score = threshold) for s in names[:10000]], number = 1) * n / 10000.
+        print("  query():     %.2f ms per query   (brute force with levenscore: %.0f ms)" % (t / queries * 1000, t0 * 1000))
+        
+        build(names[:join])
+        index = indexes.pop()
+        pairs = []
+        t = timeit(lambda: pairs.extend(index.self_join(threshold, jobs = jobs)), number = 1)
+        print("  self_join(): %d strings, %d pairs, %.1fs with %d jobs" % (join, len(pairs), t, jobs))
+    
     print(doctest.testmod())
+    
+    if 'bench' in sys.argv[1:]:
+        bench_fuzzy_index()
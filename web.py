@@ -16,12 +16,16 @@ You should have received a copy of the GNU General Public License along with Nif
 '''
 
 from __future__ import absolute_import
-import os, sys, subprocess, threading
+import os, sys, threading, sqlite3, hashlib, atexit, weakref
 #os.environ['http_proxy'] = ''                       # to fix urllib2 problem:  urllib2.URLError: <urlopen error [Errno -2] Name or service not known> 
 
-import urllib2, urlparse, random, time, socket, json, re
-from collections import namedtuple, deque
-from copy import deepcopy
+import urllib2, urlparse, httplib, random, time, socket, json, re, zlib, math, struct
+from collections import namedtuple, deque, OrderedDict
+from heapq import heappush, heappop
+from Queue import Queue, Full
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+from copy import copy, deepcopy
 from datetime import datetime
 from urllib2 import HTTPError, URLError
 from cookielib import CookieJar
@@ -29,11 +33,11 @@ from socket import timeout as Timeout
 #from lxml.html.clean import Cleaner        -- might be good for HTML sanitization (no scritps, styles, frames, ...), but not for general HTML tag filering 
 
 if __name__ != "__main__":
-    from .util import islinux, isint, islist, isnumber, isstring, JsonDict, mnoise, unique, classname, noLogger, defaultLogger, Object
+    from .util import isint, islist, isnumber, isstring, mnoise, unique, classname, noLogger, defaultLogger, Object
     from .text import regex, xbasestring, HTML, Plain
     from . import util
 else:
-    from nifty.util import islinux, isint, islist, isnumber, isstring, JsonDict, mnoise, unique, classname, noLogger, defaultLogger, Object
+    from nifty.util import isint, islist, isnumber, isstring, mnoise, unique, classname, noLogger, defaultLogger, Object
     from nifty.text import regex, xbasestring, HTML, Plain
     from nifty import util
     
@@ -118,10 +122,13 @@ def striptags(html, norm = True):
 
 ###  Other  ###
 
-def readsocket(sock):
+def readsocket(sock, limit = None):
     """Reads ALL contents from the socket. Workaround for the known problem of library sockets (also in urllib2): 
     that read() may sometimes return only a part of the contents and it must be called again and again, until empty result, to read everything. 
-    Should always be used in place of .read(). Closes the socket at the end."""
+    Should always be used in place of .read(). Closes the socket at the end.
+    If 'limit' is given and the contents are longer than 'limit' bytes, the socket is closed and Exception raised, after reading at most limit+1 bytes."""
+    if limit is not None:
+        return ''.join(readchunks(sock, limit = limit))
     content = []
     while True:
         cont = sock.read()
@@ -129,6 +136,22 @@ def readsocket(sock):
         else: 
             sock.close()
             return ''.join(content)
+
+def readchunks(sock, size = 2**16, limit = None):
+    """Generator of consecutive chunks of contents of the socket, up to 'size' bytes each. The next chunk is read only when requested,
+    so memory use is bounded by 'size' no matter how long the contents are. Closes the socket at the end, or when the generator is closed.
+    If more than 'limit' bytes are received, Exception is raised."""
+    total = 0
+    try:
+        while True:
+            chunk = sock.read(size)
+            if not chunk: break
+            total += len(chunk)
+            if limit is not None and total > limit:
+                raise Exception("readchunks(), the contents exceed the limit of %d bytes" % limit)
+            yield chunk
+    finally:
+        sock.close()
         
 
 # list from: http://techblog.willshouse.com/2012/01/03/most-common-user-agents/
@@ -245,16 +268,29 @@ class Request(urllib2.Request):
     """ When setting headers (self.headers from base class), all keys are capitalized by urllib2 (!) to avoid duplicates.
     To assign individual items in the header, use add_header() instead of manual modification of self.headers!
     """
-    def __init__(self, url, data = None, headers = {}, timeout = None):
+    def __init__(self, url, data = None, headers = {}, timeout = None, stream = False):
+        "stream: if True, the client doesn't read the body of the response, it must be read by the caller: with Response.read(), chunks() or stream()"
         urllib2.Request.__init__(self, url = url, data = data, headers = headers)
         self.url = url
         self.timeout = timeout
+        self.stream = stream
+
+    def copy(self):
+        """Cheap copy of the request, for handlers that modify it on the way down the chain (headers, url, timeout) while the original
+        must stay intact, e.g., to be sent again by a retry handler. Only header dicts are copied, all other values (including the body,
+        possibly large) are immutable and shared with the original; use add_header() or assignment on the copy, never modify values in place."""
+        dup = copy(self)
+        dup.headers = self.headers.copy()
+        dup.unredirected_hdrs = self.unredirected_hdrs.copy()
+        return dup
 
 class Response():
 
     redirect = url = request = info = headers = status = time = None
     content = None                                      # string with all contents of the page, loaded in a lazy way: on explicit client's request
     fromCache = False
+    resp = None                                         # original urllib (or other file-like) response, the source of the body
+    size = digest = None                                # no. of bytes and hex digest of the body, set by stream()
     
     def __init__(self, resp = None, url = None, read = True):
         "resp: open file (socket) returned by urllib2 (type: urllib2.addinfourl) or None. url: optionally the original URL of the request (before any redirection)"
@@ -278,10 +314,64 @@ class Response():
             else: setattr(dup, key, deepcopy(val, memo))
         return dup    
     
-    def read(self):
+    def read(self, limit = None):
+        "Load all the body into self.content and return; Exception if longer than 'limit' bytes."
         if self.content is None and self.resp: 
-            self.content = readsocket(self.resp)        # the socket is closed afterwards, by readsocket()
+            self.content = readsocket(self.resp, limit) # the socket is closed afterwards, by readsocket()
         return self.content
+    
+    def chunks(self, size = 2**16, limit = None, decompress = False):
+        """Generator of consecutive chunks of the body, up to 'size' bytes each, read from the socket only when requested; 
+        or from self.content if the body has been read already. The body is not kept in memory.
+        Raise Exception if the body is longer than 'limit' bytes: beforehand, if Content-Length says so, or when the limit is crossed.
+        decompress: if True, gzip/deflate Content-Encoding is decoded on the fly (then 'limit' applies to the decoded body)."""
+        if self.content is not None:
+            if limit is not None and len(self.content) > limit: raise Exception("Response, the body exceeds the limit of %d bytes" % limit)
+            source = (self.content[i:i+size] for i in xrange(0, len(self.content), size))
+        elif self.resp:
+            length = (self.headers or {}).get('content-length', '')
+            if limit is not None and length.isdigit() and int(length) > limit:
+                self.resp.close()
+                raise Exception("Response, Content-Length %s exceeds the limit of %d bytes" % (length, limit))
+            source = readchunks(self.resp, size, None if decompress else limit)
+        else: return
+        
+        encoding = (self.headers or {}).get('content-encoding', '').strip().lower() if decompress else None
+        if encoding not in ('gzip', 'deflate'):
+            for chunk in source: yield chunk
+            return
+        decoder = None
+        total = 0
+        for chunk in source:
+            if decoder is None: decoder = _decompressobj(encoding, chunk)
+            chunk = decoder.decompress(chunk)
+            total += len(chunk)
+            if limit is not None and total > limit:
+                source.close()
+                raise Exception("Response, the decompressed body exceeds the limit of %d bytes" % limit)
+            if chunk: yield chunk
+        if decoder: yield decoder.flush()
+    
+    def stream(self, sink, size = 2**16, limit = None, hash = None, decompress = False):
+        """Pass the body, chunk by chunk, to 'sink': a function or an object with write() method, like a file opened in binary mode.
+        Backpressure: the next chunk is read from the socket only after the sink consumed the previous one, so memory use
+        is bounded by 'size' no matter how long the body is. 'limit' and 'decompress' as in chunks().
+        hash: name of a hashlib algorithm, e.g. 'sha256', to compute digest of the body on the fly (saved in self.digest).
+        Returns the no. of bytes passed to the sink (also saved in self.size)."""
+        write = sink.write if hasattr(sink, 'write') else sink
+        hasher = hashlib.new(hash) if hash else None
+        total = 0
+        for chunk in self.chunks(size, limit, decompress):
+            if hasher: hasher.update(chunk)
+            write(chunk)
+            total += len(chunk)
+        self.size = total
+        if hasher: self.digest = hasher.hexdigest()
+        return total
+    
+    def close(self):
+        "Close the body without reading it. A streamed response that won't be read to the end should be closed, to free its connection."
+        if self.resp: self.resp.close()
             
 class WebHandler(Object):
     """ Base class for handlers of web requests & responses, which handle different atomic aspects of web access.
@@ -368,6 +458,7 @@ class StandardClient(WebHandler):
             else:
                 stream = self.opener.open(req)
         except HTTPError, e:
+            if e.code == 304: return Response(e, req.url, read = not req.stream)     # Not Modified, in reply to a conditional request: not an error
             e.msg += ", " + req.url
             raise
         try:
@@ -376,23 +467,261 @@ class StandardClient(WebHandler):
             self.cj.clear()
         except KeyError:
             pass  # if there was no cookie, KeyError is risen, skip
-        return Response(stream, req.url)
-    
+        return Response(stream, req.url, read = not req.stream)
+
+
+class ConnectionPool(object):
+    """Per-host pools of open HTTP(S) connections, kept alive and reused by subsequent requests to the same host,
+    to avoid TCP (and TLS) handshake on every request. Thread-safe. At most 'maxPerHost' connections to a given host
+    can be in use at the same time: acquire() waits until one is released, but no longer than 'waitTimeout' seconds, then URLError is raised.
+    A connection stays in use until the response body is read to the end or closed, so streamed responses must be read or closed
+    (unreferenced ones are closed when garbage-collected). Idle connections are closed after 'idleTimeout' seconds.
+    """
+    def __init__(self, maxPerHost = 8, idleTimeout = 60, waitTimeout = 60):
+        self.maxPerHost = maxPerHost
+        self.idleTimeout = idleTimeout
+        self.waitTimeout = waitTimeout
+        self.idle = {}                      # (scheme, host) -> list of (connection, time of release), most recently released last
+        self.inuse = {}                     # (scheme, host) -> no. of connections in use; hosts with none in use are missing
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        self.opened = self.reused = 0       # statistics: no. of connections opened, no. of times an idle connection was reused
+
+    def acquire(self, scheme, host, timeout = None):
+        "Return (connection, reused): an idle connection to scheme://host if available, or a new one otherwise. Must be followed by release()."
+        key = (scheme, host)
+        with self.lock:
+            deadline = now() + self.waitTimeout
+            while self.inuse.get(key, 0) >= self.maxPerHost:
+                remaining = deadline - now()
+                if remaining <= 0: raise URLError("ConnectionPool, no free connection to %s://%s after %s seconds" % (scheme, host, self.waitTimeout))
+                self.released.wait(remaining)
+            self.inuse[key] = self.inuse.get(key, 0) + 1
+            idle = self.idle.get(key)
+            while idle:
+                conn, released = idle.pop()
+                if now() - released > self.idleTimeout:
+                    conn.close()
+                    continue
+                self.reused += 1
+                conn.timeout = timeout or socket._GLOBAL_DEFAULT_TIMEOUT
+                if conn.sock: conn.sock.settimeout(timeout)
+                return conn, True
+            self.opened += 1
+        cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        return cls(host, timeout = timeout or socket._GLOBAL_DEFAULT_TIMEOUT), False
+
+    def release(self, conn, scheme, host, reuse = True):
+        "Return a connection acquired before; if reuse=False, or the connection was closed, it's closed and dropped rather than kept alive."
+        key = (scheme, host)
+        if not (reuse and conn.sock): conn.close()
+        with self.lock:
+            if reuse and conn.sock: self.idle.setdefault(key, []).append((conn, now()))
+            count = self.inuse.pop(key) - 1
+            if count: self.inuse[key] = count
+            self.released.notify_all()                  # waiters of all hosts share the condition
+
+    def clear(self):
+        "Close all idle connections."
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, _ in conns: conn.close()
+
+def _decompressobj(encoding, head):
+    "zlib decompressor for a body with Content-Encoding 'gzip' or 'deflate', given the first bytes of the body ('head')."
+    if encoding == 'gzip': wbits = 16 + zlib.MAX_WBITS
+    else:                                                               # 'deflate' is sent by some servers with zlib header, by others as raw stream
+        zheader = len(head) >= 2 and (ord(head[0]) & 0x0F) == 8 and (ord(head[0]) * 256 + ord(head[1])) % 31 == 0
+        wbits = zlib.MAX_WBITS if zheader else -zlib.MAX_WBITS
+    return zlib.decompressobj(wbits)
+
+class _PooledStream(object):
+    """File-like body of a response received by PooledClient. Decodes gzip/deflate content on the fly and gives the connection back
+    to the pool as soon as the body has been read to the end; if closed earlier, or garbage-collected unread, the connection is dropped."""
+
+    def __init__(self, resp, release, encoding = None):
+        self.resp = resp
+        self.release = release              # function(reuse) to be called once, when the body is done
+        self.encoding = encoding
+        self.decoder = None
+
+    def read(self, size = -1):
+        "Read up to 'size' bytes of the (decoded) body, or all remaining bytes if size < 0. Empty string only at the end of the body."
+        chunks = []
+        while self.resp:
+            try: data = self.resp.read() if size < 0 else self.resp.read(size)
+            except:
+                self.close()                                                    # broken connection (e.g., timeout) is dropped, not reused
+                raise
+            if not data:
+                if self.decoder: chunks.append(self.decoder.flush())
+                self._done(not self.resp.will_close)
+                break
+            chunks.append(self._decode(data) if self.encoding else data)
+            if size >= 0 and chunks[-1]: break
+        return ''.join(chunks)
+
+    def _decode(self, data):
+        if self.decoder is None: self.decoder = _decompressobj(self.encoding, data)
+        return self.decoder.decompress(data)
+
+    def _done(self, reuse):
+        self.resp = None
+        self.release(reuse)
+
+    def close(self):
+        if self.resp:
+            self.resp.close()
+            self._done(False)
+
+    def __del__(self):
+        try: self.close()
+        except Exception: pass                                                  # may fail at interpreter shutdown
+
+class _PooledResponse(object):
+    "Minimal urllib2-like response object (geturl, info, getcode, read, close), as required by Response and cookielib."
+    def __init__(self, url, status, msg, info, stream):
+        self.url, self.status, self.msg, self._info, self.stream = url, status, msg, info, stream
+        self.read, self.close = stream.read, stream.close
+    def geturl(self):   return self.url
+    def info(self):     return self._info
+    def getcode(self):  return self.status
+
+class PooledClient(WebHandler):
+    """Returns a web page like StandardClient, but through persistent (keep-alive) connections taken from a ConnectionPool,
+    which are reused by subsequent requests to the same host, also from different threads; see ConnectionPool for limits.
+    Follows redirects, raises HTTPError on 4xx/5xx statuses and URLError on connection errors, like urllib2.
+    If 'decode' is True, asks servers for gzip/deflate compression and decodes the content transparently.
+    If 'cj' (CookieJar) is given, cookies are handled, and cleared after every request like in StandardClient.
+    No support for proxies: use StandardClient in such case.
+    """
+    __shared__ = 'pool'                     # copies of the client share the same pool
+
+    REDIRECTS = (301, 302, 303, 307, 308)
+
+    def __init__(self, cj = None, pool = None, decode = True, maxRedirects = 10):
+        self.cj = cj
+        self.pool = pool or ConnectionPool()
+        self.decode = decode
+        self.maxRedirects = maxRedirects
+
+    def handle(self, req):
+        assert isinstance(req, Request)
+        self.log.info("PooledClient, downloading", req.url)
+        url, data = req.url, req.get_data()
+        headers = dict(req.header_items())
+        if self.decode and 'Accept-encoding' not in headers: headers['Accept-encoding'] = 'gzip, deflate'
+
+        for _ in range(self.maxRedirects + 1):
+            hop = urllib2.Request(url, data, headers)
+            if self.cj is not None: self.cj.add_cookie_header(hop)
+            resp = self._send(hop, req.timeout)
+            if self.cj is not None: self.cj.extract_cookies(resp, hop)
+
+            location = resp.info().getheader('location')
+            if resp.status not in self.REDIRECTS or not location: break
+            resp.read()                                                         # read till the end, so that the connection can be reused
+            url = urlparse.urljoin(url, location)
+            if resp.status in (301, 302, 303) and data is not None:            # like in browsers and urllib2, POST becomes GET
+                data = None
+                headers = dict((k, v) for k, v in headers.items() if k not in ('Content-type', 'Content-length'))
+        else:
+            raise HTTPError(url, resp.status, "Too many redirects, the last one: %s, %s" % (resp.msg, req.url), resp.info(), StringIO(resp.read()))
+
+        if self.cj is not None:
+            try: self.cj.clear()
+            except KeyError: pass
+
+        if resp.status >= 400:
+            raise HTTPError(url, resp.status, "%s, %s" % (resp.msg, req.url), resp.info(), StringIO(resp.read()))
+        return Response(resp, req.url, read = not req.stream)
+
+    def _send(self, req, timeout):
+        "Send a single request through a pooled connection and return _PooledResponse with unread body."
+        parts = urlparse.urlsplit(req.get_full_url())
+        scheme, host = parts.scheme, parts.netloc
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        data = req.get_data()
+
+        for attempt in (1, 2):
+            conn, reused = self.pool.acquire(scheme, host, timeout)
+            try:
+                conn.request(req.get_method(), path, data, dict(req.header_items()))
+                resp = conn.getresponse(buffering = True)          # buffered reading of headers, like in urllib2; otherwise, 1 recv() per byte
+                break
+            except (httplib.HTTPException, socket.error), e:
+                self.pool.release(conn, scheme, host, reuse = False)
+                if reused and attempt == 1: continue                            # keep-alive connection was closed by the server; retry on a new one
+                if isinstance(e, socket.error): raise URLError(e)
+                raise
+
+        release = lambda reuse: self.pool.release(conn, scheme, host, reuse)
+        info = resp.msg
+        encoding = (info.getheader('content-encoding') or '').strip().lower() if self.decode else None
+        if encoding in ('gzip', 'deflate'):
+            del info['content-encoding']                                        # headers must describe the decoded content
+            if 'content-length' in info: del info['content-length']
+        else:
+            encoding = None
+        return _PooledResponse(req.get_full_url(), resp.status, resp.reason, info, _PooledStream(resp, release, encoding))
+
+
 class FixURL(WebHandler):
     def handle(self, req):
         req.url = fix_url(req.url)
         return self.next.handle(req)
 
 class Delay(WebHandler):
-    "Delays web requests so that they are separated by at least 'delay' seconds (but possibly no more than this); 'delay' is slightly randomly disturbed each time"
+    """Delays web requests so that they are separated by at least 'delay' seconds (but possibly no more than this); 'delay' is slightly randomly disturbed each time.
+    The delay is global, for all hosts; see RateLimit for per-host delays. Thread-safe: concurrent requests are delayed one after another."""
+    __shared__ = 'lock'
+    
     def __init__(self, delay = 1.5):
         self.last = now() - delay
         self.delay = delay
+        self.lock = threading.Lock()
     def handle(self, req):
         delay = self.delay * (random.random()/5 + 0.9)
-        t = delay - (now() - self.last)
+        with self.lock:                                                     # reserve a time slot for this request, then sleep outside the lock
+            start = max(now(), self.last + delay)
+            self.last = start
+        t = start - now()
+        if t > 0: time.sleep(t)
+        return self.next.handle(req)
+
+class RateLimit(WebHandler):
+    """Per-host rate limiting with a token bucket: requests to the same host are separated by 'delay' seconds on average
+    (slightly randomly disturbed, like in Delay), with bursts of up to 'burst' requests after a period of inactivity.
+    Requests to different hosts don't delay each other, so in concurrent mode (WebClient.get_many) many hosts can be accessed in parallel.
+    Thread-safe: concurrent requests to the same host reserve consecutive time slots and sleep outside the lock.
+    """
+    __shared__ = 'lock'
+    MAX_HOSTS = 10000                       # when more hosts are tracked, buckets that are full again get dropped
+    
+    def __init__(self, delay = 1.5, burst = 1):
+        self.delay = delay
+        self.burst = burst
+        self.buckets = {}                   # host -> (no. of tokens, time of last update); tokens < 0 mean slots reserved by waiting requests
+        self.lock = threading.Lock()
+    
+    def wait(self, host):
+        "Reserve a token for a request to 'host' and return how long (in seconds) the request must wait for it."
+        t = now()
+        with self.lock:
+            tokens, last = self.buckets.get(host, (self.burst, t))
+            tokens = min(self.burst, tokens + (t - last) / self.delay) - 1
+            self.buckets[host] = (tokens, t)
+            if len(self.buckets) > self.MAX_HOSTS: self._prune(t)
+        return -tokens * self.delay * (random.random()/5 + 0.9) if tokens < 0 else 0
+    
+    def _prune(self, t):
+        self.buckets = dict((host, (tokens, last)) for host, (tokens, last) in self.buckets.iteritems() 
+                            if tokens + (t - last) / self.delay < self.burst)
+    
+    def handle(self, req):
+        t = self.wait(urlparse.urlsplit(req.url).netloc.lower())
         if t > 0: time.sleep(t)
-        self.last = now()
         return self.next.handle(req)
 
 class Timeout(WebHandler):
@@ -403,40 +732,107 @@ class Timeout(WebHandler):
         req.timeout = self.timeout
         return self.next.handle(req)
     
+def backoff(delay, attempt, factor = 2.0, maxdelay = 60, jitter = 0.5):
+    """Delay before the retry that follows a given no. of failed 'attempt's (>= 1): exponential backoff, 'delay' * 'factor'^(attempt-1)
+    capped at 'maxdelay' (if not None), randomly disturbed by up to +/- 'jitter' of its value, so that clients that failed together don't retry in lockstep."""
+    delay = delay * factor ** (attempt - 1)
+    if maxdelay is not None: delay = min(maxdelay, delay)
+    return delay * (1 + jitter * (2 * random.random() - 1))
+
+class RetryBudget(WebHandler):
+    """Per-host budget for retries, shared by all retry handlers that follow it in the chain (and by all threads and copies of WebClient):
+    every request that passes through deposits 'ratio' of a token on the account of its host, up to 'burst' tokens;
+    every retry withdraws 1 token, and is not allowed when less than 1 token is left. A host that keeps failing is retried
+    for at most 'ratio' of requests then, rather than having the load multiplied by retries of all requests (retry storm).
+    New hosts start with a full account, 'burst' tokens. Thread-safe.
+    """
+    __shared__ = 'lock accounts'
+    MAX_HOSTS = 10000                       # when more hosts are tracked, full accounts get dropped
+    
+    def __init__(self, ratio = 0.2, burst = 10):
+        self.ratio = ratio
+        self.burst = burst
+        self.accounts = {}                  # host -> no. of tokens; hosts with a full account may be missing
+        self.lock = threading.Lock()
+    
+    def deposit(self, host):
+        with self.lock:
+            tokens = self.accounts.get(host, self.burst) + self.ratio
+            if tokens < self.burst: self.accounts[host] = tokens
+            else: self.accounts.pop(host, None)
+    
+    def withdraw(self, host):
+        "Take 1 token for a retry of a request to 'host'. Return True if the retry is allowed, False if the budget of the host is exhausted."
+        with self.lock:
+            tokens = self.accounts.get(host, self.burst)
+            if tokens < 1: return False
+            self.accounts[host] = tokens - 1
+            if len(self.accounts) > self.MAX_HOSTS: self._prune()
+            return True
+    
+    def _prune(self):
+        full = [host for host, tokens in self.accounts.iteritems() if tokens >= self.burst - 1]
+        for host in full: del self.accounts[host]
+    
+    def handle(self, req):
+        self.deposit(urlparse.urlsplit(req.url).netloc.lower())
+        return self.next.handle(req)
+
 class RetryOnError(WebHandler):
     """In case of an exception of a given class retries the request a given number of times, only then forwards to the caller.
-    Default exception class: Exception. Default excludes: 'timeout', HTTPError 403 (Forbidden), HTTPError 404 (Not Found)"""
-    def __init__(self, attempts = 3, delay = 5, exception = Exception, exclude = [Timeout, 403, 404]):
+    Default exception class: Exception. Default excludes: 'timeout', HTTPError 403 (Forbidden), HTTPError 404 (Not Found).
+    Consecutive retries are separated by exponentially growing delays with random jitter, see backoff(). If 'budget' (RetryBudget) is given,
+    a retry is done only if the budget of the host allows, otherwise the exception is forwarded right away."""
+    def __init__(self, attempts = 3, delay = 5, exception = Exception, exclude = [Timeout, 403, 404], backoff = 2.0, maxdelay = 60, budget = None):
         self.attempts = attempts
         self.delay = delay
         self.exception = exception
         self.exclude = [cls for cls in exclude if not isint(cls)]
         self.excludeHTTP = [code for code in exclude if isint(code)]
+        self.backoff = backoff
+        self.maxdelay = maxdelay
+        self.budget = budget
+    def retry(self, req, e, attempt):
+        "Return delay before the next attempt after a given no. of failed attempts ending with exception 'e'; or None if the request shall not be retried."
+        if attempt > self.attempts: return None
+        for x in self.exclude:
+            if isinstance(e,x): return None
+        if isinstance(e, HTTPError):
+            if e.getcode() in self.excludeHTTP: return None
+        return backoff(self.delay, attempt, self.backoff, self.maxdelay)
     def handle(self, req):
-        for i in range(self.attempts + 1):
+        attempt = 0
+        while True:
             try:
-                _req = deepcopy(req)                    # we may need original 'req' again in the future, thus copying
-                return self.next.handle(_req)
+                attempt += 1
+                return self.next.handle(req.copy())     # we may need original 'req' again in the future, thus copying
             except self.exception, e:
-                for x in self.exclude:
-                    if isinstance(e,x): raise
-                if isinstance(e, HTTPError):
-                    if e.getcode() in self.excludeHTTP: raise
-                self.log.warning("%s, attempt #%d, %s trying again... Caught '%s'" % (classname(self,False), i+1, req.url, e))
-                time.sleep(self.delay * mnoise(1.1))
-        return self.next.handle(req)
+                delay = self.retry(req, e, attempt)
+                if delay is None: raise
+                if self.budget and not self.budget.withdraw(urlparse.urlsplit(req.url).netloc.lower()):
+                    self.log.warning("%s, attempt #%d, %s retry budget exhausted, not trying again. Caught '%s'" % (classname(self,False), attempt, req.url, e))
+                    raise
+                self.log.warning("%s, attempt #%d, %s trying again after %.1f seconds... Caught '%s'" % (classname(self,False), attempt, req.url, delay, e))
+                time.sleep(delay)
 
 class RetryOnTimeout(RetryOnError):
     """In case of timeout error, retry the request a given number of times, only then forward Timeout exception to the caller. 
     Only for response timeout (!), NOT for connection opening timeout (that's a different class: URLError 'timed out' not Timeout)."""
-    def __init__(self, attempts = 3, delay = 5):
-        handlers.RetryOnError.__init__(self, attempts, delay, exception = Timeout, exclude = [])
-
-class RetryCustom(WebHandler):
-    "Uses client-provided function 'test' for analyzing errors (exceptions) and deciding whether to retry (return False if not), and with what delay (return >0)"
-    def __init__(self, test):
+    def __init__(self, attempts = 3, delay = 5, backoff = 2.0, maxdelay = 60, budget = None):
+        handlers.RetryOnError.__init__(self, attempts, delay, exception = Timeout, exclude = [], backoff = backoff, maxdelay = maxdelay, budget = budget)
+
+class RetryCustom(RetryOnError):
+    """Uses client-provided function 'test' for analyzing errors (exceptions) and deciding whether to retry (return False if not), and with what delay (return >0).
+    By default, delays returned by 'test' are used as they are, only slightly disturbed (+/- 'jitter'); set backoff > 1
+    to make them grow exponentially with the no. of attempts, like in RetryOnError, up to 'maxdelay'."""
+    def __init__(self, test, backoff = 1, maxdelay = None, jitter = 0.1, budget = None):
         "'test' is a function of 2 arguments: exception and the no. of attempts done so far, returning new delay or None for stop. See exampleTest() below."
         self.test = test
+        self.exception = Exception
+        self.backoff = backoff
+        self.maxdelay = maxdelay
+        self.jitter = jitter
+        self.budget = budget
         
         def exampleTest(ex, attempt):
             "attempt: no. of attempts done so far, always >= 1"
@@ -446,20 +842,10 @@ class RetryCustom(WebHandler):
                 if status != 404: return 1.0
             return False            # forward other exceptions
         
-    def handle(self, req):
-        attempt = 0
-        while True:
-            try:
-                attempt += 1
-                _req = deepcopy(req)                    # we may need original 'req' again in the future, thus copying
-                return self.next.handle(_req)
-            except Exception, e:
-                delay = self.test(e, attempt)
-                if not delay: raise
-                delay *= mnoise(1.1)
-                self.log.warning("RetryCustom, attempt #%d, trying again after %d seconds... Caught %s" % (attempt, delay, e))
-                time.sleep(delay)
-        return self.next.handle(req)
+    def retry(self, req, e, attempt):
+        delay = self.test(e, attempt)
+        if not delay: return None
+        return backoff(delay, attempt, self.backoff, self.maxdelay, self.jitter)
 
 class UserAgent(WebHandler):
     def __init__(self, agent = None, change = None):
@@ -482,7 +868,10 @@ class UserAgent(WebHandler):
 
     
 class History(WebHandler):
+    "Thread-safe: in concurrent mode, events are recorded in the order of completion of requests."
     Event = namedtuple('Event', 'req resp')
+    __shared__ = 'lock'
+    
     def __init__(self, maxlen = None):
         "maxlen: must be >= 1, or None (no limit)"
         self.events = []            # a list of "back" and "forward" events, as (request,response) pairs
@@ -490,37 +879,46 @@ class History(WebHandler):
         if maxlen and (not isnumber(maxlen) or maxlen < 1):
             maxlen = 1
         self.maxlen = maxlen
+        self.lock = threading.RLock()
     def handle(self, req):
-        _req = deepcopy(req)
+        _req = req.copy()
         resp = self.next.handle(req)
-        self.events = self.events[:self.current]                            # we're moving forward, so forget all "forward" events, if present
-        M = self.maxlen
-        if M and len(self.events) >= M:
-            self.events = self.events[-(M-1):] if M > 1 else []             # create space for new event
-        self.events.append(self.Event(_req, deepcopy(resp)))                # must perform deepcopies because req/resp objects are modified down and up the handlers chain
-        self.current = len(self.events)
+        _resp = deepcopy(resp)                                              # must perform copies because req/resp objects are modified down and up the handlers chain
+        if req.stream and _resp: _resp.resp = None                          # unread body belongs to the caller, history mustn't keep its connection busy
+        event = self.Event(_req, _resp)
+        with self.lock:
+            self.events = self.events[:self.current]                        # we're moving forward, so forget all "forward" events, if present
+            M = self.maxlen
+            if M and len(self.events) >= M:
+                self.events = self.events[-(M-1):] if M > 1 else []         # create space for new event
+            self.events.append(event)
+            self.current = len(self.events)
         return resp
     def last(self):
         "Return last (request,response) if present; otherwise None. Don't move history pointer"
-        if self.current > 0:
-            return self.events[self.current - 1]
-        return None
+        with self.lock:
+            if self.current > 0:
+                return self.events[self.current - 1]
+            return None
     def back(self):
         "If possible, move history pointer 1 step back and return that response object again; otherwise None"
-        if self.current > 1:
-            self.current -= 1
-            return self.last()
-        return None
+        with self.lock:
+            if self.current > 1:
+                self.current -= 1
+                return self.last()
+            return None
     def forward(self):
         "If possible, move history pointer 1 step forward and return that response object again; otherwise None"
-        if self.current < len(self.events):
-            self.current += 1
-            return self.last()
-        return None
+        with self.lock:
+            if self.current < len(self.events):
+                self.current += 1
+                return self.last()
+            return None
     def reset(self):
         "Clear history entirely"
-        self.events = []
-        self.current = 0
+        with self.lock:
+            self.events = []
+            self.current = 0
     
 class Referer(WebHandler):
     def __init__(self, history):
@@ -535,25 +933,195 @@ class Referer(WebHandler):
                 suffix = req.url[len(prefix):-1]
                 #print repr(suffix)
                 #print repr(last.resp.content)
-                if str(suffix) in last.resp.content:        # suffix - simple heuristic to check if the new URL really occured in the previous page; str() to handle URL being unicode object
+                if last.resp.content and str(suffix) in last.resp.content:        # suffix - simple heuristic to check if the new URL really occured in the previous page; str() to handle URL being unicode object
                     req.add_header('Referer', lasturl) 
         return self.next.handle(req)
 
+class LRU(object):
+    """Thread-safe mapping with least-recently-used eviction, bounded by the total size of values ('size' given in put(), e.g. in bytes),
+    rather than by the number of items. Items larger than 'maxsize' are not stored at all."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.items = OrderedDict()          # key -> (value, size), least recently used first
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.items)
+    
+    def get(self, key, default = None):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None: return default
+            self.items[key] = item          # move to the end: most recently used
+            return item[0]
+    
+    def put(self, key, value, size = 1):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old: self.size -= old[1]
+            if size > self.maxsize: return
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.maxsize:
+                _, (_, evicted) = self.items.popitem(last = False)
+                self.size -= evicted
+    
+    def pop(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item: self.size -= item[1]
+    
+
+class _CacheWriter(object):
+    """File-like body of a streamed response that passes the data read by the caller through, and at the same time stores them in Cache,
+    compressed chunk by chunk, without buffering. When the body has been read to the end, the file is moved into place and indexed;
+    if the body is closed earlier or reading fails, the incomplete file is discarded."""
+    def __init__(self, cache, req, resp):
+        self.cache, self.req, self.resp = cache, req, resp
+        self.body = resp.resp
+        self.blob = cache._digest(resp.url)
+        self.filename = cache._blobfile(self.blob)
+        cache._makedirs(self.filename)
+        self.tmp = cache._tmpfile(self.filename)
+        self.file = open(self.tmp, 'wb')
+        self.codec, self.compressor = cache._compressor()
+        self.size = self.stored = 0
+    
+    def read(self, size = -1):
+        try: data = self.body.read(size) if size >= 0 else self.body.read()
+        except:
+            self._discard()
+            raise
+        if self.file:
+            if data:
+                self.size += len(data)
+                self._write(self.compressor.compress(data) if self.compressor else data)
+            else:
+                self._finish()
+        return data
+    
+    def _write(self, data):
+        self.stored += len(data)
+        self.file.write(data)
+    
+    def _finish(self):
+        if self.compressor: self._write(self.compressor.flush())
+        self.file.close()
+        self.file = None
+        self.cache._rename(self.tmp, self.filename)
+        self.cache._index(self.req, self.resp, self.blob, self.codec, self.size, self.stored)
+    
+    def _discard(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            os.remove(self.tmp)
+    
+    def close(self):
+        self._discard()
+        self.body.close()
+
+_caches = weakref.WeakSet()                 # Caches with a maintenance thread, to be stopped when the interpreter exits
+
+@atexit.register
+def _stop_caches():
+    "Let maintenance threads end cleanly if they're idle when the interpreter exits."
+    for cache in list(_caches): cache.stop(cache.interval)
+
+class _BlobReader(object):
+    "File-like body of a page streamed from Cache: reads the file and decompresses it on the fly, chunk by chunk."
+    def __init__(self, cache, file, decompressor):
+        self.cache, self.file, self.decompressor = cache, file, decompressor
+    
+    def read(self, size = -1):
+        while self.file:
+            data = self.file.read(size) if size >= 0 else self.file.read()
+            self.cache._count(disk_read = len(data))
+            if not data:
+                self.close()
+                return self.decompressor.flush() if hasattr(self.decompressor, 'flush') else ''
+            if self.decompressor: data = self.decompressor.decompress(data)
+            if data: return data
+        return ''
+    
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
 class Cache(WebHandler):
     """Web caching: enables repeated access to the same www page without its reloading.
-    Cache is located on disk, in a folder given as parameter; pages stored in separate files named after their URLs.
-    When redirection occurs, a special type of file (*.redirect) is created pointing to the new URL, so that the returned response
-    can have final URL set correctly.
+    Cache is located on disk, in a folder given as parameter. Contents of pages are stored in files named after SHA-1 digests
+    of their final URLs (after redirections), in 2-level sharded subfolders: ab/cd/abcd...(40 hex digits), so that no folder grows too large.
+    An SQLite index (.index.db) maps requested URLs to: the file (blob), time of download, target URL if redirection occured,
+    size of the page, its validators (ETag, Last-Modified) and max-age, compression codec and size on disk. When redirection occurs,
+    both the original and the final URL are indexed, pointing to the same file, so that the returned response can have final URL set correctly.
+    A lookup is a single indexed query.
     
-    https://pypi.python.org/pypi/pyxattr/0.5.2 - module for Extended File Attributes (might be needed)
+    A page is fresh for 'refresh' period after download, or longer if the server declared a longer max-age in Cache-Control.
+    A stale page that has validators is revalidated with a conditional request (If-None-Match, If-Modified-Since):
+    if the server responds 304 Not Modified, the cached copy is marked as fresh again and returned, without downloading the page.
+    
+    The cache can be bounded by total size of files on disk ('maxsize', in bytes) and/or the number of pages ('maxentries');
+    when a limit is exceeded, least recently used pages are evicted. Eviction, as well as removal of pages older than 'retain',
+    is done incrementally by a background maintenance thread: at most 'batch' pages every 'interval' seconds, so that requests
+    never wait for cleanup, and a large backlog (e.g., after lowering the limits) doesn't saturate the disk.
+    Times of last access are collected in memory and written to the index by the same thread, in batches.
+    The thread is a daemon, it doesn't keep the application alive nor the Cache object: it ends when the Cache is garbage-collected,
+    or earlier, on stop().
+    
+    Pages are compressed on disk, every one with the codec given by 'compress': 'zlib' (default), 'zstd' (requires 'zstandard' module)
+    or None; the codec is recorded per entry, so it can be changed for an existing cache. For zstd, a dictionary can be trained
+    on the cached pages with train(), which improves compression of small, similar pages a lot.
+    In front of the disk store, there is an in-memory LRU tier of recently used pages (decompressed), bounded by 'memory' bytes.
+    Streamed requests (Request.stream=True) are served from disk chunk by chunk; streamed downloads are compressed and stored
+    while the caller reads the body, without loading the page into memory.
+    Hit ratios of both tiers, bytes read from disk and saved by compression are counted in self.stats, see report().
+    Thread-safe.
     """
     DEFAULT_PATH = ".webcache/"            # default folder where cached pages are stored (will be created if doesn't exist)
-    STATE_FILE   = ".state.json"
+    INDEX_FILE   = ".index.db"
+    DICT_FILE    = ".dict-%d.zstd"         # trained zstd dictionaries, by their IDs
+    REPORT_EVERY = 1000                     # log statistics every 1000 requests
+    
+    __shared__ = 'lock db memory totals accessed stopped worker'
+    
+    Entry = namedtuple('Entry', 'blob fetched redirect size etag codec modified maxage')        # index entry of a page, as returned by _lookup()
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pages (
+            url      TEXT PRIMARY KEY,          -- requested URL
+            blob     TEXT NOT NULL,             -- SHA-1 of the final URL: name of the file with contents
+            fetched  REAL NOT NULL,             -- time of download, as returned by time.time()
+            redirect TEXT,                      -- final URL if redirection occured, NULL otherwise
+            size     INTEGER,                   -- length of contents, in bytes
+            etag     TEXT,                      -- ETag header of the response, if present
+            codec    TEXT,                      -- compression of the file: raw, zlib, zstd, zstd:<dictionary ID>
+            stored   INTEGER,                   -- size of the file, in bytes
+            accessed REAL,                      -- time of last access (approximate: updated in batches)
+            modified TEXT,                      -- Last-Modified header of the response, if present
+            maxage   INTEGER                    -- max-age of Cache-Control header, in seconds, if present
+        );
+        CREATE INDEX IF NOT EXISTS pages_fetched ON pages (fetched);
+        CREATE INDEX IF NOT EXISTS pages_blob ON pages (blob);
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value);
+    """
+    INDEXES = """
+        CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed);
+    """
     
-    def __init__(self, path = DEFAULT_PATH, refresh = 1.0, retain = 30):
+    def __init__(self, path = DEFAULT_PATH, refresh = 1.0, retain = 30, compress = 'zlib', level = None, memory = 64*2**20,
+                 maxsize = None, maxentries = None, interval = 1.0, batch = 200, maintain = True):
         """refresh: how often pages in cache should be refreshed, in days; default: 1 day
            retain: for how long pages should be kept in cache even after refresh period (for safety); default: 30 days; 
                    not less than 'refresh' (increased up to 'refresh' if necessary)
+           compress: codec for new pages: 'zlib', 'zstd' or None; level: compression level, codec's default if None
+           memory: max. total size of pages kept in memory, in bytes; 0 or None to disable the memory tier
+           maxsize, maxentries: max. total size of files on disk (in bytes) and max. no. of pages in cache; None for no limit
+           interval, batch: the maintenance thread wakes up every 'interval' seconds and removes at most 'batch' pages at a time
+           maintain: if False, the maintenance thread is not started, maintain() must be called explicitly
         """
         if not isstring(path): path = self.DEFAULT_PATH
         if path[-1] != '/': path += '/' 
@@ -564,106 +1132,410 @@ class Cache(WebHandler):
         if not refresh: refresh = 1.0
         self.refresh = refresh * 24*60*60                       # refresh copies after this time, in seconds
         self.retain = max(retain, refresh) * 24*60*60           # keep copies in cache for this long, in seconds
-        self.clean = self.refresh / 10.0                        # how often to clean the cache: on every startup + 50 times over 'refresh' period
-        self.clean = max(self.clean, 60*60)                     # ...but not more often than every hour
+        self.maxsize = maxsize
+        self.maxentries = maxentries
+        self.interval = interval
+        self.batch = batch
         
-        self.state = JsonDict(path + self.STATE_FILE, indent = 4)
-        self.state.setdefault('lastClean')
-    
-    def _clean_cache(self):
-        if self.state['lastClean'] and (now() - self.state['lastClean']) < self.clean: return
-        self.state['lastClean'] = now()
-        self.state.sync()
-        self.log.warn("Cache, cleaning of the cache started in a separate thread...")
+        self.db = sqlite3.connect(path + self.INDEX_FILE, check_same_thread = False)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode = WAL")            # readers don't block the writer, also in other processes
+        self.db.executescript(self.SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(pages)")]
+        for column, kind in [('codec', 'TEXT'), ('stored', 'INTEGER'), ('accessed', 'REAL'), ('modified', 'TEXT'), ('maxage', 'INTEGER')]:   # upgrade an older cache
+            if column not in columns: self.db.execute("ALTER TABLE pages ADD COLUMN %s %s" % (column, kind))
+        if 'accessed' not in columns:
+            with self.db: self.db.execute("UPDATE pages SET accessed = fetched")
+        self.db.executescript(self.INDEXES)
+        self.lock = threading.Lock()                            # guards self.db, self.stats and self.totals
         
-        if islinux():                                           # on Linux, use faster shell command (find) to find and remove old files, in one step
-            retain = self.retain / (24*60*60) + 1               # retension time in days, for 'find' command
-            subprocess.call("find '%s' -maxdepth 1 -type f -mtime +%d -exec rm '{}' \;" % (self.path, retain), shell=True)
-        else:
-            MAX_CLEAN = 10000                                   # for performance reasons, if there are many files in cache check only a random subset of MAX_CLEAN ones for removal
-            _now = now()
-            files = os.listdir(self.path)
-            self.log.info("Cache, cleaning, got file list...")
-            if len(files) > MAX_CLEAN: files = random.sample(files, MAX_CLEAN)
-            for f in files:
-                f = self.path + f
-                created = os.path.getmtime(f)
-                if (_now - created) > self.retain:
-                    os.remove(f)
-        self.log.info("Cache, cleaning completed.")
-    
-    def _url2file_old(self, url, ext = "html"):  
-        # Deprecated
-        safeurl = url.replace('/', '\\')
-        filename = safeurl + " " + str(hash(url))
-        return self.path + filename + "." + ext
-    
-    def _url2file(self, url, ext = "html", pat = re.compile(r"""[/"'!?\\&=:]"""), maxlen = 60):
-        "Encode URL to obtain a correct file name, preceeded by cache path"
-        safeurl = pat.sub('_', url.replace('://', '_'))[:maxlen]
-        filename = safeurl + "_" + str(hash(url))
-        return self.path + filename + "." + ext
-    
-    def _cachedFile(self, url, ext = "html"):
-        "if possible, return cached copy and its file modification time, otherwise (None,None)"
-        filename = self._url2file(url, ext)
-        if not os.path.exists(filename):
-            filename = self._url2file_old(url, ext)
-            if not os.path.exists(filename):
-                return None, None
-
-        created = os.path.getmtime(filename)
-        if now() - created > self.refresh: return None, None        # we have a copy, but time to refresh (don't delete instantly for safety, if web access fails)
-        with open(filename) as f:
-            time = util.filedatetime(filename)
-            return f.read(), time
+        if compress not in ('zlib', 'zstd', None): raise Exception("Cache, unknown compression codec: %s" % compress)
+        self.codec = compress or 'raw'
+        self.level = level
+        self.dicts = {}                                         # zstd dictionaries loaded so far, by ID
+        self.dictionary = self._state('dictionary')             # ID of the dictionary for compression of new pages, or None
+        self.memory = LRU(memory) if memory else None
+        self.stats = dict.fromkeys(['requests', 'memory_hits', 'disk_hits', 'misses', 'revalidated', 'served', 'disk_read', 'raw_written', 'written',
+                                    'expired', 'evicted'], 0)
         
+        self.totals = list(self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(COALESCE(stored, size)), 0) "
+                                           "FROM pages WHERE redirect IS NULL").fetchone())     # [no. of pages, total size, total size on disk], kept up to date
+        self.accessed = {}                                      # final URL -> time of last access, not yet written to the index
+        self.stopped = threading.Event()
+        self.worker = None
+        if maintain:
+            stopped = self.stopped
+            ref = weakref.ref(self, lambda ref: stopped.set())  # the thread holds a weak reference only, and ends when the Cache is collected
+            self.worker = threading.Thread(target = Cache._maintain, args = (ref, stopped, self.interval), name = "Cache maintenance")
+            self.worker.daemon = True                           # never delays termination of the application
+            self.worker.start()
+            _caches.add(self)                                   # to be stopped at exit
     
-    def _cachedResponse(self, req):
-        # is there a .redirect file?
-        url = req.url
-        content, time1 = self._cachedFile(url, 'redirect')
-        if content: url = content                                       # .redirect file contains just the target URL in plain text form
+    def _state(self, key, value = None):
+        "Get (if value=None) or set a persistent value in the 'state' table."
+        with self.lock, self.db:
+            if value is not None:
+                self.db.execute("INSERT OR REPLACE INTO state VALUES (?,?)", (key, value))
+                return value
+            row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+    
+    def _count(self, **increments):
+        with self.lock:
+            for key, inc in increments.iteritems(): self.stats[key] += inc
+    
+    @staticmethod
+    def _maintain(ref, stopped, interval):
+        "Body of the maintenance thread: call maintain() of the Cache referenced weakly by 'ref' every 'interval' seconds until stop()."
+        while not stopped.wait(interval):
+            cache = ref()
+            if cache is None: return
+            try: cache.maintain()
+            except Exception, e:
+                cache.log.error("Cache, maintenance failed: %s" % e)
+            del cache                                           # don't keep the Cache alive while waiting
+    
+    def stop(self, timeout = None):
+        "Stop the maintenance thread after its current step and wait for it (at most 'timeout' seconds)."
+        self.stopped.set()
+        if self.worker and self.worker is not threading.current_thread(): self.worker.join(timeout)
+    
+    def maintain(self, batch = None):
+        """A single step of maintenance: write times of recent accesses to the index, then remove at most 'batch' pages
+        (self.batch by default): first those older than 'retain', then least recently used ones while the cache exceeds
+        'maxsize' or 'maxentries'. Returns the no. of pages removed."""
+        batch = batch or self.batch
+        accessed = [(self.accessed.pop(url), url) for url in self.accessed.keys()]
+        with self.lock, self.db:
+            if accessed:
+                self.db.executemany("UPDATE pages SET accessed = ? WHERE url = ?", accessed)
+        
+        limit = now() - self.retain
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM pages WHERE redirect IS NOT NULL AND fetched < ?", (limit,))
+        expired = self._remove("fetched < ? LIMIT ?", (limit, batch))
+        self._count(expired = expired)
         
-        # now check the actual .html file
-        content, time2 = self._cachedFile(url)
-        if content == None: return None
+        evicted = 0
+        while evicted + expired < batch:
+            excess = self._excess()
+            if excess <= 0: break
+            removed = self._remove("1 ORDER BY accessed LIMIT ?", (min(batch - evicted - expired, excess, 100),))
+            if not removed: break
+            evicted += removed
+        self._count(evicted = evicted)
         
-        # found in cache; return a Response() object
+        if expired or evicted: self.log.info("Cache, %d old and %d least recently used pages removed" % (expired, evicted))
+        return expired + evicted
+    
+    def _excess(self):
+        "Estimated no. of pages that must be evicted to fit in 'maxentries' and 'maxsize'; pages of average size are assumed for the latter."
+        entries, _, stored = self.totals
+        excess = entries - self.maxentries if self.maxentries is not None else 0
+        if self.maxsize is not None and stored > self.maxsize:
+            excess = max(excess, -(-(stored - self.maxsize) * entries // stored))           # ceil()
+        return excess
+    
+    def _remove(self, where, params):
+        """Remove pages selected by a 'where' clause from the index, together with URLs redirected to them,
+        then delete their files and drop them from the memory tier. Returns the no. of pages removed."""
+        with self.lock, self.db:
+            entries = self.db.execute("SELECT blob, size, COALESCE(stored, size) FROM pages WHERE redirect IS NULL AND " + where, params).fetchall()
+            blobs = [(e[0],) for e in entries]
+            urls = [url for blob, in blobs for url, in self.db.execute("SELECT url FROM pages WHERE blob = ?", (blob,))]
+            self.db.executemany("DELETE FROM pages WHERE blob = ?", blobs)
+            self.totals[0] -= len(entries)
+            self.totals[1] -= sum(e[1] or 0 for e in entries)
+            self.totals[2] -= sum(e[2] or 0 for e in entries)
+        for blob, in blobs:
+            try: os.remove(self._blobfile(blob))
+            except OSError: pass                                # already removed
+        if self.memory is not None:
+            for url in urls: self.memory.pop(url)
+        return len(entries)
+    
+    def _blobfile(self, blob):
+        "Path to the file with contents of a given blob (SHA-1 hex digest)"
+        return "%s%s/%s/%s" % (self.path, blob[:2], blob[2:4], blob)
+    
+    @staticmethod
+    def _digest(url):
+        return hashlib.sha1(url.encode('utf-8') if isinstance(url, unicode) else url).hexdigest()
+    
+    def _zstd_dict(self, id):
+        import zstandard
+        if id not in self.dicts:
+            with open(self.path + self.DICT_FILE % id, 'rb') as f:
+                self.dicts[id] = zstandard.ZstdCompressionDict(f.read())
+        return self.dicts[id]
+    
+    def _encode(self, content):
+        "Compress 'content' with the current codec. Return (codec, compressed content)."
+        if self.codec == 'zlib':
+            return 'zlib', zlib.compress(content, 6 if self.level is None else self.level)
+        if self.codec == 'zstd':
+            import zstandard
+            level = 3 if self.level is None else self.level
+            if self.dictionary:
+                return 'zstd:%d' % self.dictionary, zstandard.ZstdCompressor(level, dict_data = self._zstd_dict(self.dictionary)).compress(content)
+            return 'zstd', zstandard.ZstdCompressor(level).compress(content)
+        return 'raw', content
+    
+    def _decode(self, codec, data):
+        if codec in ('raw', None): return data
+        if codec == 'zlib': return zlib.decompress(data)
+        return self._decompressor(codec).decompress(data)      # zstd frames of streamed pages have no content size in the header, one-shot decompress() can't handle them
+    
+    def _compressor(self):
+        "Incremental version of _encode(), for streamed pages: (codec, object with compress() and flush() methods, or None for 'raw')."
+        if self.codec == 'zlib':
+            return 'zlib', zlib.compressobj(6 if self.level is None else self.level)
+        if self.codec == 'zstd':
+            import zstandard
+            level = 3 if self.level is None else self.level
+            if self.dictionary:
+                return 'zstd:%d' % self.dictionary, zstandard.ZstdCompressor(level, dict_data = self._zstd_dict(self.dictionary)).compressobj()
+            return 'zstd', zstandard.ZstdCompressor(level).compressobj()
+        return 'raw', None
+    
+    def _decompressor(self, codec):
+        "Object with decompress() method for incremental decompression of 'codec', or None for 'raw'."
+        if codec in ('raw', None): return None
+        if codec == 'zlib': return zlib.decompressobj()
+        import zstandard
+        if codec == 'zstd': return zstandard.ZstdDecompressor().decompressobj()
+        return zstandard.ZstdDecompressor(dict_data = self._zstd_dict(int(codec.split(':')[1]))).decompressobj()
+    
+    def _read(self, blob, codec):
+        "Read and decompress contents of a blob; None if the file is missing."
+        try:
+            with open(self._blobfile(blob), 'rb') as f:
+                data = f.read()
+        except IOError:                                         # file removed by cleaning in the meantime, or externally
+            return None
+        self._count(disk_read = len(data))
+        return self._decode(codec, data)
+    
+    def _body(self, req, entry):
+        """Contents of a cached page, as a pair (content, stream): either the contents loaded into a string,
+        or, for streamed requests, a file-like object that reads and decompresses the file on the fly. None if the file is missing."""
+        if not req.stream:
+            content = self._read(entry.blob, entry.codec)
+            return (content, None) if content is not None else None
+        try: f = open(self._blobfile(entry.blob), 'rb')
+        except IOError: return None
+        return None, _BlobReader(self, f, self._decompressor(entry.codec))
+    
+    def _lookup(self, url):
+        "Index entry of 'url' as Cache.Entry, or None if not present."
+        with self.lock:
+            entry = self.db.execute("SELECT blob, fetched, redirect, size, etag, codec, modified, maxage FROM pages WHERE url = ?", (url,)).fetchone()
+        return self.Entry(*entry) if entry else None
+    
+    def _fresh(self, fetched, maxage):
+        "Is a page downloaded at 'fetched' time still fresh? It is until 'refresh' period passes, or the page's max-age if longer."
+        return now() - fetched <= max(self.refresh, maxage or 0)
+    
+    @staticmethod
+    def _maxage(headers):
+        "max-age of Cache-Control header, in seconds, or None if missing."
+        match = re.search(r'max-age\s*=\s*"?(\d+)', headers.get('cache-control') or '')
+        return int(match.group(1)) if match else None
+    
+    def _cachedResponse(self, req):
+        """Returns a pair: (response, stale). Response is the cached page, if present and fresh, None otherwise.
+        Stale is the index entry of the page if it's present, but stale and must be refreshed; None otherwise."""
+        cached = self.memory.get(req.url) if self.memory is not None else None            # (final url, fetched, maxage, content)
+        if cached and not self._fresh(*cached[1:3]):
+            self.memory.pop(req.url)
+            cached = None
+        stream = size = None
+        if cached:
+            url, fetched, _, content = cached
+            self._count(memory_hits = 1)
+        else:
+            entry = self._lookup(req.url)
+            if entry is None: return None, None
+            if not self._fresh(entry.fetched, entry.maxage):   # we have a copy, but time to refresh (don't delete instantly for safety, if web access fails)
+                return None, entry
+            body = self._body(req, entry)
+            if body is None: return None, None
+            content, stream = body
+            url, fetched, size = entry.redirect or req.url, entry.fetched, entry.size
+            if self.memory is not None and content is not None: self.memory.put(req.url, (url, fetched, entry.maxage, content), len(content))
+            self._count(disk_hits = 1)
+        self.accessed[url] = now()
+        return self._response(req, url, fetched, content, stream, size), None
+    
+    def _revalidate(self, req, entry):
+        """Send a conditional request for a stale page, with its validators. If the server responds 304 Not Modified,
+        mark the cached copy as fresh and return it. Otherwise, return the response: the new version of the page, to be stored."""
+        cond = req.copy()
+        if entry.etag: cond.add_header('If-None-Match', entry.etag)
+        if entry.modified: cond.add_header('If-Modified-Since', entry.modified)
+        resp = self.next.handle(cond)
+        if resp.status != 304: return resp
+        resp.read()                                             # empty body of 304, if streamed: read to release the connection
+        
+        body = self._body(req, entry)
+        if body is None: return self.next.handle(req)          # file removed in the meantime, download the page unconditionally
+        content, stream = body
+        headers = resp.headers or {}
+        fetched, maxage = now(), self._maxage(headers)
+        if maxage is None: maxage = entry.maxage
+        with self.lock, self.db:                                # refresh all the URLs of the page: the final one and redirected ones
+            self.db.execute("UPDATE pages SET fetched = ?, accessed = ?, etag = COALESCE(?, etag), modified = COALESCE(?, modified), maxage = ? WHERE blob = ?",
+                            (fetched, fetched, headers.get('etag'), headers.get('last-modified'), maxage, entry.blob))
+        url = entry.redirect or req.url
+        if self.memory is not None and content is not None: self.memory.put(req.url, (url, fetched, maxage, content), len(content))
+        self._count(revalidated = 1)
+        self.log.info("Cache, revalidated: " + req.url)
+        return self._response(req, url, fetched, content, stream, entry.size)
+    
+    def _response(self, req, url, fetched, content, stream = None, size = None):
+        "Response() object with a page found in cache: loaded into 'content', or to be read from 'stream' ('size' bytes)."
         resp = Response()
         resp.content = content
+        resp.resp = stream
         resp.fromCache = True
         resp.url = url
-        resp.time = min(time1 or time2, time2 or time1)
+        resp.time = datetime.fromtimestamp(fetched)
+        self._count(served = len(content) if content is not None else size or 0)
         self.log.info("Cache, loaded from cache: " + req.url + (" -> " + url if url != req.url else ""))
         return resp
     
+    def _store(self, req, resp):
+        "Save the downloaded page under its final URL; if redirection occured, index the original URL, too."
+        blob = self._digest(resp.url)
+        filename = self._blobfile(blob)
+        self._makedirs(filename)
+        codec, data = self._encode(resp.content)
+        self._write(filename, data)
+        self._index(req, resp, blob, codec, len(resp.content), len(data), resp.content)
+    
+    def _index(self, req, resp, blob, codec, size, stored, content = None):
+        "Add a page saved in the 'blob' file to the index (and to the memory tier, if 'content' is given)."
+        url = resp.url
+        headers = resp.headers or {}
+        fetched, maxage = now(), self._maxage(headers)
+        validators = (headers.get('etag'), headers.get('last-modified'))
+        entries = [(url, blob, fetched, None, size, codec, stored, fetched, maxage) + validators]
+        if url != req.url: entries.append((req.url, blob, fetched, url, size, codec, stored, fetched, maxage) + validators)
+        with self.lock, self.db:
+            # keep totals up to date, taking into account the replaced version of the page
+            old = self.db.execute("SELECT size, COALESCE(stored, size) FROM pages WHERE url = ? AND redirect IS NULL", (url,)).fetchone()
+            old_size, old_stored = old or (0, 0)
+            self.totals[0] += 0 if old else 1
+            self.totals[1] += size - (old_size or 0)
+            self.totals[2] += stored - (old_stored or 0)
+            replaced, aliases = None, []
+            if url != req.url:                                  # req.url might have been a page of its own, now it becomes a redirect:
+                replaced = self.db.execute("SELECT blob, size, COALESCE(stored, size) FROM pages WHERE url = ? AND redirect IS NULL", (req.url,)).fetchone()
+                if replaced and replaced[0] != blob:            # its file and URLs redirected to it must go, nothing else would remove them
+                    aliases = [alias for alias, in self.db.execute("SELECT url FROM pages WHERE blob = ?", replaced[:1])]
+                    self.db.execute("DELETE FROM pages WHERE blob = ?", replaced[:1])
+                    self.totals[0] -= 1
+                    self.totals[1] -= replaced[1] or 0
+                    self.totals[2] -= replaced[2] or 0
+                else: replaced = None
+            self.db.executemany("INSERT OR REPLACE INTO pages (url, blob, fetched, redirect, size, codec, stored, accessed, maxage, etag, modified) "
+                                "VALUES (?,?,?,?,?,?,?,?,?,?,?)", entries)
+        if replaced:
+            try: os.remove(self._blobfile(replaced[0]))
+            except OSError: pass
+        if self.memory is not None:
+            for alias in aliases: self.memory.pop(alias)
+            if content is not None:
+                for entry in entries: self.memory.put(entry[0], (url, fetched, maxage, content), size)
+        self._count(raw_written = size, written = stored)
+    
     def handle(self, req):
-        # page in cache?
-        resp = self._cachedResponse(req)
-        if resp != None: return resp
+        self._count(requests = 1)
+        if self.stats['requests'] % self.REPORT_EVERY == 0: self.report()
         
-        # download page and save in cache under final URL 
-        resp = self.next.handle(req)
-        url = resp.url
-        filename = self._url2file(url)
-        with open(filename, 'wt') as f:
-            f.write(resp.content)
+        # page in cache?
+        resp, stale = self._cachedResponse(req)
+        if resp is not None: return resp
         
-        # redirection occured? create a .redirect file under original URL to indicate this fact
-        if url != req.url:
-            filename = self._url2file(req.url, 'redirect')
-            with open(filename, 'wt') as f:
-                f.write(url)                                                    # .redirect file contains only the target URL in plain text form
+        # stale copy in cache? try to revalidate instead of downloading
+        if stale and (stale.etag or stale.modified):
+            resp = self._revalidate(req, stale)
+            if resp.fromCache: return resp
+        else:
+            resp = self.next.handle(req)
         
+        # page downloaded; save in cache under final URL 
+        self._count(misses = 1)
+        if req.stream and resp.content is None:
+            resp.resp = _CacheWriter(self, req, resp)           # the page will be stored while the caller reads it
+        else:
+            self._store(req, resp)
+        url = resp.url
         self.log.info("Cache, downloaded from web: " + req.url + (" -> " + url if url != req.url else ""))
-        
-        lastClean = self.state['lastClean']
-        if not lastClean or (now() - lastClean) > self.clean:                   # remove old files from the cache before proceeding
-            threading.Thread(target = self._clean_cache).start()
-            # we'll not join this thread, but application will not terminate until this thread ends (!); set .deamon=True otherwise
-            
         return resp
+    
+    def _write(self, filename, content):
+        "Write to a temporary file first and rename, so that concurrent readers and writers of the same file never see it incomplete."
+        tmp = self._tmpfile(filename)
+        with open(tmp, 'wb') as f:
+            f.write(content)
+        self._rename(tmp, filename)
+    
+    @staticmethod
+    def _tmpfile(filename):
+        "Unique name of a temporary file, for writing contents of 'filename' before the file is moved into place by _rename()."
+        return "%s.%016x.tmp" % (filename, random.getrandbits(64))
+    
+    @staticmethod
+    def _makedirs(filename):
+        folder = os.path.dirname(filename)
+        if not os.path.isdir(folder):
+            try: os.makedirs(folder)
+            except OSError:                                     # created concurrently by another thread?
+                if not os.path.isdir(folder): raise
+    
+    @staticmethod
+    def _rename(tmp, filename):
+        try: os.rename(tmp, filename)
+        except OSError:                                                         # on Windows, rename fails if the target exists
+            if os.path.exists(filename): os.remove(filename)
+            os.rename(tmp, filename)
+    
+    def train(self, samples = 2000, size = 112640):
+        """Train a zstd dictionary of 'size' bytes on a random sample of up to 'samples' cached pages and compress new pages with it
+        (switches the codec to zstd). Pages stored before remain readable, with their own codecs. Returns ID of the dictionary."""
+        import zstandard
+        with self.lock:
+            entries = self.db.execute("SELECT blob, codec FROM pages WHERE redirect IS NULL ORDER BY RANDOM() LIMIT ?", (samples,)).fetchall()
+        pages = filter(None, [self._read(blob, codec) for blob, codec in entries])
+        if not pages: raise Exception("Cache.train(), no pages in cache to train the dictionary on")
+        dictionary = zstandard.train_dictionary(size, pages)
+        id = dictionary.dict_id()
+        self._write(self.path + self.DICT_FILE % id, dictionary.as_bytes())
+        self.dicts[id] = dictionary
+        self.codec = 'zstd'
+        self.dictionary = self._state('dictionary', id)
+        self.log.info("Cache, trained zstd dictionary #%d on %d pages" % (id, len(pages)))
+        return id
+    
+    def report(self):
+        """Log (info) and return statistics: hit ratios of the memory tier and the whole cache, no. of pages revalidated, read amplification
+        (bytes read from disk per byte served from cache), bytes saved by compression: in this session and in the whole cache,
+        no. of pages and their size on disk, no. of pages expired and evicted by maintenance."""
+        with self.lock:
+            s = dict(self.stats)
+            entries, raw, stored = self.totals
+        s['entries'], s['size'] = entries, stored or 0
+        lookups = max(s['memory_hits'] + s['disk_hits'] + s['misses'] + s['revalidated'], 1)
+        s['memory_ratio'] = s['memory_hits'] / float(lookups)
+        s['hit_ratio'] = (s['memory_hits'] + s['disk_hits']) / float(lookups)
+        s['read_amplification'] = s['disk_read'] / float(max(s['served'], 1))
+        s['saved'] = s['raw_written'] - s['written']
+        s['saved_total'] = (raw or 0) - (stored or 0)
+        self.log.info("Cache, %(requests)d requests, hit ratio %(hit_ratio).3f (memory %(memory_ratio).3f), read amplification %(read_amplification).3f, "
+                      "%(revalidated)d pages revalidated, bytes saved by compression: %(saved)d in this session, %(saved_total)d in the whole cache; "
+                      "%(entries)d pages, %(size)d bytes on disk, %(expired)d expired, %(evicted)d evicted" % s)
+        return s
 
 class CustomTransform(WebHandler):
     "Base class for any handler that performs simple 1-1 transformation of either the request or/and the response object."
@@ -710,6 +1582,7 @@ class handlers(object):
     RetryOnError = RetryOnError
     RetryOnTimeout = RetryOnTimeout
     RetryCustom = RetryCustom
+    RetryBudget = RetryBudget
     UserAgent = UserAgent
     History = History
     Referer = Referer
@@ -734,7 +1607,7 @@ class WebClient(Object):
     
     # atomic handlers that comprise the 'handlers' chain, in the same order;
     # _head and _tail are lists of custom handlers that go at the beginning or at the end of all handlers list
-    _history = _head = _cache = _useragent = _referer = _timeout = _retryCustom = _retryOnError = _retryOnTimeout = _delay = _tail = _client = None
+    _history = _head = _cache = _useragent = _referer = _timeout = _budget = _retryCustom = _retryOnError = _retryOnTimeout = _delay = _tail = _client = None
     _tor = False            # self._tor is a read-only attr., changing it does NOT influence whether Tor is used or not, this is decided in __init__ and can't be changed
 
     handlers = None         # head (only!) of the chain of handlers
@@ -743,8 +1616,8 @@ class WebClient(Object):
     
     def __init__(self, timeout = None, identity = True, referer = True, cache = None, cacheRefresh = None, tor = False, history = 5, delay = None, 
                  retryOnTimeout = None, retryOnError = None,
-                 retryCustom = None, head = [], tail = [], logger = None,
-                 cookies = False, proxyAddr = None):
+                 retryCustom = None, retryBudget = True, head = [], tail = [], logger = None,
+                 cookies = False, proxyAddr = None, pool = False):
         """
         :param identity: how to set User-Agent. Can be either: 
             None/False (no custom identity); 
@@ -754,6 +1627,11 @@ class WebClient(Object):
         :param history: if number, maximum num of extract to be kept in web history; if True, history with no limit; otherwise (None, <1), limit=1
         :param cacheRefresh: either None, or a number (refresh == retain), or a pair (refresh, retain); typically refresh <= retain
         :param proxy: if string with proxy address (as adress:port) then connections will be proxies via this address or None
+        :param retryBudget: per-host limit for retries done by retryOnTimeout, retryOnError and retryCustom handlers, shared by copies of the client:
+            True (default RetryBudget), or <number> (max. ratio of retries to requests, see RetryBudget), or None/False (no limit)
+        :param delay: min. average interval, in seconds, between consecutive requests to the same host (per-host limit, see RateLimit)
+        :param pool: if True, pages are downloaded by PooledClient through persistent keep-alive connections rather than by urllib2;
+            or a ConnectionPool instance to be used (can be shared between clients). Ignored if tor or proxyAddr is used.
         """
         H = handlers
         # create cookiejar, which handles cookies while requesting
@@ -773,9 +1651,10 @@ class WebClient(Object):
         if identity:    self._useragent = H.UserAgent(identity if isstring(identity) else None, identity if isnumber(identity) else None)
         if referer:     self._referer = H.Referer(self._history)
         if cache:       self.setCache(cache, cacheRefresh)
-        if delay:       self._delay = H.Delay(delay)
-        if retryOnError:   self._retryOnError = H.RetryOnError(retryOnError)
-        if retryOnTimeout: self._retryOnTimeout = H.RetryOnTimeout(retryOnTimeout)
+        if delay:       self._delay = RateLimit(delay)
+        if retryBudget:    self._budget = RetryBudget() if retryBudget is True else RetryBudget(retryBudget)
+        if retryOnError:   self._retryOnError = H.RetryOnError(retryOnError, budget = self._budget)
+        if retryOnTimeout: self._retryOnTimeout = H.RetryOnTimeout(retryOnTimeout, budget = self._budget)
         if retryCustom:    self.setRetryCustom(retryCustom)
         if tor:         self._tor = True; urllib2hand.append(urllib2.ProxyHandler({'http': '127.0.0.1:8118'}))
         if proxyAddr and not tor: # either tor, or proxy, not both, tor is cheaper so has priority
@@ -786,7 +1665,10 @@ class WebClient(Object):
             urllib2hand.append(handler)
         self._head = head if islist(head) else [head]
         self._tail = tail if islist(tail) else [tail]
-        self._client = H.StandardClient(urllib2hand, cj)
+        if pool and not tor and not proxyAddr:
+            self._client = PooledClient(cj if cookies else None, pool if isinstance(pool, ConnectionPool) else None)
+        else:
+            self._client = H.StandardClient(urllib2hand, cj)
 
         self._rebuild()                                             # connect all the handlers into a chain
 
@@ -795,15 +1677,18 @@ class WebClient(Object):
     def copy(self):
         return deepcopy(self)
 
-    def setCache(self, path, refresh = None, retain = None):
-        "Default retain period = 1 year. 'refresh' can hold a pair: (refresh, retain), then 'retain' is not used."
+    def setCache(self, path, refresh = None, retain = None, **kwargs):
+        """Default retain period = 1 year. 'refresh' can hold a pair: (refresh, retain), then 'retain' is not used.
+        Other keyword arguments (compress, level, memory, maxsize, maxentries, ...) are passed to Cache."""
         if islist(refresh) and len(refresh) >= 2:
             refresh, retain = refresh[:2]
         if not retain: retain = refresh
-        self._cache = handlers.Cache(path, refresh, retain)
+        if self._cache: self._cache.stop()                  # the old cache won't be used anymore
+        self._cache = handlers.Cache(path, refresh, retain, **kwargs)
+        if self.handlers: self._rebuild()
         
     def setRetryCustom(self, retryCustom):
-        self._retryCustom = handlers.RetryCustom(retryCustom)
+        self._retryCustom = handlers.RetryCustom(retryCustom, budget = self._budget)
     
     def setLogger(self, logger):
         if logger is True: logger = defaultLogger
@@ -839,20 +1724,23 @@ class WebClient(Object):
         
     def _rebuild(self):
         "Rearrange handlers into a chain once again."
-        self.handlers = WebHandler.chain([self._history, self._head, self._cache, self._useragent, self._referer, self._timeout, 
+        retries = self._retryCustom or self._retryOnError or self._retryOnTimeout
+        self.handlers = WebHandler.chain([self._history, self._head, self._cache, self._useragent, self._referer, self._timeout, self._budget if retries else None,
                                           self._retryCustom, self._retryOnError, self._retryOnTimeout, self._delay, self._tail, self._client])
         self.setLogger(self.logger)
     
-    def response(self, url = None, data = None, headers = {}):
+    def response(self, url = None, data = None, headers = {}, stream = False):
         """Return current (last) response object if url=None, or make a new request like open() and return full response object. 
-        The method is aware of movements along history: back(), forward(), ..."""
+        The method is aware of movements along history: back(), forward(), ...
+        If stream=True, the body is not loaded: it must be read by the caller, e.g. with Response.stream() or chunks(),
+        or closed with Response.close(); otherwise, a pooled connection (pool=True) stays busy until the response is garbage-collected."""
         if not url:
             last = self._history.last()
             return last.resp if last else None
         # new request...
         self.url_now = url
         url = fix_url(url)
-        req = Request(url = url, data = data, headers = headers)
+        req = Request(url = url, data = data, headers = headers, stream = stream)
         resp = self.handlers.handle(req)
         self.url_now = None
         return resp                         # implicitly, the 'resp' object is remembered in browsing history, too
@@ -865,12 +1753,54 @@ class WebClient(Object):
         return self.response(url).read()
     #open = get                              # TODO: change open() API to only initiate the connection but not read the data
     
-    def download(self, filename, url = None):
-        "Download a page and save in file. The file will be overriden if exists. If url=None, the last accessed page is downloaded (or just saved if already retrieved)."
-        # TODO: transform to stream not batch download, to handle pages of arbitrary size
-        page = self.get(url)
-        with open(filename, 'wt') as f:
-            f.write(page)
+    def get_many(self, urls, concurrency = 8):
+        """Download many pages concurrently, in 'concurrency' threads that share the handlers of this client.
+        Generates triples (url, response, error) in the order of completion, as soon as every download completes: 'response' is
+        a Response object with the contents already loaded, or None if the download failed with exception 'error' (None otherwise).
+        URLs are reordered to interleave different hosts, so that threads don't wait all at once for the same rate-limited host
+        (see 'delay' in __init__) while other hosts are available. If the generator is closed early, pending downloads are cancelled.
+        """
+        def fetch(url):
+            try:
+                resp = self.response(url)
+                resp.read()
+                return url, resp, None
+            except Exception, e:
+                return url, None, e
+        
+        pool = ThreadPool(concurrency)
+        try:
+            for result in pool.imap_unordered(fetch, self._interleave(urls)):
+                yield result
+        finally:
+            pool.terminate()
+    
+    @staticmethod
+    def _interleave(urls):
+        "Reorder URLs, round-robin over hosts: 1st URL of every host, then 2nd URL of every host etc. Order of URLs of the same host is preserved."
+        byhost = OrderedDict()
+        for url in urls:
+            byhost.setdefault(urlparse.urlsplit(fix_url(url)).netloc.lower(), deque()).append(url)
+        queues = deque(byhost.values())
+        while queues:
+            queue = queues.popleft()
+            yield queue.popleft()
+            if queue: queues.append(queue)
+    
+    def download(self, filename, url = None, limit = None, hash = None, decompress = False):
+        """Download a page and save in file. The file will be overriden if exists. If url=None, the last accessed page is downloaded (or just saved if already retrieved).
+        The body is streamed to the file in chunks, never loaded into memory as a whole. If it turns out longer than 'limit' bytes,
+        or the download fails, the file is removed and exception raised. 'hash' and 'decompress' as in Response.stream().
+        Returns the Response, with no. of bytes saved in .size and digest of the contents in .digest (if 'hash' was given)."""
+        resp = self.response(url, stream = True)
+        try:
+            with open(filename, 'wb') as f:
+                resp.stream(f, limit = limit, hash = hash, decompress = decompress)
+        except:
+            resp.close()
+            if os.path.exists(filename): os.remove(filename)
+            raise
+        return resp
     
     def url(self):
         "Return requested URL of the last web access. (Use response() to get last response object.)"
@@ -905,69 +1835,407 @@ class WebClient(Object):
 
 ########################################################################################################################################################################
 ###
-###  Crawler (draft)
+###  Crawler
 ###
 
+class BloomFilter(object):
+    """Set of strings with a probabilistic membership test: no false negatives, false positives with probability 'error'
+    as long as no more than 'capacity' items were added (higher afterwards). Takes ~1.44*log2(1/error) bits per item,
+    e.g., 14.4 bits for error=0.001, regardless of the length of items.
+    """
+    def __init__(self, capacity, error = 0.001):
+        self.capacity = capacity
+        self.error = error
+        self.bits = int(math.ceil(-capacity * math.log(error) / math.log(2)**2))
+        self.hashes = max(1, int(round(self.bits * math.log(2) / capacity)))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _positions(self, item):
+        "Positions of bits for 'item': double hashing with two 64-bit halves of MD5 digest."
+        if isinstance(item, unicode): item = item.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def __contains__(self, item):
+        array = self.array
+        for pos in self._positions(item):
+            if not array[pos >> 3] & (1 << (pos & 7)): return False
+        return True
+
+    def add(self, item):
+        "Add 'item' to the set. Return True if it was (probably) present already, False if it definitely wasn't."
+        array = self.array
+        present = True
+        for pos in self._positions(item):
+            mask = 1 << (pos & 7)
+            if not array[pos >> 3] & mask:
+                array[pos >> 3] |= mask
+                present = False
+        if not present: self.count += 1
+        return present
+
+class ScalableBloomFilter(object):
+    """Bloom filter that grows with the no. of items, keeping the probability of false positives below 'error'.
+    Consists of a series of BloomFilters: when the last one is full, a new one is added, 'growth' times larger,
+    with the error rate 'tightening' times lower (Almeida et al., 2007), so that the total error rate converges to 'error'.
+    """
+    def __init__(self, capacity = 100000, error = 0.001, growth = 2, tightening = 0.5):
+        self.capacity = capacity
+        self.error = error
+        self.growth = growth
+        self.tightening = tightening
+        self.filters = []
+
+    def __len__(self):
+        return sum(len(f) for f in self.filters)
+
+    def __contains__(self, item):
+        return any(item in f for f in self.filters)
+
+    def add(self, item):
+        "Add 'item' to the set. Return True if it was (probably) present already, False if it definitely wasn't."
+        if item in self: return True
+        last = self.filters[-1] if self.filters else None
+        if last is None or len(last) >= last.capacity:
+            i = len(self.filters)
+            last = BloomFilter(self.capacity * self.growth ** i, self.error * (1 - self.tightening) * self.tightening ** i)
+            self.filters.append(last)
+        last.add(item)
+        return False
+
+
+class Frontier(object):
+    """Disk-backed queue of URLs to be crawled, for Crawler. URLs are kept in an SQLite database, together with their priority,
+    depth and state (pending, active, done, failed), so that crawling can be resumed after a crash or restart: URLs that
+    were active are pending again, to be downloaded once more. The same database is the exact store of all URLs seen so far;
+    a ScalableBloomFilter in front of it, rebuilt on startup, filters out most duplicates without a query.
+
+    next() returns the URL of the highest priority (lowest value) among the hosts that can be accessed now.
+    Politeness: every host has at most 1 active URL, and is accessed again not earlier than 'delay' seconds after
+    the previous download from this host completed. Up to BUFFER pending URLs of every host are kept in memory.
+    Thread-safe.
+    """
+    PENDING, ACTIVE, DONE, FAILED = range(4)
+    BUFFER = 100
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS urls (
+            id       INTEGER PRIMARY KEY,
+            url      TEXT NOT NULL UNIQUE,
+            host     TEXT NOT NULL,
+            priority REAL NOT NULL,                 -- lower values are crawled first
+            depth    INTEGER NOT NULL,              -- no. of links from a start URL
+            state    INTEGER NOT NULL DEFAULT 0     -- PENDING, ACTIVE, DONE, FAILED
+        );
+        CREATE INDEX IF NOT EXISTS urls_pending ON urls (host, state, priority);
+    """
+
+    def __init__(self, path = ':memory:', delay = 1.0, capacity = 100000, error = 0.001, exact = True):
+        """path: the database file, ':memory:' for a frontier that can't be resumed
+           capacity, error: initial capacity and error rate of the Bloom filter
+           exact: if False, URLs reported by the Bloom filter as seen are skipped without checking in the database,
+                  which saves a query per duplicate, but ~'error' fraction of new URLs will be lost
+        """
+        self.delay = delay
+        self.exact = exact
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")         # commits are not fsync'ed, but the database stays consistent after a crash
+        self.db.executescript(self.SCHEMA)
+        with self.db:
+            self.db.execute("UPDATE urls SET state = ? WHERE state = ?", (self.PENDING, self.ACTIVE))
+
+        self.lock = threading.Condition()                       # guards all the properties below and self.db; notified when a host may become ready
+        self.seen = ScalableBloomFilter(capacity, error)
+        for url, in self.db.execute("SELECT url FROM urls"): self.seen.add(url)
+        self.queues = {}                                        # host -> deque of its pending URLs in memory: (priority, id, url, depth)
+        self.waiting = []                                       # heap of (time when the host can be accessed, host)
+        self.ready = []                                         # heap of (priority of the next URL of the host, host) for hosts that can be accessed now
+        self.scheduled = set()                                  # hosts present in 'waiting' or 'ready'
+        self.last = {}                                          # host -> time when the host can be accessed again
+        self.active = {}                                        # id -> host, of active URLs
+        with self.lock:
+            for host, in self.db.execute("SELECT DISTINCT host FROM urls WHERE state = ?", (self.PENDING,)): self._wake(host)
+
+    @staticmethod
+    def host(url):
+        return urlparse.urlsplit(url).netloc.lower()
+
+    def _wake(self, host):
+        "Schedule 'host' to be accessed when the politeness delay passes, unless already scheduled."
+        if host in self.scheduled: return
+        self.scheduled.add(host)
+        self.queues.setdefault(host, deque())
+        heappush(self.waiting, (self.last.get(host, 0), host))
+        self.lock.notify()
+
+    def add(self, urls):
+        """Add new URLs, given as triples (url, priority, depth). URLs seen before, in any state, are ignored.
+        Returns the no. of URLs added."""
+        added = 0
+        with self.lock, self.db:
+            for url, priority, depth in urls:
+                if self.seen.add(url):
+                    if not self.exact: continue
+                    if self.db.execute("SELECT 1 FROM urls WHERE url = ?", (url,)).fetchone(): continue
+                host = self.host(url)
+                self.db.execute("INSERT INTO urls (url, host, priority, depth) VALUES (?,?,?,?)", (url, host, priority, depth))
+                added += 1
+                if host not in self.queues: self._wake(host)    # otherwise, the host is scheduled, or active and will be scheduled on release()
+        return added
+
+    def next(self, timeout = None):
+        """Take the next URL to be crawled and mark it as active. Return (id, url, depth), or None if there are no pending URLs
+        and no active ones (that might add new URLs), or no host gets ready within 'timeout' seconds (see finished())."""
+        deadline = now() + timeout if timeout is not None else None
+        with self.lock:
+            while True:
+                t = now()
+                while self.waiting and self.waiting[0][0] <= t:
+                    _, host = heappop(self.waiting)
+                    queue = self.queues[host]
+                    if not queue: queue.extend(self._load(host))
+                    if queue: heappush(self.ready, (queue[0][0], host))
+                    else:                                       # no more pending URLs of this host
+                        del self.queues[host]
+                        self.scheduled.discard(host)
+                if self.ready:
+                    _, host = heappop(self.ready)
+                    self.scheduled.discard(host)
+                    _, id, url, depth = self.queues[host].popleft()
+                    self.db.execute("UPDATE urls SET state = ? WHERE id = ?", (self.ACTIVE, id))       # committed together with the next change
+                    self.active[id] = host
+                    return id, url, depth
+                if self.finished(): return None
+                wait = self.waiting[0][0] - t if self.waiting else None
+                if deadline is not None:
+                    if t >= deadline: return None
+                    wait = min(wait, deadline - t) if wait is not None else deadline - t
+                self.lock.wait(wait)
+
+    def _load(self, host):
+        return self.db.execute("SELECT priority, id, url, depth FROM urls WHERE host = ? AND state = ? ORDER BY priority, id LIMIT ?",
+                               (host, self.PENDING, self.BUFFER)).fetchall()
+
+    def release(self, id):
+        "Download of an active URL completed (successfully or not): its host can be accessed again after 'delay'."
+        with self.lock:
+            host = self.active.get(id)
+            if host is None: return                             # URL was reset() in the meantime
+            t = now()
+            if len(self.last) > 100000:                         # forget hosts that can be accessed already
+                self.last = dict((h, ht) for h, ht in self.last.iteritems() if ht > t)
+            self.last[host] = t + self.delay
+            self._wake(host)
+
+    def done(self, id, failed = False):
+        "Processing of an active URL completed: mark it as done (or failed), to never download it again."
+        with self.lock, self.db:
+            if self.active.pop(id, None) is None: return
+            self.db.execute("UPDATE urls SET state = ? WHERE id = ?", (self.FAILED if failed else self.DONE, id))
+            if self.finished(): self.lock.notify_all()
+
+    def reset(self):
+        "Make all active URLs pending again, e.g. when crawling was interrupted and their downloads were lost."
+        with self.lock, self.db:
+            self.db.executemany("UPDATE urls SET state = ? WHERE id = ?", [(self.PENDING, id) for id in self.active])
+            hosts = set(self.active.values())
+            self.active.clear()
+            for host in hosts: self._wake(host)
+
+    def finished(self):
+        "True if there are no pending nor active URLs."
+        return not self.waiting and not self.ready and not self.active
+
+    def count(self, state = PENDING):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM urls WHERE state = ?", (state,)).fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+class Throughput(object):
+    "Counter of events (e.g., pages downloaded) that reports their rate per second: over the last 'window' seconds and since start."
+    def __init__(self, window = 10.0):
+        self.window = window
+        self.start = now()
+        self.total = 0
+        self.recent = deque()                                   # (time, count) of the events within the window
+
+    def add(self, count = 1):
+        t = now()
+        self.total += count
+        self.recent.append((t, count))
+        while self.recent and self.recent[0][0] < t - self.window: self.recent.popleft()
+
+    def rate(self):
+        "Events per second over the last 'window' seconds (or since start, if shorter)."
+        t = now()
+        while self.recent and self.recent[0][0] < t - self.window: self.recent.popleft()
+        return sum(c for _, c in self.recent) / max(min(self.window, t - self.start), 1e-6)
+
+    def mean(self):
+        "Events per second since start."
+        return self.total / max(now() - self.start, 1e-6)
+
+
 class Crawler(object):
-    
-    client = WebClient(timeout = 60, retryOnTimeout = 2, history = 1)
-    
+    """Concurrent web crawler built on WebClient. Pages are downloaded by 'concurrency' threads that share the same client,
+    starting from 'start' URLs and following links extracted from pages by process(); links are filtered by allowed()
+    and queued in a Frontier, breadth-first (priority = depth) or in random order, with politeness per host ('delay').
+    The frontier is stored in 'path' (SQLite database): if the crawler is created again with the same path, e.g. after a crash,
+    crawling resumes where it stopped, and URLs visited before are not downloaded again.
+    Throughput (pages/s) is logged every 'report' pages, see self.throughput.
+
+    Parameters can be passed to __init__ as keyword arguments, or overriden in subclasses as class properties. Example:
+
+        crawler = Crawler(start = ['http://example.com/'], domains = ['example.com'], path = 'example.crawl', pages_limit = 1000)
+        for url, page, resp in crawler.pages():
+            ...
+    """
+
+    client = None                   # WebClient to be used; default: WebClient(timeout = 60, retryOnTimeout = 2, history = 1, pool = True)
+    path = ':memory:'               # file with the frontier database; crawling can be resumed only if a file is given
+    concurrency = 8                 # no. of threads that download pages
+    delay = 1.0                     # min. delay between consecutive accesses to the same host, in seconds
+
     start = []                      # list of start URLs
-    domains = None                  # list of domain names to crawl (others will be ignored), case insensitive, implicitly includes all subdomains; None if all domains to be included 
+    domains = None                  # list of domain names to crawl (others will be ignored), case insensitive, implicitly includes all subdomains; None if all domains to be included
     url_include = None              # if not-None, every visited URL must match this pattern or function
     url_exclude = None              # if not-None, every visited URL must NOT match this pattern or function
-    pages_limit = None              # max. number of pages to visit
-    links_limit = None              # max. no. of URLs extracted from a single page; if more links are present, only the first 'limit_page' are used
-    random = False                  # if True, URLs will be visited in random order and not strictly breadth-first, rather than in their order on page 
-    
+    pages_limit = None              # max. number of pages to visit, including pages visited before resume
+    links_limit = None              # max. no. of URLs extracted from a single page; if more links are present, only the first 'links_limit' are used
+    random = False                  # if True, URLs will be visited in random order and not strictly breadth-first, rather than in their order on page
+    report = 100                    # log throughput every 'report' pages
+
+    _href = re.compile(r"""<a\s[^>]*?\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.IGNORECASE)
+
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
-        self.urls = deque(self.start)                       # queue of pending URLs (pages not downloaded yet)
-        self.visited = set()
-        
-        # combine filtering patterns into one regex
-        self.url_filter 
-        
+        if self.client is None: self.client = WebClient(timeout = 60, retryOnTimeout = 2, history = 1, pool = True)
+        self.log = self.client.logger or noLogger
+        self.domains = [d.lower().lstrip('.') for d in self.domains] if self.domains is not None else None
+        self.frontier = Frontier(self.path, self.delay)
+        self.frontier.add((url, self.priority(url, 0), 0) for url in map(self.normalize, map(fix_url, self.start)) if self.allowed(url))
+        self.throughput = Throughput()
+
     def pages(self):
-        """Generator that yields consecutive URLs and pages visited, as pairs (url, page_content, response_object), starting URLs included;
+        """Generator that yields consecutive URLs and pages visited, as triples (url, page_content, response_object), starting URLs included;
         'url' and 'page' are strings, 'response' is an http Response object, with fields like status code, headers etc.
-        At the end (when all urls processed or terminated by client) the final state of crawling process is still present in self.urls and self.visited.
+        Pages are yielded in the order of download, which is only roughly the order of priority, due to concurrency and politeness.
+        Links are extracted and the page is marked as done only after the caller processed it, i.e., asked for the next page:
+        if the crawler is interrupted, the last page will be downloaded and yielded again on resume.
+        When all URLs are processed, pages_limit reached or the generator closed, the state of crawling is still present in self.frontier.
         Invoking the crawler again will start from the point where previous call has finished! """
-        def nexturl(self):
-            if not self.urls: return None
-            if random: 
-                i = random.randint(0, len(self.urls)-1)
-                url = self.urls[i]
-                self.urls[i] = self.urls.popright()
-                return url
-            return self.urls.popleft()
-        def skip(url):
-            if not self.allowed(url) or url in self.visited: return True
-            return False        
-    
-        while True:
-            url = nexturl()
-            if url is None: break       # no more pages to visit
-            if skip(url): continue
-            self.visited.add(url)
-            try: page = self.client.get(url)
-            except: continue            # failed to open the page? ignore
-            yield url, page
-            self.urls += self.process(page, url)            
+        frontier = self.frontier
+        results = Queue(self.concurrency * 2)
+        stop = threading.Event()
+
+        def worker():
+            while not stop.is_set():
+                task = frontier.next(timeout = 0.5)
+                if task is None:
+                    if frontier.finished(): break
+                    continue
+                if stop.is_set(): break                         # the task will be reset()
+                id, url, depth = task
+                try:
+                    resp = self.client.response(url)
+                    result = (id, url, depth, resp, resp.read(), None)
+                except Exception, e:
+                    result = (id, url, depth, None, None, e)
+                frontier.release(id)
+                while not stop.is_set():
+                    try: results.put(result, timeout = 0.5); break
+                    except Full: pass
+            if not stop.is_set(): results.put(None)             # this worker ends
+
+        visited = frontier.count(Frontier.DONE)
+        if self.pages_limit is not None and visited >= self.pages_limit: return
+        threads = [threading.Thread(target = worker, name = "Crawler worker %d" % i) for i in range(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        running = len(threads)
+        try:
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                id, url, depth, resp, page, error = result
+                if error is not None:
+                    self.log.warn("Crawler, failed to download %s: %s" % (url, error))
+                    frontier.done(id, failed = True)
+                    continue
+
+                yield url, page, resp
+
+                links = [link for link in map(self.normalize, self.process(page, resp.url or url)) if self.allowed(link)]
+                if self.links_limit is not None: links = links[:self.links_limit]
+                frontier.add((link, self.priority(link, depth + 1), depth + 1) for link in links)
+                frontier.done(id)
+
+                self.throughput.add()
+                if self.report and self.throughput.total % self.report == 0:
+                    self.log.info("Crawler, %d pages visited, %.1f pages/s (%.1f pages/s on average)" %
+                                  (self.throughput.total, self.throughput.rate(), self.throughput.mean()))
+                visited += 1
+                if self.pages_limit is not None and visited >= self.pages_limit: break
+        finally:
+            stop.set()
+            for thread in threads: thread.join()                # wait for downloads in progress, at most for the client's timeout
+            frontier.reset()                                    # pages downloaded but not processed will be downloaded again next time
 
     def allowed(self, url):
-        "Check if this url is allowed to visit."
-        
+        "Check if this url is allowed to visit: http(s) scheme, domain in 'domains', matches 'url_include' and doesn't match 'url_exclude'."
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'): return False
+        if self.domains is not None:
+            host = parts.hostname or ''
+            if not any(host == d or host.endswith('.' + d) for d in self.domains): return False
+        if self.url_include is not None and not self._match(self.url_include, url): return False
+        if self.url_exclude is not None and self._match(self.url_exclude, url): return False
+        return True
+
+    @staticmethod
+    def _match(pattern, url):
+        if callable(pattern): return pattern(url)
+        return re.search(pattern, url) is not None
+
+    def priority(self, url, depth):
+        "Priority of a URL in the frontier, lower values are crawled first: depth (breadth-first), or random if self.random. Can be overriden in subclasses."
+        return random.random() if self.random else depth
+
+    @staticmethod
+    def normalize(url):
+        "Canonical form of a URL, for deduplication: lower-case scheme and host, no fragment, '/' as an empty path."
+        parts = urlparse.urlsplit(url)
+        return urlparse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', parts.query, ''))
+
+    @classmethod
+    def extractUrls(cls, page, url):
+        "Absolute URLs of all links (<a href>) in the 'page' located at 'url', in order of occurrence, without fragments."
+        links = []
+        for match in cls._href.finditer(page):
+            link = (match.group(1) or match.group(2) or match.group(3) or '').strip().replace('&amp;', '&')
+            if link and not link.startswith(('#', 'javascript:', 'mailto:')):
+                links.append(urlparse.urldefrag(urlparse.urljoin(url, link))[0])
+        return links
 
-    @staticmethod            
-    def extractUrls(page, parsehtml = False):
-        #if self.nofollow(url): continue         # filter out non-HTML contents
-        return []
-    
     def process(self, page, url):
         "Called in crawler loop. Can be overriden in subclasses to provide custom processing of pages. extraction of URLs and/or custom data collection from visited pages."
         return self.extractUrls(page, url)
-    
+
 
 ########################################################################################################################################################################
 ###
@@ -1272,6 +2540,296 @@ tree = lxml.html.fromstring(dom.toxml())
 """
 
 if __name__ == "__main__":
-    import doctest
+    import doctest, gzip, BaseHTTPServer, SocketServer
+    from timeit import timeit
+    
+    class TestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        """Local HTTP/1.1 server with keep-alive, a stand-in for real websites in benchmarks, running in a background thread.
+        GET /redirect* redirects to /page; GET or POST /fail* returns 503 Service Unavailable; GET /site/<n> returns n-th page of a website of 'site' pages linked into a tree,
+        10 children per page, every page linking to its children, parent and the home page /site/0;
+        any other path returns a page of 'size' bytes, gzipped if the client accepts gzip.
+        If 'validators' is True, pages are sent with ETag and Last-Modified, and conditional requests are answered with 304.
+        Every server listens on a different port, so several servers are seen by clients as different hosts."""
+        daemon_threads = True
+        
+        def __init__(self, size = 10000, latency = 0, validators = True, site = 1000):
+            BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), TestHandler)
+            self.site = site
+            self.latency = latency              # response delay, in seconds, to simulate a remote server
+            self.validators = validators
+            self.sent = 0                       # total size of response bodies sent, in bytes
+            self.failed = 0                     # no. of requests answered with 503
+            self.page = ''.join("<p>Paragraph no. %d of a test page.</p>\n" % i for i in range(size / 40 + 1))[:size]
+            buf = StringIO()
+            with gzip.GzipFile(fileobj = buf, mode = 'wb') as f: f.write(self.page)
+            self.gzipped = buf.getvalue()
+            self.url = 'http://127.0.0.1:%d/' % self.server_port
+            thread = threading.Thread(target = self.serve_forever)
+            thread.daemon = True
+            thread.start()
+    
+    class TestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def setup(self):
+            BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)      # no Nagle's delays on keep-alive connections, like in real servers
+        
+        def do_GET(self):
+            if self.server.latency: time.sleep(self.server.latency)
+            if self.path.startswith('/redirect'):
+                return self.reply(302, '', [('Location', '/page')])
+            if self.path.startswith('/fail'):
+                self.server.failed += 1
+                return self.reply(503, 'Service Unavailable')
+            if self.path.startswith('/site/'):
+                n = int(self.path[6:])
+                links = [i for i in range(10*n + 1, 10*n + 11) + [(n - 1) // 10, 0] if 0 <= i < self.server.site]
+                return self.reply(200, "<html><body><h1>Page %d</h1>%s</body></html>" % (n, "".join("<a href='/site/%d'>page %d</a>\n" % (i, i) for i in links)))
+            headers = []
+            if self.server.validators:
+                headers = [('ETag', '"%x"' % (zlib.crc32(self.path) & 0xffffffff)), ('Last-Modified', 'Mon, 02 Jan 2017 10:00:00 GMT')]
+                if self.headers.getheader('if-none-match') == headers[0][1] or self.headers.getheader('if-modified-since') == headers[1][1]:
+                    return self.reply(304, '', headers)
+            if 'gzip' in self.headers.getheader('accept-encoding', ''):
+                return self.reply(200, self.server.gzipped, headers + [('Content-Encoding', 'gzip')])
+            self.reply(200, self.server.page, headers)
+        
+        def do_POST(self):
+            self.rfile.read(int(self.headers.getheader('content-length', 0)))
+            self.do_GET()
+        
+        def reply(self, status, body, headers = []):
+            self.server.sent += len(body)
+            self.send_response(status)
+            for name, value in headers + [('Content-Type', 'text/html'), ('Content-Length', len(body))]:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def log_message(self, *args): pass
+    
+    def bench_pooled_client(requests = 1000):
+        "Requests per second to a local server: a new connection per request (StandardClient, urllib2) vs. keep-alive connections (PooledClient)."
+        server = TestServer()
+        clients = [("StandardClient", StandardClient([], CookieJar())),
+                   ("PooledClient", PooledClient(CookieJar())),
+                   ("PooledClient, no gzip", PooledClient(decode = False))]
+        for name, client in clients:
+            resp = client.handle(Request(server.url + 'redirect'))
+            assert resp.read() == server.page and resp.url == server.url + 'page'
+            t = timeit(lambda: client.handle(Request(server.url + 'page')).read(), number = requests)
+            print "%-22s %6.0f requests/s" % (name, requests / t)
+            if isinstance(client, PooledClient): client.pool.clear()
+        server.shutdown()
+    
+    def bench_get_many(hosts = 4, pages = 25, latency = 0.05, delay = 0.1):
+        """Download 'pages' pages from each of 'hosts' local servers with 'latency' [s] response time and 'delay' [s] rate limit per host:
+        sequentially with a global Delay (the former WebClient's 'delay'), and with get_many() and per-host RateLimit."""
+        servers = [TestServer(latency = latency) for _ in range(hosts)]
+        urls = [server.url + 'page%d' % i for server in servers for i in range(pages)]
+        
+        client = WebClient(history = 1, referer = False, pool = True, tail = [Delay(delay)])
+        t = timeit(lambda: [client.get(url) for url in urls], number = 1)
+        print "get(), global Delay                 %6.1f pages/s" % (len(urls) / t)
+        
+        for concurrency in [1, 4, 16]:
+            client = WebClient(history = 1, referer = False, pool = True, delay = delay)
+            results = []
+            t = timeit(lambda: results.extend(client.get_many(urls, concurrency)), number = 1)
+            assert len(results) == len(urls) and not any(error for _, _, error in results)
+            print "get_many(concurrency = %2d), RateLimit %6.1f pages/s" % (concurrency, len(urls) / t)
+        for server in servers: server.shutdown()
+    
+    class TestPages(WebHandler):
+        "Last handler of a chain that serves 'count' synthetic pages without network: http://test/<no>; a common layout + unique text, like pages of a website."
+        def __init__(self, count = 1000, seed = 0):
+            rand = random.Random(seed)
+            words = ["".join(rand.choice('abcdefghijklmnoprstuwyz') for _ in range(rand.randint(2, 9))) for _ in range(3000)]
+            layout = "<html><head><title>Page %%d</title>%s</head><body><div id='menu'>%s</div><div id='content'>%%s</div><footer>%s</footer></body></html>" % \
+                     ("<link rel='stylesheet' href='/static/style.css'>" * 5, "".join("<a href='/section/%d'>%s</a>" % (i, rand.choice(words)) for i in range(60)),
+                      "<p>Copyright (c) by the Test Company. All rights reserved.</p>" * 10)
+            self.pages = [layout % (i, " ".join(rand.choice(words) for _ in range(rand.randint(100, 600)))) for i in range(count)]
+        def handle(self, req):
+            resp = Response()
+            resp.url = req.url
+            resp.content = self.pages[int(req.url.rsplit('/', 1)[1])]
+            resp.headers = {}
+            return resp
+    
+    def bench_cache(pages = 2000, requests = 20000, memory = 4*2**20):
+        """Storage size and read performance of Cache with different codecs; reads follow Zipf-like distribution of URLs,
+        without and with the memory tier of 'memory' bytes."""
+        import tempfile, shutil
+        server = TestPages(pages)
+        rand = random.Random(1)
+        urls = ['http://test/%d' % min(int(rand.paretovariate(0.8)) - 1, pages - 1) for _ in range(requests)]
+        configs = [("raw", dict(compress = None)), ("zlib", dict(compress = 'zlib')), ("zstd", dict(compress = 'zstd')), ("zstd + dictionary", dict(compress = 'zstd'))]
+        for name, params in configs:
+            for mem in [None, memory]:
+                path = tempfile.mkdtemp()
+                cache = Cache(path, memory = mem, maintain = False, **params)
+                cache.next = server
+                for i in range(pages / 10 if 'dictionary' in name else 0): cache.handle(Request('http://test/%d' % i))
+                if 'dictionary' in name: cache.train()
+                reqs = [Request('http://test/%d' % i) for i in range(pages)]
+                t1 = timeit(lambda: [cache._store(req, server.handle(req)) for req in reqs], number = 1)
+                cache.stats = dict.fromkeys(cache.stats, 0)
+                if cache.memory is not None: cache.memory = LRU(mem)                    # start reading with empty memory
+                t2 = timeit(lambda: [cache.handle(Request(url)) for url in urls], number = 1)
+                s = cache.report()
+                print "%-18s memory %5s:  stored %5.1f%% of %.1f MB, write %5.0f pages/s, read %6.0f pages/s, memory hits %.3f, read amplification %.3f" % \
+                      (name, mem and "%dM" % (mem / 2**20), 100. - 100. * s['saved_total'] / sum(map(len, server.pages)), sum(map(len, server.pages)) / 1e6,
+                       pages / t1, requests / t2, s['memory_ratio'], s['read_amplification'])
+                shutil.rmtree(path)
+    
+    def bench_eviction(pages = 5000, batch = 200):
+        """Speed of LRU eviction by Cache.maintain(), in steps of 'batch' pages, after the limit on the no. of pages was halved;
+        and latency of reads served concurrently with the maintenance thread."""
+        import tempfile, shutil
+        server = TestPages(pages)
+        path = tempfile.mkdtemp()
+        cache = Cache(path, maintain = False, memory = None)
+        cache.next = server
+        for i in range(pages): cache._store(Request('http://test/%d' % i), server.handle(Request('http://test/%d' % i)))
+        cache.maintain()
+        recent = ['http://test/%d' % i for i in range(0, pages, 4)]
+        for url in recent: cache.handle(Request(url))
+        cache.maxentries = pages / 2
+        t = timeit(lambda: cache.maintain(batch), number = (pages / 2) / batch)
+        survived = sum(1 for url in recent if cache._cachedResponse(Request(url)))
+        print "Cache.maintain(%d)     %6.0f pages evicted/s, %d of %d recently used pages kept" % (batch, batch * ((pages / 2) / batch) / t, survived, len(recent))
+        
+        cache.maxentries = pages / 4
+        cache.interval = 0.01
+        cache.worker = threading.Thread(target = Cache._maintain, args = (weakref.ref(cache), cache.stopped, cache.interval))
+        cache.worker.start()
+        t = timeit(lambda: [cache.handle(Request(url)) for url in recent], number = 1)
+        cache.stop()
+        print "Cache.handle()          %6.0f reads/s during background eviction, %d pages left" % (len(recent) / t, cache.totals[0])
+        shutil.rmtree(path)
+    
+    def bench_revalidation(pages = 200, latency = 0.002):
+        """Recrawl of 'pages' unchanged pages from a local server with 'latency' [s] response time, after all of them went stale in Cache:
+        with validators (conditional requests, 304 responses) and without them (full downloads)."""
+        import tempfile, shutil
+        for validators in [False, True]:
+            server = TestServer(size = 50000, latency = latency, validators = validators)
+            for name, client in [("StandardClient", StandardClient([], CookieJar())), ("PooledClient", PooledClient(decode = False))]:
+                path = tempfile.mkdtemp()
+                cache = Cache(path, refresh = 1e-9, maintain = False)                   # every page goes stale right after download
+                cache.next = client
+                urls = [server.url + 'page%d' % i for i in range(pages)]
+                for url in urls: cache.handle(Request(url))
+                sent = server.sent
+                t = timeit(lambda: [cache.handle(Request(url)) for url in urls], number = 1)
+                print "recrawl, %-14s %-18s %6.0f pages/s, %5.1f kB/page transferred, %d revalidated" % \
+                      (name, "with validators" if validators else "without validators", pages / t, (server.sent - sent) / 1e3 / pages, cache.stats['revalidated'])
+                assert all(cache.handle(Request(url)).content == server.page for url in urls[:10])
+                shutil.rmtree(path)
+            server.shutdown()
+    
+    def bench_download(size = 20*2**20):
+        """Download of a 'size'-byte file from a local server to disk: streamed by WebClient.download(), without and with SHA-256 computed
+        on the fly, vs. loaded into memory with get() and written afterwards. Every download runs in a forked process (Unix only),
+        where memory use is measured as the growth of peak RSS."""
+        import tempfile, resource
+        server = TestServer(size = size)
+        path = tempfile.mktemp()
+        def buffered(client):
+            page = client.get(server.url + 'file')
+            with open(path, 'wb') as f: f.write(page)
+        downloads = [("streamed", lambda client: client.download(path, server.url + 'file')),
+                     ("streamed + sha256", lambda client: client.download(path, server.url + 'file', hash = 'sha256')),
+                     ("buffered", buffered)]
+        for name, download in downloads:
+            r, w = os.pipe()
+            if os.fork() == 0:
+                client = WebClient(history = 1, pool = True)
+                rss = int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize() / 1024     # current RSS, in kB
+                t = timeit(lambda: download(client), number = 1)
+                assert os.path.getsize(path) == size
+                os.write(w, "%f %d" % (t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss))
+                os._exit(0)
+            os.close(w)
+            t, memory = os.read(r, 100).split()
+            os.close(r)
+            os.wait()
+            print "download(), %-18s %6.1f MB/s, peak memory +%.1f MB" % (name, size / float(t) / 2**20, int(memory) / 1024.)
+        os.remove(path)
+        server.shutdown()
+    
+    def bench_crawler(hosts = 8, site = 200, latency = 0.01, delay = 0.02):
+        """Crawl of 'hosts' local websites of 'site' pages each, with 'latency' [s] response time and 'delay' [s] politeness per host,
+        using a different no. of worker threads; the last crawl is interrupted halfway and resumed."""
+        import tempfile
+        servers = [TestServer(latency = latency, site = site) for _ in range(hosts)]
+        start = [server.url + 'site/0' for server in servers]
+        pool = ConnectionPool()
+        for concurrency in [1, 4, 16]:
+            crawler = Crawler(start = start, delay = delay, concurrency = concurrency, report = None, client = WebClient(history = 1, referer = False, pool = pool))
+            count = sum(1 for _ in crawler.pages())
+            assert count == hosts * site
+            print "Crawler(concurrency = %2d)  %6.1f pages/s" % (concurrency, crawler.throughput.mean())
+        
+        path = tempfile.mktemp()
+        for limit in [hosts * site / 2, None]:
+            crawler = Crawler(start = start, delay = delay, concurrency = 16, path = path, pages_limit = limit, client = WebClient(history = 1, referer = False, pool = pool))
+            count = sum(1 for _ in crawler.pages())
+            crawler.frontier.close()
+        assert count == hosts * site / 2
+        print "Crawler, interrupted and resumed: %d pages in the 2nd run, %d in total" % (count, hosts * site)
+        os.remove(path)
+        pool.clear()
+        for server in servers: server.shutdown()
+    
+    def bench_retries(attempts = 3, requests = 200, body = 2**20, threads = 8):
+        """Retries of POST requests with a 'body'-byte body to a local server that always fails with 503: cost of copying the request
+        before every attempt, deepcopy() vs. Request.copy(), in time and memory (RSS growth per copy kept alive, Linux only);
+        then time per attempt of RetryOnError with zero delay, and the no. of attempts that reach the server
+        from concurrent 'threads' without and with RetryBudget."""
+        import resource
+        server = TestServer()
+        req = Request(server.url + 'fail', 'x' * body, {'Content-Type': 'application/octet-stream', 'X-Test': 'retries'})
+        rss = lambda: int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize()
+        for name, copier in [("deepcopy()", deepcopy), ("Request.copy()", Request.copy)]:
+            t = timeit(lambda: copier(req), number = 100) / 100
+            before = rss()
+            copies = [copier(req) for _ in range(50)]
+            memory = (rss() - before) / 50.
+            del copies
+            print "retry, request copy by %-15s %8.1f us/copy, %8.1f kB allocated/copy" % (name, t * 1e6, memory / 1e3)
+        
+        retry = RetryOnError(attempts, delay = 0, exclude = [])
+        retry.next = PooledClient(CookieJar())
+        def attempt(send, req):
+            try: send(req)
+            except HTTPError: pass
+        t = timeit(lambda: attempt(retry.handle, req), number = 20)
+        print "retry, RetryOnError(delay = 0)        %8.1f ms/attempt" % (t / 20 / (attempts + 1) * 1e3)
+        retry.next.pool.clear()
+        
+        for budget in [False, True]:
+            client = WebClient(history = 1, referer = False, retryOnError = attempts, retryBudget = budget, pool = True)
+            client._retryOnError.delay = 0
+            client._retryOnError.exclude = []
+            failed = server.failed
+            pool = ThreadPool(threads)
+            pool.map(lambda _: attempt(client.get, server.url + 'fail'), range(requests))
+            pool.close()
+            print "retry, %d requests, %-10s %6d attempts sent to the failing server" % (requests, "budget" if budget else "no budget", server.failed - failed)
+            client._client.pool.clear()
+        server.shutdown()
+    
     print doctest.testmod()
     
+    if 'bench' in sys.argv[1:]:
+        bench_pooled_client()
+        bench_get_many()
+        bench_cache()
+        bench_eviction()
+        bench_revalidation()
+        bench_crawler()
+        bench_download()
+        bench_retries()
+    